@@ -28,15 +28,19 @@ class AudiologyAppStack(Stack):
         fn = _lambda.Function(
             self, "AudiologyHandler",
             runtime=_lambda.Runtime.PYTHON_3_10,
-            handler="handler.handler",
-            code=_lambda.Code.from_asset(os.path.join(cwd, "lambda")),  # directory with handler.py & deps
+            handler="audiology_mee1call.lambda_handler",
+            code=_lambda.Code.from_asset(os.path.join(cwd, "lambda")),  # directory with handler & deps
             memory_size=512,
-            timeout=Duration.seconds(15),
+            # Room for several model calls per invocation; patients left at the deadline resume
+            # from a continuation object
+            timeout=Duration.minutes(5),
             environment={
                 "BUCKET_NAME": bucket_name,
+                "MAX_WORKERS": "4",
             }
         )
-        self.bucket.grant_read(fn)
+        # write access for classification results and continuation objects
+        self.bucket.grant_read_write(fn)
 
         self.bucket.add_event_notification(
             s3.EventType.OBJECT_CREATED_PUT,
@@ -45,3 +49,11 @@ class AudiologyAppStack(Stack):
             # only trigger when lab data is input to the bucket of type .json
             s3.NotificationKeyFilter(prefix="lab_data_input/", suffix=".json")
         )
+
+        self.bucket.add_event_notification(
+            s3.EventType.OBJECT_CREATED_PUT,
+            s3n.LambdaDestination(fn),
+
+            # resume files whose patients did not all finish before the function timeout
+            s3.NotificationKeyFilter(prefix="lab_data_continuation/", suffix=".json")
+        )
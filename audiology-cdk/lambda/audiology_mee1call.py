@@ -1,82 +1,196 @@
+import time
+
+_INIT_STARTED = time.perf_counter()
+
 import json
 import os
+import io
 import re
 import boto3
 import logging
-from langchain_aws.chat_models import ChatBedrock
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import unquote_plus
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-s3_client = boto3.client("s3")
 
-bedrock_runtime = boto3.client("bedrock-runtime", region_name="us-west-2")
+REGION = "us-west-2"
 BUCKET_NAME = os.environ['BUCKET_NAME']
-
-
-def categorize_diagnosis_with_lm(report, results, institution_template, valid_values, guidelines):
+CONFIG_KEY = "/Config/config.json"
+CONTINUATION_PREFIX = "lab_data_continuation/"
+# Outputs above this size are uploaded in parts
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# Patients classified concurrently per container, counting calls an earlier invocation abandoned
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "4"))
+# Time kept back from the Lambda deadline to write the continuation object
+DEADLINE_MARGIN_MS = int(os.environ.get("DEADLINE_MARGIN_MS", "3000"))
+MAX_CONTINUATIONS = int(os.environ.get("MAX_CONTINUATIONS", "20"))
+
+# Cross-region inference profile for Nova Pro
+MODEL_ID = "us.amazon.nova-pro-v1:0"
+INFERENCE_CONFIG = {
+    "maxTokens": 4096,
+    "temperature": 0.0,
+    "topK": 250,
+    "topP": 0.9,
+    "stopSequences": ["\n\nHuman"]
+}
+SYSTEM_PROMPT = ("You are an expert **pediatric** audiologist that extracts explicit hearing test data "
+                 "and classifies hearing loss accurately.")
+
+# Module-level state survives warm invocations of the same container
+_config_cache = {"etag": None, "config": None}
+_prompt_cache = {}
+_clients = {}
+_startup = {"cold": True, "init_ms": None, "setup_ms": None}
+# Model calls still running after the invocation that started them returned at its deadline
+_abandoned = set()
+
+
+def get_client(service):
+    """Create boto3 clients on first use rather than at import, so unused ones cost nothing."""
+    if service not in _clients:
+        _clients[service] = boto3.client(service, region_name=REGION)
+    return _clients[service]
+
+
+def load_config():
+    """Return config.json from S3, revalidating a cached copy by ETag instead of re-reading it."""
+    try:
+        if _config_cache["etag"]:
+            resp = get_client("s3").get_object(Bucket=BUCKET_NAME, Key=CONFIG_KEY,
+                                               IfNoneMatch=_config_cache["etag"])
+        else:
+            resp = get_client("s3").get_object(Bucket=BUCKET_NAME, Key=CONFIG_KEY)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+            return _config_cache["config"], _config_cache["etag"]
+        raise
+
+    _config_cache["config"] = json.loads(resp['Body'].read())
+    _config_cache["etag"] = resp["ETag"]
+    logger.info("Loaded %s (ETag %s)", CONFIG_KEY, resp["ETag"])
+    return _config_cache["config"], _config_cache["etag"]
+
+
+def get_classification_prompt(institution, institution_template, valid_values, guidelines, config_etag):
+    """
+    Return the institution part of the prompt, built once per institution and config version.
+
+    The template, valid values, guidelines and processing rules follow the patient data,
+    so each patient only adds the report and results in front of this text.
+    """
+    cache_key = (institution, config_etag)
+    prompt = _prompt_cache.get(cache_key)
+    if prompt is not None:
+        return prompt
+
+    prompt = ("**Use the classification template and guidelines** to determine:\n"
+              f"{json.dumps(institution_template, indent=4)}\n\n"
+              f"**Valid Values:**\n```json\n{json.dumps(valid_values, indent=4)}\n```\n\n"
+              f"**Guidelines for Classification:**\n```json\n{json.dumps(guidelines, indent=4)}\n```\n\n"
+
+              "**Processing Rules (MUST Follow):**\n"
+              "- **Use only explicitly provided threshold values**; do not infer missing values.\n"
+              "- **If multiple severities are listed, assign the most severe classification.**\n"
+
+              "**Output Requirements:**\n"
+              "- Return classification in **EXACT JSON format** as per the template, with no modifications.\n"
+              "- Provide **precise reasoning** for each classification.\n"
+              "- Make sure there is thorough, chain of thought reasoning for each attribute's output."
+              "- **Cite guideline numbers** when making classification decisions.\n"
+              "- **DO NOT include any additional explanations, assumptions, or commentary.**\n")
+
+    # Prompts for superseded config versions are dropped
+    for key in [key for key in _prompt_cache if key[0] == institution]:
+        del _prompt_cache[key]
+    _prompt_cache[cache_key] = prompt
+    return prompt
+
+
+def categorize_diagnosis_with_lm(institution_prompt, report, results):
     """Uses LLM to extract explicit facts and classify hearing loss in one step."""
 
-    model_id = "us.amazon.nova-pro-v1:0"
-    model_kwargs = {
-        "max_tokens": 4096,
-        "temperature": 0.0,
-        "top_k": 250,
-        "top_p": 0.9,
-        "stop_sequences": ["\n\nHuman"],
-        "inference_profile_arn": "arn:aws:bedrock:us-west-2:762233745628:inference-profile/us.amazon.nova-pro-v1:0"
+    user_prompt = (f"Here is the **hearing report**:\n\n{report}\n\n"
+                   f"Here are the **audiometric test results**:\n\n{json.dumps(results, indent=4)}\n\n"
+                   f"{institution_prompt}")
+    body = {
+        "schemaVersion": "messages-v1",
+        "system": [{"text": SYSTEM_PROMPT}],
+        "messages": [{"role": "user", "content": [{"text": user_prompt}]}],
+        "inferenceConfig": INFERENCE_CONFIG
     }
 
-    model = ChatBedrock(client=bedrock_runtime, model_id=model_id, model_kwargs=model_kwargs)
+    try:
+        response = get_client("bedrock-runtime").invoke_model(
+            modelId=MODEL_ID,
+            body=json.dumps(body),
+            contentType="application/json",
+            accept="application/json"
+        )
+        output = json.loads(response["body"].read())
+        return output["output"]["message"]["content"][0]["text"]
+    except Exception as e:
+        return f"Error categorizing diagnosis: {e}"
+
 
-    results_json_str = json.dumps(results, indent=4).replace("{", "{{").replace("}", "}}")
-    json_template_fixed = json.dumps(institution_template, indent=4).replace("{", "{{").replace("}", "}}")
+def classify_patient(institution_prompt, index, patient):
+    """Classify one patient; returns its output entry, with either the diagnosis or an error."""
+    print(f"\nProcessing patient {index}...\n")
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system",
-         "You are an expert **pediatric** audiologist that extracts explicit hearing test data and classifies hearing loss accurately."),
-        ("human", "{report_text}\n\n"
-                  "Here are the **audiometric test results**:\n\n{results_json}\n\n"
-                  "**Use the classification template and guidelines** to determine:\n"
-                  "{json_template}\n\n"
-                  "**Valid Values:**\n```json\n{valid_values}\n```\n\n"
-                  "**Guidelines for Classification:**\n```json\n{guidelines}\n```\n\n"
+    raw_report = patient.get("Report", "").strip()
+    audiometric_results = patient.get("Results", [])
 
-                  "**Processing Rules (MUST Follow):**\n"
-                  "- **Use only explicitly provided threshold values**; do not infer missing values.\n"
-                  "- **If multiple severities are listed, assign the most severe classification.**\n"
+    if not raw_report and not audiometric_results:
+        print(f"Skipping patient {index}: No data found.")
+        return {"index": index, "error": "No data found"}
 
-                  "**Output Requirements:**\n"
-                  "- Return classification in **EXACT JSON format** as per the template, with no modifications.\n"
-                  "- Provide **precise reasoning** for each classification.\n"
-                  "- Make sure there is thorough, chain of thought reasoning for each attribute's output."
-                  "- **Cite guideline numbers** when making classification decisions.\n"
-                  "- **DO NOT include any additional explanations, assumptions, or commentary.**\n"
-         )
-    ])
+    # Extract and categorize in a single step
+    diagnosis_results = categorize_diagnosis_with_lm(institution_prompt, raw_report, audiometric_results)
+    if "Error" in diagnosis_results:
+        print(f"Skipping patient {index} due to categorization error: {diagnosis_results}")
+        return {"index": index, "error": diagnosis_results}
 
-    chain = prompt | model | StrOutputParser()
+    print("Diagnosis Categorization Results:\n", diagnosis_results)
 
+    # Extract JSON response
     try:
-        return chain.invoke({
-            "report_text": f"Here is the **hearing report**:\n\n{report}",
-            "results_json": results_json_str,
-            "json_template": json_template_fixed,
-            "valid_values": json.dumps(valid_values, indent=4),
-            "guidelines": json.dumps(guidelines, indent=4)
-        })
-    except Exception as e:
-        return f"Error categorizing diagnosis: {e}"
+        match = re.search(r'```json\n(.*?)\n```', diagnosis_results, re.DOTALL)
+        if match:
+            diagnosis_json_str = match.group(1).strip()
+            return {"index": index, "result": json.loads(diagnosis_json_str)}
+
+        print(f"Error: Could not find valid JSON in LLM response for patient {index}.")
+        return {"index": index, "error": "No JSON in model response"}
+
+    except json.JSONDecodeError as e:
+        print(f"Error parsing JSON for patient {index}: {e}")
+        return {"index": index, "error": f"Invalid JSON in model response: {e}"}
+
+
+def process_audiology_data(input_json, institution, context=None):
+    """
+    Processes the audiology JSON data, merging extraction and classification into one step.
+
+    Patients are classified concurrently, at most MAX_WORKERS at a time. When a Lambda context is
+    given, no new patient is started once the remaining time drops below DEADLINE_MARGIN_MS plus the
+    slowest patient seen so far, and patients still running at the margin are abandoned.
 
+    Abandoned calls keep running in the warm container, so they hold on to their MAX_WORKERS slots
+    in later invocations until they finish; at most MAX_WORKERS calls are ever running at once.
 
-def process_audiology_data(input_json, institution):
-    """Processes the audiology JSON data, merging extraction and classification into one step."""
+    :param input_json: Either the list of patients, or a list of (index, patient) pairs when resuming
+    :return: The output entries of finished patients, and the (index, patient) pairs that
+             were not finished before the deadline
+    """
 
-    # load config from S3
-    resp = s3_client.get_object(Bucket=BUCKET_NAME, Key="/Config/config.json")
-    body = resp['Body'].read()
-    config = json.loads(body)
+    setup_started = time.perf_counter()
+
+    # load config from S3 (cached across warm invocations)
+    config, config_etag = load_config()
 
     institution_data = config["templates"].get(institution, {})
     institution_template = institution_data.get("template", {})
@@ -85,80 +199,217 @@ def process_audiology_data(input_json, institution):
 
     if not institution_template:
         print(f"Error: No template found for institution '{institution}'. Exiting...")
-        return
+        return [], []
 
     if not processing_guidelines:
         print(f"Warning: No processing guidelines found for '{institution}', proceeding without them.")
 
-    for index, patient in enumerate(input_json, start=1):
-        print(f"\nProcessing patient {index}...\n")
-
-        raw_report = patient.get("Report", "").strip()
-        audiometric_results = patient.get("Results", [])
-
-        if not raw_report and not audiometric_results:
-            print(f"Skipping patient {index}: No data found.")
-            continue
-
-        # Extract and categorize in a single step
-        diagnosis_results = categorize_diagnosis_with_lm(raw_report, audiometric_results, institution_template,
-                                                         valid_values, processing_guidelines)
-        if "Error" in diagnosis_results:
-            print(f"Skipping patient {index} due to categorization error: {diagnosis_results}")
-            continue
-
-        print("Diagnosis Categorization Results:\n", diagnosis_results)
-
-        # Extract JSON response
-        try:
-            match = re.search(r'```json\n(.*?)\n```', diagnosis_results, re.DOTALL)
-            if match:
-                diagnosis_json_str = match.group(1).strip()
-                diagnosis_json = json.loads(diagnosis_json_str)
-
-                # TODO
-                s3_client.put_object(
-                    Bucket=BUCKET_NAME,
-                    Key="<provider>_lab_output/<patient>",
-                    Body=diagnosis_json,
-                    ContentType='application/json'
-                )
-                print(f"Diagnosis results saved successfully to {output_file}")
-
-            else:
-                print(f"Error: Could not find valid JSON in LLM response for patient {index}.")
-
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON for patient {index}: {e}")
+    institution_prompt = get_classification_prompt(institution, institution_template, valid_values,
+                                                   processing_guidelines, config_etag)
+    # Create the client here; boto3 client creation is not thread-safe
+    get_client("bedrock-runtime")
+    if _startup["cold"] and _startup["setup_ms"] is None:
+        _startup["setup_ms"] = (time.perf_counter() - setup_started) * 1000
+
+    if input_json and isinstance(input_json[0], dict):
+        input_json = list(enumerate(input_json, start=1))
+    pending = deque(input_json)
+
+    def remaining_ms():
+        return context.get_remaining_time_in_millis() if context else float("inf")
+
+    def timed_classify(index, patient):
+        started = time.monotonic()
+        entry = classify_patient(institution_prompt, index, patient)
+        return (time.monotonic() - started) * 1000, entry
+
+    slowest_ms = 0.0
+    entries = []
+    in_flight = {}
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        while pending or in_flight:
+            _abandoned.difference_update([future for future in _abandoned if future.done()])
+            can_start = remaining_ms() > DEADLINE_MARGIN_MS + slowest_ms
+            while pending and len(in_flight) + len(_abandoned) < MAX_WORKERS and can_start:
+                index, patient = pending.popleft()
+                in_flight[executor.submit(timed_classify, index, patient)] = (index, patient)
+            if not in_flight and not (pending and _abandoned and can_start):
+                break
+
+            # With every slot held by abandoned calls, wait for one of them to finish
+            timeout = max(0.0, (remaining_ms() - DEADLINE_MARGIN_MS) / 1000) if context else None
+            done, _ = wait(list(in_flight) + list(_abandoned), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future not in in_flight:
+                    continue
+                index, _ = in_flight.pop(future)
+                try:
+                    elapsed_ms, entry = future.result()
+                    slowest_ms = max(slowest_ms, elapsed_ms)
+                except Exception as e:
+                    print(f"Error processing patient {index}: {e}")
+                    entry = {"index": index, "error": str(e)}
+                entries.append(entry)
+    finally:
+        # Threads still running are left behind; their patients go into the continuation
+        executor.shutdown(wait=False, cancel_futures=True)
+        _abandoned.update(in_flight)
+
+    unfinished = sorted(in_flight.values(), key=lambda item: item[0]) + list(pending)
+    if unfinished:
+        logger.warning("Deadline reached with %d of %d patients unfinished", len(unfinished), len(input_json))
+    return entries, unfinished
+
+
+def save_results(source_key, institution, entries):
+    """
+    Write all output entries for one input object as a single NDJSON object, ordered by patient index.
+
+    The first line is an index header mapping each patient index to the [offset, length] of its line,
+    with offsets counted from the first byte after the header line, so one patient can be read with a
+    ranged GET once the header line is known.
+    """
+    source_name = os.path.splitext(os.path.basename(source_key))[0]
+    output_key = f"{institution.lower()}_lab_output/{source_name}.ndjson"
+
+    lines = []
+    index = {}
+    offset = 0
+    for entry in sorted(entries, key=lambda e: e["index"]):
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        index[str(entry["index"])] = [offset, len(line)]
+        lines.append(line)
+        offset += len(line)
+    header = {"source_key": source_key, "institution": institution, "patients": len(lines), "index": index}
+
+    body = io.BytesIO()
+    body.write((json.dumps(header) + "\n").encode("utf-8"))
+    body.writelines(lines)
+    body.seek(0)
+
+    from boto3.s3.transfer import TransferConfig
+    get_client("s3").upload_fileobj(
+        body, BUCKET_NAME, output_key,
+        ExtraArgs={"ContentType": "application/x-ndjson"},
+        Config=TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_THRESHOLD)
+    )
+    print(f"Diagnosis results for {len(lines)} patients saved successfully to {output_key}")
+    return output_key
+
+
+def save_continuation(source_key, institution, unfinished, attempt, entries):
+    """
+    Write the unfinished patients to S3; the upload triggers the follow-up invocation.
+
+    Entries already finished are carried along, so the last invocation writes them all in one object.
+    """
+    source_name = os.path.splitext(os.path.basename(source_key))[0]
+    continuation_key = f"{CONTINUATION_PREFIX}{source_name}.{attempt}.json"
+    get_client("s3").put_object(
+        Bucket=BUCKET_NAME,
+        Key=continuation_key,
+        Body=json.dumps({
+            "source_key": source_key,
+            "institution": institution,
+            "attempt": attempt,
+            "patients": [{"index": index, "patient": patient} for index, patient in unfinished],
+            "results": entries
+        }),
+        ContentType='application/json'
+    )
+    logger.info("Saved %d unfinished patients to %s", len(unfinished), continuation_key)
+    return continuation_key
+
+
+def report_startup():
+    """
+    Log cold-start timings once per container as a CloudWatch embedded metric,
+    dimensioned by function version so cold-start latency can be compared across deploys.
+    """
+    _startup["cold"] = False
+    metrics = [{"Name": "InitDuration", "Unit": "Milliseconds"}]
+    if _startup["setup_ms"] is not None:
+        metrics.append({"Name": "ColdSetupDuration", "Unit": "Milliseconds"})
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": "AudiologyClassifier",
+                "Dimensions": [["FunctionVersion"]],
+                "Metrics": metrics
+            }]
+        },
+        "FunctionVersion": os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", "$LATEST"),
+        "InitDuration": round(_startup["init_ms"], 1),
+        "ColdSetupDuration": round(_startup["setup_ms"] or 0.0, 1)
+    }))
 
 
 def lambda_handler(event, context):
     # Log the received event
     logger.info("Received event: %s", json.dumps(event))
 
-    # Obtain Patient Record from S3
-    record = event.get("Records", [])
-    bucket = record["s3"]["bucket"]["name"]
-    key = record["s3"]["object"]["key"]
+    processed = []
+    for record in event.get("Records", []):
+        # Obtain Patient Record from S3
+        bucket = record["s3"]["bucket"]["name"]
+        key = unquote_plus(record["s3"]["object"]["key"])
 
-    resp = s3_client.get_object(Bucket=bucket, Key=key)
-    body = resp["Body"].read()
+        resp = get_client("s3").get_object(Bucket=bucket, Key=key)
+        body = resp["Body"].read()
+
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            return {
+                "statusCode": 500,
+                "body": json.dumps({
+                    "message": f"Error parsing record: {key}"
+                })
+            }
+
+        if key.startswith(CONTINUATION_PREFIX):
+            # Resume a file that an earlier invocation could not finish
+            source_key = data["source_key"]
+            institution = data["institution"]
+            attempt = data["attempt"]
+            patients = [(item["index"], item["patient"]) for item in data["patients"]]
+            entries = data.get("results", [])
+        else:
+            source_key = key
+            institution = "Redcap"  # TODO Change where the institution field comes from
+            attempt = 0
+            patients = data
+            entries = []
+
+        new_entries, unfinished = process_audiology_data(patients, institution, context)
+        entries += new_entries
+
+        if unfinished and attempt < MAX_CONTINUATIONS and not (attempt and len(unfinished) == len(patients)):
+            save_continuation(source_key, institution, unfinished, attempt + 1, entries)
+        else:
+            if unfinished:
+                logger.error("No progress on %s after %d continuations; %d patients left unprocessed",
+                             source_key, attempt, len(unfinished))
+                entries += [{"index": index, "error": "Not processed before the deadline"}
+                            for index, _ in unfinished]
+            if entries:
+                save_results(source_key, institution, entries)
+        processed.append({"key": key, "patients": len(patients), "unfinished": len(unfinished)})
+
+    if _startup["cold"]:
+        report_startup()
 
-    try:
-        data = json.loads(body)
-        process_audiology_data(data, "Redcap")  # TODO Change where the institution field comes from
-
-    except json.JSONDecodeError:
-        return {
-            "statusCode": 500,
-            "body": json.dumps({
-                "message": f"Error parsing record: {record}"
-            })
-        }
     response = {
         "statusCode": 200,
         "body": json.dumps({
-            "message": f"Successfully Processed patient record: {record}"
+            "message": f"Successfully Processed patient record: {processed}"
         })
     }
     return response
+
+
+_startup["init_ms"] = (time.perf_counter() - _INIT_STARTED) * 1000
@@ -0,0 +1,202 @@
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault("BUCKET_NAME", "audiology-test")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "lambda"))
+
+import audiology_mee1call as handler  # noqa: E402
+
+CONFIG = {"templates": {"Redcap": {"template": {"Hearing Type": ""}, "valid_values": {},
+                                   "processing_rules": {"rules": ["Use the worse ear."]}}}}
+
+
+class FakeContext:
+    """Lambda context whose remaining time runs down with the wall clock from ``remaining_ms``."""
+
+    def __init__(self, remaining_ms):
+        self.deadline = time.monotonic() + remaining_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+class SlowModel:
+    """Stands in for categorize_diagnosis_with_lm; patients named in ``blocked`` wait for ``release``."""
+
+    def __init__(self, seconds=0.0, blocked=()):
+        self.seconds = seconds
+        self.blocked = set(blocked)
+        self.release = threading.Event()
+        self.started = []
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, institution_prompt, report, results):
+        with self._lock:
+            self.started.append(report)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            if report in self.blocked:
+                self.release.wait(timeout=10)
+            time.sleep(self.seconds)
+            return f'```json\n{{"patient": "{report}"}}\n```'
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+def patients(*reports):
+    return [{"Report": report, "Results": []} for report in reports]
+
+
+@pytest.fixture
+def model(monkeypatch):
+    model = SlowModel()
+    monkeypatch.setattr(handler, "load_config", lambda: (CONFIG, "etag"))
+    monkeypatch.setattr(handler, "categorize_diagnosis_with_lm", model)
+    monkeypatch.setattr(handler, "_clients", {"bedrock-runtime": object()})
+    monkeypatch.setattr(handler, "MAX_WORKERS", 2)
+    monkeypatch.setattr(handler, "DEADLINE_MARGIN_MS", 100)
+    handler._abandoned.clear()
+    yield model
+    model.release.set()
+    for future in list(handler._abandoned):
+        future.result(timeout=10)
+    handler._abandoned.clear()
+
+
+def test_patients_running_or_queued_at_the_deadline_are_unfinished(model):
+    model.blocked = {"a", "b"}
+    entries, unfinished = handler.process_audiology_data(patients("a", "b", "c", "d"), "Redcap", FakeContext(300))
+
+    assert entries == []
+    assert [index for index, _ in unfinished] == [1, 2, 3, 4]
+    assert model.started == ["a", "b"]
+    assert len(handler._abandoned) == 2
+
+
+def test_no_patient_is_started_without_time_for_the_slowest_one_so_far(model, monkeypatch):
+    monkeypatch.setattr(handler, "MAX_WORKERS", 1)
+    model.seconds = 0.15
+    # 100 ms margin + 150 ms for the slowest patient leaves room for a second patient only
+    entries, unfinished = handler.process_audiology_data(patients("a", "b", "c"), "Redcap", FakeContext(500))
+
+    assert [entry["index"] for entry in entries] == [1, 2]
+    assert unfinished == [(3, patients("c")[0])]
+    assert not handler._abandoned
+
+
+def test_abandoned_calls_hold_their_slots_in_the_next_invocation(model):
+    model.blocked = {"a", "b"}
+    handler.process_audiology_data(patients("a", "b", "c"), "Redcap", FakeContext(300))
+    assert len(handler._abandoned) == 2
+
+    released = threading.Timer(0.2, model.release.set)
+    released.start()
+    started = time.monotonic()
+    entries, unfinished = handler.process_audiology_data([(3, patients("c")[0])], "Redcap", FakeContext(5000))
+
+    assert time.monotonic() - started >= 0.2
+    assert [entry["index"] for entry in entries] == [3]
+    assert unfinished == []
+    assert model.peak <= handler.MAX_WORKERS
+    assert not handler._abandoned
+
+
+def test_waiting_for_abandoned_slots_stops_at_the_deadline(model):
+    model.blocked = {"a", "b"}
+    handler.process_audiology_data(patients("a", "b"), "Redcap", FakeContext(300))
+
+    started = time.monotonic()
+    entries, unfinished = handler.process_audiology_data([(3, patients("c")[0])], "Redcap", FakeContext(400))
+
+    assert time.monotonic() - started < 1
+    assert entries == []
+    assert [index for index, _ in unfinished] == [3]
+    assert model.started == ["a", "b"]
+
+
+class RecordingS3:
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[Key] = Body.encode("utf-8") if isinstance(Body, str) else Body
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        self.objects[Key] = Fileobj.read()
+
+
+def s3_event(key):
+    return {"Records": [{"s3": {"bucket": {"name": "audiology-test"}, "object": {"key": key}}}]}
+
+
+def continuation(attempt, indexes):
+    return json.dumps({"source_key": "lab_data/file.json", "institution": "Redcap", "attempt": attempt,
+                       "patients": [{"index": index, "patient": {"Report": str(index)}} for index in indexes],
+                       "results": [{"index": 1, "result": {}}]}).encode("utf-8")
+
+
+@pytest.mark.parametrize("attempt,finished,expected", [
+    (0, 0, "continuation"),
+    (1, 1, "continuation"),
+    (1, 0, "results"),
+    (handler.MAX_CONTINUATIONS, 1, "results"),
+])
+def test_continuation_stops_when_a_resumed_attempt_makes_no_progress(monkeypatch, attempt, finished, expected):
+    key = f"{handler.CONTINUATION_PREFIX}file.{attempt}.json" if attempt else "lab_data/file.json"
+    body = continuation(attempt, [2, 3]) if attempt else json.dumps([{"Report": "2"}, {"Report": "3"}]).encode()
+    s3 = RecordingS3({key: body})
+    monkeypatch.setattr(handler, "_clients", {"s3": s3})
+
+    def process(patients, institution, context):
+        # The new file's patients are numbered 2 and 3 as well, so every case checks the same indexes
+        patients = list(enumerate(patients, start=2)) if isinstance(patients[0], dict) else patients
+        return [{"index": index, "result": {}} for index, _ in patients[:finished]], patients[finished:]
+
+    monkeypatch.setattr(handler, "process_audiology_data", process)
+    handler.lambda_handler(s3_event(key), FakeContext(5000))
+
+    [(written_key, written_body)] = [(k, v) for k, v in s3.objects.items() if k != key]
+    if expected == "continuation":
+        assert written_key == f"{handler.CONTINUATION_PREFIX}file.{attempt + 1}.json"
+        assert [item["index"] for item in json.loads(written_body)["patients"]] == [2, 3][finished:]
+    else:
+        assert written_key == "redcap_lab_output/file.ndjson"
+        lines = [json.loads(line) for line in written_body.decode("utf-8").splitlines()[1:]]
+        assert [entry["index"] for entry in lines] == [1, 2, 3]
+        assert [entry.get("error") for entry in lines if entry["index"] > 1 + finished] == [
+            "Not processed before the deadline"] * (2 - finished)
+
+
+def test_each_patient_is_read_back_by_its_index_entry(monkeypatch):
+    s3 = RecordingS3()
+    monkeypatch.setattr(handler, "_clients", {"s3": s3})
+    entries = [{"index": 10, "result": {"Reasoning": "Pérdida auditiva leve, oído izquierdo"}},
+               {"index": 2, "error": "No data found"},
+               {"index": 1, "result": {"Hearing Type": {"Left Ear": "Normal"}}}]
+
+    key = handler.save_results("lab_data/file.json", "Redcap", entries)
+
+    body = s3.objects[key]
+    header_line, _, _ = body.partition(b"\n")
+    header = json.loads(header_line)
+    records = body[len(header_line) + 1:]
+    assert header["patients"] == 3
+    assert list(header["index"]) == ["1", "2", "10"]
+    for entry in entries:
+        offset, length = header["index"][str(entry["index"])]
+        assert json.loads(records[offset:offset + length]) == entry
+        assert records[offset + length - 1:offset + length] == b"\n"
+    assert sum(length for _, length in header["index"].values()) == len(records)
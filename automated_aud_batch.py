@@ -1,14 +1,35 @@
+import argparse
+import codecs
+import functools
+import hashlib
+import io
 import json
 import os
+import sys
 import time
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import IO, Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Tuple
 import logging
 import boto3
 from botocore.exceptions import ClientError
 import re
 import csv
-import ast
+import sqlite3
+import heapq
+import itertools
+import math
+import random
+import tempfile
+import threading
+from collections import Counter
+from dataclasses import dataclass, field, replace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+try:
+    import numpy as np
+except ImportError:  # optional: only the audiogram pre-classifier needs it
+    np = None
 
 # Import your existing bedrock module
 # from bedrock import client, bedrock, llm_model_id, invoke_llm
@@ -17,15 +38,1492 @@ import ast
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-start_time = time.time()
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Bedrock batch inference limits: jobs need at least BATCH_MIN_RECORDS records, and each
+# input file may hold at most BATCH_MAX_RECORDS records / BATCH_MAX_BYTES bytes.
+# Record sets below the minimum are classified on-demand instead.
+BATCH_MIN_RECORDS = 100
+BATCH_MAX_RECORDS = 50000
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+PACKED_RECORD_PREFIX = "REC"
+
+# Batch job states (compared upper-cased) and polling cadence for the orchestrator
+TERMINAL_JOB_STATES = {"COMPLETED", "PARTIALLYCOMPLETED", "FAILED", "STOPPED", "EXPIRED"}
+SUCCESSFUL_JOB_STATES = {"COMPLETED", "PARTIALLYCOMPLETED"}
+POLL_MIN_INTERVAL = 15
+POLL_MAX_INTERVAL = 300
+JOB_MANIFEST_PATH = "batch_jobs_manifest.json"
+
+# Batch results: output parts are fetched with ranged GETs of this size, and the
+# ".jsonl.out" files Bedrock writes under "<output prefix><job id>/" are the records;
+# a successful job's download is tried on this many polls before the run gives up
+RESULT_RANGE_BYTES = 8 * 1024 * 1024
+RESULT_SUFFIX = ".jsonl.out"
+RESULT_DOWNLOAD_ATTEMPTS = 3
+
+# CSV conversion: rows held for reordering, and rows per out-of-order spill run
+CSV_REORDER_BUFFER_ROWS = 10000
+CSV_SPILL_ROWS = 10000
+# Field size limit when reading spilled runs back; the report column of a huge record exceeds csv's 128 KiB default
+CSV_FIELD_SIZE_LIMIT = 2 ** 31 - 1
+
+# Stable, reused service role for batch jobs; new roles get this long to propagate
+BATCH_ROLE_NAME = "pediatric-aud-batch"
+ROLE_PROPAGATION_TIMEOUT = 120
+
+# How long a successful bucket verification is trusted before it is repeated
+S3_VERIFY_TTL = 3600
+
+# Sidecar record manifests written next to each staged batch input; spooled in memory up to
+# SIDECAR_SPOOL_BYTES before spilling to a temporary file. Entries hold the full report and
+# results rather than offsets into the source export: the CSV columns and re-run prompts need
+# them verbatim, and the exports are JSON arrays that could only be read back record by record
+# with a ranged GET and a re-parse each
+SIDECAR_SUFFIX = ".records.jsonl"
+SIDECAR_SPOOL_BYTES = 8 * 1024 * 1024
+
+# Audiogram pre-classifier: pure-tone average frequencies (Hz) and how many must be present,
+# the ceiling of normal hearing, and report wording that always leaves a record to the model
+PTA_FREQUENCIES = (500, 1000, 2000, 4000)
+PTA_MIN_FREQUENCIES = 3
+NORMAL_HEARING_MAX_DB = 15
+PRECLASSIFY_REPORT_GUARD = re.compile(
+    r"neuropath|dys-?synchron|conductive|sensorineural|mixed|refer|fail|unable|could not|"
+    r"not tested|inconclusive|incomplete|effusion|fluid", re.IGNORECASE)
+
+# Appended to the prompt of a record whose first output was rejected by validation
+RERUN_PROMPT_NOTE = (
+    "\n**Note:** A previous classification of this record was rejected ({reason}). Return a single "
+    "JSON object that follows the template and uses only the listed valid values.\n"
+)
+# Validation problem of an output that was cut off at max_tokens; its re-run gets MODEL_MAX_OUTPUT_TOKENS
+TRUNCATED_OUTPUT_REASON = "output truncated at max_tokens"
+
+# Token budget: characters per token of the local estimate (see estimate_tokens), expected output
+# per reasoning field and per other field, headroom of max_tokens over the expected output, and the
+# limits of the model (Claude 3.5 Sonnet). DEFAULT_MAX_TOKENS applies to prompts without a profile.
+CHARS_PER_TOKEN = 3
+OUTPUT_REASONING_TOKENS = 600
+OUTPUT_FIELD_TOKENS = 16
+OUTPUT_HEADROOM = 2.0
+DEFAULT_MAX_TOKENS = 4096
+MODEL_MAX_OUTPUT_TOKENS = 8192
+MODEL_CONTEXT_TOKENS = 200000
+# Message framing around the prompt blocks, and the marker left where a report was cut
+PROMPT_OVERHEAD_TOKENS = 64
+# Shortest prefix the model will cache; a static prompt below it is billed in full on every request
+PROMPT_CACHE_MIN_TOKENS = 1024
+REPORT_TRIM_MARKER = "\n[... {omitted} characters of the report omitted to fit the model's context window ...]\n"
+
+# On-demand price in USD per million input/output tokens, for the pre-flight cost estimate;
+# batch inference is billed at BATCH_PRICE_FACTOR of it
+MODEL_PRICES = {"anthropic.claude-3-5-sonnet-20241022-v2:0": (3.00, 15.00)}
+BATCH_PRICE_FACTOR = 0.5
+
+# Persistent classification cache, keyed by record content, profile version and model
+RESULT_CACHE_PATH = "result_cache.sqlite3"
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Per-run metrics exports (see PipelineMetrics); the .prom file suits the node_exporter textfile collector
+RUN_SUMMARY_PATH = "run_summary_{run_id}.json"
+METRICS_PROM_PATH = "pipeline_metrics_{run_id}.prom"
+METRICS_NAMESPACE = "audiology_pipeline"
+
+# Opt-in stage profiler (--profile): sampling interval in seconds, and functions listed per stage
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP_N = 15
+# Interpreter switch interval while profiling, so the sampler is not starved by stage threads
+PROFILE_SWITCH_INTERVAL = 0.00005
+_JSON_DECODER = json.JSONDecoder()
+
+
+def iter_json_array(stream, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Yield the elements of a top-level JSON array one at a time from a binary stream.
+
+    Only the element being decoded (plus one read chunk) is held in memory, so peak
+    usage stays flat regardless of the size of the array. Works with any object that
+    exposes ``read(n)``, including botocore's StreamingBody.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill() -> bool:
+        nonlocal buf, pos, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            buf = buf[pos:] + decoder.decode(b"", final=True)
+        else:
+            buf = buf[pos:] + decoder.decode(chunk)
+        pos = 0
+        return not eof
+
+    def skip_whitespace(extra: str = "") -> bool:
+        """Advance past whitespace (and ``extra`` characters); False if input ran out."""
+        nonlocal pos
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] in extra):
+                pos += 1
+            if pos < len(buf):
+                return True
+            if eof or not fill():
+                return False
+
+    if not skip_whitespace("\ufeff"):
+        return
+    if buf[pos] != "[":
+        raise ValueError("Expected a top-level JSON array")
+    pos += 1
+    if not skip_whitespace():
+        raise ValueError("Unexpected end of input inside JSON array")
+    if buf[pos] == "]":
+        return
+
+    while True:
+        if not skip_whitespace():
+            raise ValueError("Unexpected end of input inside JSON array")
+        if buf[pos] in ",]":
+            raise ValueError(f"Expected an array element at {buf[pos]!r}")
+        try:
+            item, end = _JSON_DECODER.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        # An element is only complete once the "," or "]" after it has been read. A value cut
+        # at the end of a chunk may decode as a shorter one ("1." of "1.5"), so anything other
+        # than a separator directly after it means reading more and decoding it again.
+        separator = end
+        while separator < len(buf) and buf[separator].isspace():
+            separator += 1
+        if separator == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of input inside JSON array")
+            fill()
+            continue
+        if buf[separator] not in ",]":
+            if separator > end or eof:
+                raise ValueError(f"Expected ',' or ']' after array element, found {buf[separator]!r}")
+            fill()
+            continue
+        closed = buf[separator] == "]"
+        pos = separator + 1
+        yield item
+        if closed:
+            return
+
+
+class JsonlUploadStream(io.RawIOBase):
+    """
+    Read-only file object that serializes JSONL entries lazily as it is read.
+
+    Passed straight to ``upload_fileobj`` so batch inputs are staged to S3 without
+    building the whole file in memory or writing a temporary copy to disk. Entries are
+    dicts, or lines that are already serialized (bytes ending in a newline).
+    """
+
+    def __init__(self, entries: Iterator[dict]):
+        self._entries = entries
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            entry = next(self._entries, None)
+            if entry is None:
+                return 0
+            self._pending = entry if isinstance(entry, bytes) else (json.dumps(entry) + "\n").encode("utf-8")
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+@dataclass
+class BatchInputManifest:
+    """
+    What the generation stage produced for one source file, handed to dispatch.
+
+    The record metadata is kept in memory. The model inputs are written to a local temporary
+    file (``spool``) because shards can only be planned once every record's size is known.
+    The disk space this takes is traded for uploading each record to S3 only once.
+    """
+    source_key: str
+    # Batch input key; per-file manifests only name their sidecar after it, since their records
+    # are held in ``spool`` until pack_batch_inputs writes them into shards
+    s3_key: str
+    record_ids: List[str] = field(default_factory=list)
+    record_sizes: List[int] = field(default_factory=list)
+    # Patient prompt blocks are only retained while the file is small enough for on-demand processing
+    prompts: Optional[List[str]] = field(default_factory=list)
+    # Institution instructions shared by every record, sent ahead of each patient prompt
+    static_prompt: str = ""
+    # Sidecar with the report and results of every record, keyed by record ID
+    sidecar_key: Optional[str] = None
+    # Records answered from the result cache; they are in the sidecar but not in the batch input
+    cached_ids: List[str] = field(default_factory=list)
+    # Records classified from their thresholds alone; also only in the sidecar
+    preclassified_ids: List[str] = field(default_factory=list)
+    # Output token limit of every request, from the institution profile
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    # Estimated input tokens of the staged records (static and patient prompt of each)
+    input_tokens: int = 0
+    # Records whose prompt was compacted or trimmed to fit the token budget, and records that
+    # could not be made to fit; the latter are in the sidecar but never sent to the model
+    trimmed_ids: List[str] = field(default_factory=list)
+    over_budget_ids: List[str] = field(default_factory=list)
+    # Local temporary file with the serialized modelInput of each record in record_ids, one per line
+    spool: Optional[IO[bytes]] = None
+
+    @property
+    def record_count(self) -> int:
+        return len(self.record_ids)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.record_sizes)
+
+    def add_record(self, record_id: str, model_input: dict) -> None:
+        """Append a record's model input to the spool, creating it on first use."""
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+        line = json.dumps(model_input).encode("utf-8")
+        self.spool.write(line + b"\n")
+        self.record_ids.append(record_id)
+        # Size of the record's line in a batch input: {"recordId": "<id>", "modelInput": ...}
+        self.record_sizes.append(len(line) + len(record_id) + 33)
+
+    def close(self) -> None:
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+
+def render_static_prompt(template: dict, valid_values: dict, rules: list) -> str:
+    """
+    Render the institution-wide instructions of the prompt.
+
+    This block is identical for every patient and is sent first, ahead of the patient
+    block that varies, so on-demand calls can use it as a prompt-cache prefix. Bedrock
+    only caches prefixes of at least PROMPT_CACHE_MIN_TOKENS; shorter instructions
+    (Dawn's, for one) are sent and billed in full with every request.
+    """
+    return (
+        "You are an expert **pediatric** audiologist assistant responsible for extracting explicit hearing test data and classifying hearing loss with precision."
+        " Your classification must strictly follow given templates and clinical guidelines.\n\n"
+        "**Classification Template:**\n\n"
+        f"{json.dumps(template, indent=4)}\n\n"
+        "**Valid Values:**\n"
+        f"```json\n{json.dumps(valid_values, indent=4)}\n```\n\n"
+        "**Classification Guidelines (MUST FOLLOW):**\n"
+        f"```json\n{json.dumps(rules, indent=4)}\n```\n\n"
+        "**Processing Rules (MUST Follow):**\n"
+        "- **Use only explicitly provided threshold values**; do not infer missing values.\n"
+        "- **If multiple severities are listed, assign the most severe classification.**\n\n"
+        "**Output Requirements:**\n"
+        "- Fill in missing values using classification rules.\n"
+        "- Assign the correct 'Better Ear' based on hearing loss severity.\n"
+        "- Use only valid options listed above (strict validation).\n"
+        "- Provide **reasoning** for each classification decision.\n"
+        "- Cite **guidelines** used in decisions.\n"
+        "- Return classification in **EXACT JSON format** as per the template, with no modifications.\n"
+        "- Provide **precise reasoning** for each classification.\n"
+        "- Make sure there is a **detailed, thorough, chain of thought reasoning for each attribute's output** and how it came to that conclusion."
+        "- Reasoning must include thorough reasoning for the left ear, right ear, and risk factors"
+        "- **Cite guideline numbers** when making classification decisions.\n"
+        "- **DO NOT include any additional explanations, assumptions, or commentary.**\n"
+    )
+
+
+def map_header_to_path(header: str) -> Tuple[str, ...]:
+    """Resolve a CSV header from config.json to its key path inside the model's Attributes."""
+    if "Left Ear" in header:
+        return ("Hearing Type", "Left Ear", header.split('Left Ear ')[1])
+    elif "Right Ear" in header:
+        return ("Hearing Type", "Right Ear", header.split('Right Ear ')[1])
+    elif "Tier One" in header:
+        return ("Known Hearing Loss Risk Indicators", "Risk Factors", "Tier One")
+    elif "Tier Two" in header:
+        return ("Known Hearing Loss Risk Indicators", "Risk Factors", "Tier Two")
+    elif header == "Known Hearing Loss Risk":
+        return ("Known Hearing Loss Risk Indicators", "Known Hearing Loss Risk")
+    elif header == "Reasoning":
+        return ("Reasoning",)
+    return (header,)
+
+
+def _flatten_valid_values(valid_values: dict, prefix: Tuple[str, ...] = ()) -> Dict[Tuple[str, ...], FrozenSet[str]]:
+    """Flatten nested valid_values into {key path: frozenset of allowed values}."""
+    flat = {}
+    for key, value in valid_values.items():
+        if isinstance(value, dict):
+            flat.update(_flatten_valid_values(value, prefix + (key,)))
+        else:
+            flat[prefix + (key,)] = frozenset(value)
+    return flat
+
+
+def _column_valid_set(path: Tuple[str, ...], valid_value_sets: Dict[Tuple[str, ...], FrozenSet[str]]
+                      ) -> Optional[FrozenSet[str]]:
+    """
+    Find the valid values for a column's key path. Valid values are keyed by section and
+    field without the ear ("Hearing Type" > "Degree"), and some institutions name the field
+    a little differently from the column ("Degree" vs "Degree of Loss").
+    """
+    same_section = [key for key in valid_value_sets if key[0] == path[0]]
+    for key in same_section:
+        if key[-1] == path[-1]:
+            return valid_value_sets[key]
+    for key in same_section:
+        if key[-1].startswith(path[-1]):
+            return valid_value_sets[key]
+    return None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Local estimate of the model tokens in ``text``: one per CHARS_PER_TOKEN characters.
+
+    Indented JSON results come to about 3 characters per token and report prose to a little
+    more, so the estimate errs on the high side, which is the safe side for a budget.
+    """
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def estimate_output_tokens(template: dict, valid_value_sets: Dict[Tuple[str, ...], FrozenSet[str]]) -> int:
+    """
+    Expected size of a model output that fills in ``template``: the JSON structure, the longest
+    valid value of each restricted field (every value for list fields), OUTPUT_FIELD_TOKENS for
+    other fields and OUTPUT_REASONING_TOKENS for each reasoning field.
+    """
+    tokens = estimate_tokens(json.dumps(template, indent=4))
+
+    def walk(node: dict, path: Tuple[str, ...]) -> None:
+        nonlocal tokens
+        for key, value in node.items():
+            if isinstance(value, dict):
+                walk(value, path + (key,))
+                continue
+            allowed = _column_valid_set(path + (key,), valid_value_sets)
+            if key == "Reasoning":
+                tokens += OUTPUT_REASONING_TOKENS
+            elif not allowed:
+                tokens += OUTPUT_FIELD_TOKENS
+            elif isinstance(value, list):
+                tokens += sum(estimate_tokens(json.dumps(v)) + 1 for v in allowed)
+            else:
+                tokens += max(estimate_tokens(json.dumps(v)) for v in allowed)
+
+    walk(template.get("Attributes", template), ())
+    return tokens
+
+
+# Marks a column absent from a model output, as opposed to present but empty
+_MISSING = object()
+
+
+@dataclass(frozen=True)
+class InstitutionProfile:
+    """An institution's entry under ``templates`` in config.json, compiled once for reuse."""
+    name: str
+    template: dict
+    valid_values: dict
+    rules: Tuple[str, ...]
+    csv_headers: Tuple[str, ...]
+    # Key paths for the attribute columns, i.e. csv_headers[3:] (after ID, report, results)
+    header_paths: Tuple[Tuple[str, ...], ...]
+    valid_value_sets: Dict[Tuple[str, ...], FrozenSet[str]]
+    # Allowed values for each attribute column (parallel to header_paths), None if unrestricted
+    column_valid_sets: Tuple[Optional[FrozenSet[str]], ...]
+    static_prompt: str
+    # Hash of the institution's config entry; changes whenever any part of it changes
+    version: str
+    # Estimated tokens of the static prompt and of one output, and the output limit sent with each
+    # request: OUTPUT_HEADROOM over the expected output, unless the entry sets "max_tokens"
+    static_prompt_tokens: int = 0
+    expected_output_tokens: int = 0
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    # Key path -> value of each column for normal hearing in both ears, from the entry's optional
+    # "normal_hearing" map of CSV header -> value; these values are valid for their column
+    normal_hearing: Tuple[Tuple[Tuple[str, ...], str], ...] = ()
+
+    @classmethod
+    def compile(cls, name: str, data: dict) -> "InstitutionProfile":
+        template = data.get("template", {})
+        valid_values = data.get("valid_values", {})
+        rules = data.get("processing_rules", {}).get("rules", [])
+        csv_headers = tuple(data.get("csv_headers", []))
+        header_paths = tuple(map_header_to_path(header) for header in csv_headers[3:])
+        valid_value_sets = _flatten_valid_values(valid_values)
+        normal_hearing = data.get("normal_hearing", {})
+        allow_empty = data.get("allow_empty", [])
+        unknown = sorted((set(normal_hearing) | set(allow_empty)) - set(csv_headers[3:]))
+        if unknown:
+            raise ValueError(f"normal_hearing or allow_empty of '{name}' names columns not in csv_headers: "
+                             f"{', '.join(unknown)}")
+        extra_values = {header: {""} for header in allow_empty}
+        for header, value in normal_hearing.items():
+            extra_values.setdefault(header, set()).add(value)
+        column_valid_sets = tuple(
+            allowed | extra_values.get(header, set()) if allowed is not None else None
+            for header, allowed in zip(csv_headers[3:], (_column_valid_set(path, valid_value_sets)
+                                                         for path in header_paths)))
+        static_prompt = render_static_prompt(template, valid_values, rules)
+        expected_output_tokens = estimate_output_tokens(template, valid_value_sets)
+        max_tokens = data.get("max_tokens") or min(
+            MODEL_MAX_OUTPUT_TOKENS, -(-int(expected_output_tokens * OUTPUT_HEADROOM) // 256) * 256)
+        return cls(
+            name=name,
+            template=template,
+            valid_values=valid_values,
+            rules=tuple(rules),
+            csv_headers=csv_headers,
+            header_paths=header_paths,
+            valid_value_sets=valid_value_sets,
+            column_valid_sets=column_valid_sets,
+            static_prompt=static_prompt,
+            version=hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()[:16],
+            static_prompt_tokens=estimate_tokens(static_prompt),
+            expected_output_tokens=expected_output_tokens,
+            max_tokens=max_tokens,
+            normal_hearing=tuple((map_header_to_path(header), value) for header, value in normal_hearing.items())
+        )
+
+    def validate(self, attributes: dict) -> List[str]:
+        """
+        Return a description of every missing column and every attribute value outside the
+        institution's valid values. An empty value is only valid in the columns the entry
+        lists under "allow_empty" (or whose normal_hearing value is empty).
+        """
+        problems = []
+        for path, allowed in zip(self.header_paths, self.column_valid_sets):
+            value = attributes
+            for part in path:
+                value = value.get(part, _MISSING) if isinstance(value, dict) else _MISSING
+            if value is _MISSING:
+                problems.append(f"{' > '.join(path)}: missing")
+                continue
+            if allowed is None:
+                continue
+            values = value if isinstance(value, list) else [value]
+            invalid = [v for v in values if not isinstance(v, str) or v not in allowed]
+            if invalid:
+                problems.append(f"{' > '.join(path)}: {', '.join(str(v) or repr(v) for v in invalid)} "
+                                f"not in valid values")
+        return problems
+
+
+_DEGREE_BAND_RE = re.compile(
+    r"\(\s*(?:>\s*(?P<gt>\d+)|(?P<low>-?\d+)\s*-\s*(?P<high>-?\d+)|(?P<plus>\d+)\s*\+)\s*dB")
+# Result "Type" values and flag keys that mark a threshold entry as a no-response, and flag values that set it
+_NO_RESPONSE_RE = re.compile(r"^\s*(?:nr|no[\s_-]*response)\s*$", re.IGNORECASE)
+_FLAG_SET_VALUES = frozenset(("1", "true", "y", "yes"))
+_EARS = ("Left Ear", "Right Ear")
+
+
+def _parse_degree_band(value: str) -> Optional[Tuple[float, float]]:
+    """Return the inclusive dB range of a band label such as "Mild (26-40 dB HL)" or "Profound (>90 dB)"."""
+    match = _DEGREE_BAND_RE.search(value)
+    if not match:
+        return None
+    if match.group("gt"):
+        return float(match.group("gt")) + 1, float("inf")
+    if match.group("plus"):
+        return float(match.group("plus")), float("inf")
+    return float(match.group("low")), float(match.group("high"))
+
+
+@dataclass(frozen=True)
+class AudiogramPreclassifier:
+    """
+    Deterministic degree-of-loss classification from explicit air-conduction thresholds.
+
+    Results are parsed into a (left, right) x frequency threshold array and each ear's
+    pure-tone average over PTA_FREQUENCIES is mapped to the institution's numeric degree
+    bands. An ear counts as unambiguous only when enough PTA frequencies are present,
+    every one of its thresholds falls in the same band as its average, and none of its
+    air-conduction entries is a no-response or lacks a numeric level.
+
+    Normal hearing is only recognised for institutions whose config sets "normal_hearing",
+    so the values follow their own rules (CDC's degree '1', for one). When both ears are
+    unambiguously normal, the report does not match PRECLASSIFY_REPORT_GUARD and that map
+    covers every column (no risk indicators etc.), the record is answered without the
+    model. Otherwise unambiguous degrees are passed to the model as a hint in the patient
+    prompt.
+    """
+    # Sorted (low, high, label) bands, with a normal band up to NORMAL_HEARING_MAX_DB when the
+    # institution's normal_hearing map gives a degree
+    bands: Tuple[Tuple[float, float, str], ...]
+    # Header path -> value for a record with normal hearing in both ears, or None if the
+    # normal_hearing map does not cover every column
+    normal_columns: Optional[Tuple[Tuple[Tuple[str, ...], str], ...]]
+    header_paths: Tuple[Tuple[str, ...], ...]
+
+    @classmethod
+    def from_profile(cls, profile: InstitutionProfile) -> Optional["AudiogramPreclassifier"]:
+        """Build the pre-classifier for an institution, or None without numpy or numeric bands."""
+        if np is None:
+            logger.info("numpy is not installed; audiogram pre-classification is disabled")
+            return None
+        degree_values = next((values for path, values in profile.valid_value_sets.items()
+                              if "Degree" in path[-1]), frozenset())
+        # e.g. MassEyeAndEar gives no degree ('') for normal hearing
+        normal_degree = next((value for path, value in profile.normal_hearing if "Degree" in path[-1]), None)
+
+        bands = sorted((band[0], band[1], value) for value in degree_values
+                       for band in [_parse_degree_band(value)] if band)
+        if normal_degree is not None:
+            bands.insert(0, (float("-inf"), float(NORMAL_HEARING_MAX_DB), normal_degree))
+        if not bands:
+            return None
+
+        normal = dict(profile.normal_hearing)
+        attribute_paths = [path for path in profile.header_paths if path != ("Reasoning",)]
+        normal_columns = None
+        if normal_degree is not None and all(path in normal for path in attribute_paths):
+            normal_columns = tuple((path, normal[path]) for path in attribute_paths)
+        return cls(bands=tuple(bands), normal_columns=normal_columns, header_paths=profile.header_paths)
+
+    @staticmethod
+    def thresholds(results: Any) -> Tuple["np.ndarray", Tuple[int, ...], "np.ndarray"]:
+        """
+        Parse results into a (2, n) array of air-conduction thresholds (NaN where missing).
+
+        Rows are the left and right ear, columns the distinct frequencies (returned too);
+        repeated measurements keep the worst threshold. The third value flags, per ear,
+        air-conduction entries without a usable level: a no-response (by Type or flag key)
+        or a DB_HL or Frequency that is not a number ("NR", None...). Such an ear cannot be
+        classified from its thresholds, since the missing level may be its worst.
+        """
+        entries = []
+        unusable = np.zeros(2, dtype=bool)
+        for item in results if isinstance(results, list) else []:
+            if not isinstance(item, dict):
+                continue
+            result_type = str(item.get("Type", ""))
+            if result_type.upper() != "THRESHOLD" and not _NO_RESPONSE_RE.match(result_type):
+                continue
+            if "BONE" in str(item.get("TransducerType", "")).upper():
+                continue
+            side = str(item.get("Side", "")).upper()
+            if side not in ("LEFT", "RIGHT"):
+                continue
+            ear = 0 if side == "LEFT" else 1
+            no_response = _NO_RESPONSE_RE.match(result_type) or any(
+                _NO_RESPONSE_RE.match(str(key)) and str(value).strip().lower() in _FLAG_SET_VALUES
+                for key, value in item.items())
+            try:
+                frequency, level = float(item["Frequency"]), float(item["DB_HL"])
+            except (KeyError, TypeError, ValueError):
+                unusable[ear] = True
+                continue
+            if no_response or not math.isfinite(level) or not math.isfinite(frequency):
+                unusable[ear] = True
+                continue
+            entries.append((ear, frequency, level))
+        if not entries:
+            return np.full((2, 0), np.nan), (), unusable
+        ears, frequencies, levels = (np.asarray(column) for column in zip(*entries))
+        distinct, columns = np.unique(frequencies, return_inverse=True)
+        grid = np.full((2, len(distinct)), -np.inf)
+        np.maximum.at(grid, (ears.astype(int), columns), levels)
+        grid[np.isneginf(grid)] = np.nan
+        return grid, tuple(int(f) for f in distinct), unusable
+
+    def _band_index(self, levels: "np.ndarray") -> "np.ndarray":
+        """Index into ``self.bands`` for each level, -1 where a level falls between or outside bands."""
+        lows = np.array([band[0] for band in self.bands])
+        highs = np.array([band[1] for band in self.bands])
+        index = np.searchsorted(highs, levels, side="left")
+        index = np.minimum(index, len(self.bands) - 1)
+        valid = ~np.isnan(levels) & (levels >= lows[index]) & (levels <= highs[index])
+        return np.where(valid, index, -1)
+
+    def classify(self, report: str, results: Any) -> Tuple[Optional[str], str]:
+        """
+        Return (model output JSON for a full bypass or None, degree hint for the prompt).
+        """
+        grid, frequencies, unusable = self.thresholds(results)
+        if not frequencies:
+            return None, ""
+        pta_columns = [i for i, f in enumerate(frequencies) if f in PTA_FREQUENCIES]
+        pta_grid = grid[:, pta_columns]
+        counts = np.sum(~np.isnan(pta_grid), axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pta = np.rint(np.nansum(pta_grid, axis=1) / counts)
+        pta_band = self._band_index(pta)
+        threshold_bands = self._band_index(np.rint(grid))
+        agrees = np.all((threshold_bands == pta_band[:, None]) | np.isnan(grid), axis=1)
+        clear = (counts >= PTA_MIN_FREQUENCIES) & (pta_band >= 0) & agrees & ~unusable
+
+        degrees = {ear: self.bands[pta_band[i]][2] for i, ear in enumerate(_EARS) if clear[i]}
+        normal = self.bands[0][0] == float("-inf") and bool(np.all(clear & (pta_band == 0)))
+        if normal and self.normal_columns is not None and not PRECLASSIFY_REPORT_GUARD.search(report):
+            attributes = {}
+            for path, value in self.normal_columns:
+                node = attributes
+                for key in path[:-1]:
+                    node = node.setdefault(key, {})
+                node[path[-1]] = value
+            attributes["Reasoning"] = (
+                f"Deterministic pre-classification from air-conduction thresholds: pure-tone average "
+                f"{int(pta[0])} dB HL (Left Ear) and {int(pta[1])} dB HL (Right Ear), with every threshold "
+                f"at or below {NORMAL_HEARING_MAX_DB} dB HL; the report does not indicate a hearing loss type.")
+            return json.dumps({"Attributes": attributes}), ""
+
+        hint = "".join(f"{ear}: {degree} (pure-tone average {int(pta[i])} dB HL)\n"
+                       for i, ear in enumerate(_EARS) for degree in [degrees.get(ear)] if degree)
+        return None, hint
+
+
+_profile_cache: Dict[str, Tuple[int, Dict[str, InstitutionProfile]]] = {}
+_profile_cache_lock = threading.Lock()
+
+
+def load_institution_profiles(config_path: str = "config.json") -> Dict[str, InstitutionProfile]:
+    """
+    Return the compiled profiles for every institution in ``config_path``.
+
+    Profiles are compiled once per process and shared; the file is only re-read and
+    recompiled when its modification time changes.
+    """
+    path = os.path.abspath(config_path)
+    mtime = os.stat(path).st_mtime_ns
+    with _profile_cache_lock:
+        cached = _profile_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        profiles = {name: InstitutionProfile.compile(name, data) for name, data in config["templates"].items()}
+        _profile_cache[path] = (mtime, profiles)
+        logger.info(f"Compiled {len(profiles)} institution profiles from {config_path}")
+        return profiles
+
+
+def get_institution_profile(config_path: str, institution: str) -> InstitutionProfile:
+    """Return one institution's compiled profile, raising ValueError if it is not configured."""
+    profiles = load_institution_profiles(config_path)
+    if institution not in profiles:
+        raise ValueError(f"Institution '{institution}' not found in config")
+    return profiles[institution]
+
+
+_LENIENT_JSON_DECODER = json.JSONDecoder(strict=False)
+# Characters the repair scan must look at outside and inside strings; everything else is copied
+_STRUCTURAL_RE = re.compile(r'[{}\[\]"\'\\]|\b(?:True|False|None)\b')
+_STRING_SPECIAL_RE = re.compile(r'["\'\\\x00-\x1f]')
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_DOUBLE_ESCAPED_RE = re.compile(r'\{\s*\\"')
+_ONE_LEVEL_ESCAPE_RE = re.compile(r'\\(["\\/nrt])')
+_ONE_LEVEL_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'n': '\n', 'r': '\r', 't': '\t'}
+_CONTROL_ESCAPES = {'\n': '\\n', '\t': '\\t', '\r': '\\r'}
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+_MAX_JSON_CANDIDATES = 5
+
+
+def _repair_scan(text: str, start: int, repairs: set) -> str:
+    """
+    Single left-to-right pass from the ``{`` at ``start`` that rewrites common LLM JSON defects.
+
+    Escapes raw control characters and invalid backslashes inside strings, converts
+    single-quoted strings and Python literals, drops trailing commas, and closes a
+    truncated object. Stops at the brace that balances the opening one. Each applied
+    fix is added to ``repairs``. Runs of ordinary characters are located with a regex
+    search and copied as slices, so the pass stays linear and mostly runs at C speed.
+    """
+    if _DOUBLE_ESCAPED_RE.match(text, start):
+        text = _ONE_LEVEL_ESCAPE_RE.sub(lambda m: _ONE_LEVEL_ESCAPES[m.group(1)], text[start:])
+        start = 0
+        repairs.add("double_escaped")
+
+    out = []
+    stack = []
+    in_string = False
+    quote = '"'
+    i, n = start, len(text)
+
+    def drop_trailing_comma():
+        j = len(out) - 1
+        while j >= 0 and not out[j].strip():
+            j -= 1
+        if j >= 0 and out[j].rstrip().endswith(","):
+            stripped = out[j].rstrip()
+            out[j] = stripped[:-1] + out[j][len(stripped):]
+            repairs.add("trailing_commas")
+
+    while i < n:
+        # Copy plain runs in one slice and only step through the interesting characters
+        match = (_STRING_SPECIAL_RE if in_string else _STRUCTURAL_RE).search(text, i)
+        if not match:
+            out.append(text[i:])
+            break
+        if match.start() > i:
+            out.append(text[i:match.start()])
+        i = match.start()
+        c = text[i]
+
+        if in_string:
+            if c == "\\":
+                nxt = text[i + 1:i + 2]
+                if nxt and nxt in '"\\/bfnrt':
+                    out.append(c + nxt)
+                    i += 2
+                elif nxt == "u" and len(text) >= i + 6 and all(h in _HEX_DIGITS for h in text[i + 2:i + 6]):
+                    out.append(text[i:i + 6])
+                    i += 6
+                elif nxt == "'" and quote == "'":
+                    out.append("'")
+                    i += 2
+                else:
+                    out.append("\\\\")
+                    repairs.add("invalid_escapes")
+                    i += 1
+                continue
+            if c == quote:
+                out.append('"')
+                in_string = False
+            elif c == '"':
+                out.append('\\"')
+            elif c == "'":
+                out.append(c)
+            else:
+                out.append(_CONTROL_ESCAPES.get(c, ""))
+                repairs.add("control_chars")
+            i += 1
+            continue
+
+        if c == '"' or c == "'":
+            in_string, quote = True, c
+            out.append('"')
+            if c == "'":
+                repairs.add("single_quotes")
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+            out.append(c)
+        elif c in "}]":
+            drop_trailing_comma()
+            if stack:
+                stack.pop()
+            out.append(c)
+            if not stack:
+                break
+        elif c == "\\":
+            repairs.add("stray_backslashes")
+        else:
+            word = match.group()
+            out.append(_PY_LITERALS[word])
+            repairs.add("python_literals")
+            i += len(word)
+            continue
+        i += 1
+
+    if in_string or stack:
+        if in_string:
+            out.append('"')
+        drop_trailing_comma()
+        out.extend(reversed(stack))
+        repairs.add("truncated")
+    return "".join(out)
+
+
+def extract_json(text: str) -> Tuple[dict, Tuple[str, ...]]:
+    """
+    Extract the first JSON object from LLM output in linear time.
+
+    A ```json fence is preferred when present. Each ``{`` (up to _MAX_JSON_CANDIDATES,
+    to skip braces in preceding prose) is first decoded in place with ``raw_decode``,
+    which stops at the end of the object, and is otherwise rewritten by ``_repair_scan``.
+    At most one candidate (an unbalanced one) is repaired through to the end of the
+    text; later candidates only get the direct decode, keeping extraction linear.
+
+    Returns:
+        The parsed object and the names of the repairs that were needed (empty if none).
+
+    Raises:
+        ValueError: if no candidate parses to a JSON object.
+    """
+    fence = text.find("```json")
+    start = text.find("{", fence if fence >= 0 else 0)
+    if start < 0 and fence >= 0:
+        start = text.find("{")
+    if start < 0:
+        raise ValueError("JSON decode failed: No JSON block found in model output.")
+
+    starts = []
+    while start >= 0 and len(starts) < _MAX_JSON_CANDIDATES:
+        starts.append(start)
+        start = text.find("{", start + 1)
+
+    error = None
+    scanned_to_end = False
+    for start in starts:
+        for decoder, repairs in ((_JSON_DECODER, ()), (_LENIENT_JSON_DECODER, ("control_chars",))):
+            try:
+                parsed = decoder.raw_decode(text, start)[0]
+                if isinstance(parsed, dict):
+                    return parsed, repairs
+            except json.JSONDecodeError as e:
+                error = e
+        if scanned_to_end:
+            continue
+
+        applied = set()
+        try:
+            parsed = json.loads(_repair_scan(text, start, applied), strict=False)
+            if isinstance(parsed, dict):
+                return parsed, tuple(sorted(applied))
+        except json.JSONDecodeError as e:
+            error = e
+        scanned_to_end = "truncated" in applied
+    raise ValueError(f"JSON decode failed: {error}")
+
+
+_RECORD_INDEX_RE = re.compile(r"PAT(\d+)")
+
+
+def _row_sort_key(row: List[str]) -> Tuple[float, str]:
+    """Order CSV rows by the patient index in their record ID; unnumbered IDs sort last."""
+    match = _RECORD_INDEX_RE.search(row[0])
+    return (int(match.group(1)) if match else float('inf'), row[0])
+
+
+def _reorder(items: Iterator[Any], key, buffer_size: int) -> Iterator[Any]:
+    """Yield ``items`` sorted by ``key`` as far as a heap of ``buffer_size`` entries allows."""
+    heap = []
+    for seq, item in enumerate(items):
+        heapq.heappush(heap, (key(item), seq, item))
+        if len(heap) > buffer_size:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class SortedCsvWriter:
+    """
+    Write CSV rows ordered by record index without holding the whole file in memory.
+
+    Rows pass through a bounded reorder buffer and are streamed to ``<path>.part``.
+    Rows that arrive later than the buffer can absorb are spilled to sorted run files
+    and merged in on ``close()`` (an external merge sort); if none arrive, the part
+    file is simply renamed into place.
+
+    With ``merge_existing`` a CSV already at ``path`` is kept as one more sorted run, and
+    where a record ID appears in both, the newly written row replaces the existing one.
+
+    A writer that is not closed must be aborted, which removes its part and run files and
+    puts back a CSV set aside for merging.
+    """
+
+    def __init__(self, path: str, headers: Tuple[str, ...], buffer_size: int = CSV_REORDER_BUFFER_ROWS,
+                 merge_existing: bool = False):
+        self.path = path
+        self.headers = headers
+        self.buffer_size = buffer_size
+        self._part_path = f"{path}.part"
+        self._handle = None
+        self._writer = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._last_key = None
+        self._late = []
+        self._runs = []
+        self._existing_path = None
+        self.rows_written = 0
+        if merge_existing and os.path.exists(path):
+            self._existing_path = f"{path}.prev"
+            os.replace(path, self._existing_path)
+        with open(self._part_path, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow(headers)
+
+    def add(self, row: List[str]) -> None:
+        heapq.heappush(self._heap, (_row_sort_key(row), next(self._seq), row))
+        if len(self._heap) > self.buffer_size:
+            key, _, row = heapq.heappop(self._heap)
+            self._emit(key, row)
+
+    def release(self) -> None:
+        """Close the underlying file handle; it is reopened on the next write."""
+        if self._handle:
+            self._handle.close()
+            self._handle = self._writer = None
+
+    def close(self) -> None:
+        while self._heap:
+            key, _, row = heapq.heappop(self._heap)
+            self._emit(key, row)
+        self.release()
+        if self._late:
+            self._spill()
+        if not self._runs and not self._existing_path:
+            os.replace(self._part_path, self.path)
+            return
+
+        runs = [self._part_path] + self._runs
+        existing = [self._existing_path] if self._existing_path else []
+        logger.info(f"Merging {len(self._runs)} out-of-order runs{' and the existing CSV' if existing else ''} "
+                    f"into {self.path}")
+        csv.field_size_limit(max(csv.field_size_limit(), CSV_FIELD_SIZE_LIMIT))
+        merged_path = f"{self.path}.merge"
+        files = []
+        try:
+            files.extend(open(run, "r", newline="", encoding="utf-8") for run in existing + runs)
+            readers = [csv.reader(f) for f in files]
+            for f, reader in zip(files, readers):
+                if f.name in existing or f.name == self._part_path:
+                    next(reader, None)  # header
+            # Rank existing rows before new ones so that, for a duplicated record ID, the new row is last
+            ranked = [zip(itertools.repeat(rank), reader)
+                      for rank, reader in zip([0] * len(existing) + [1] * len(runs), readers)]
+            merged = heapq.merge(*ranked, key=lambda item: (_row_sort_key(item[1]), item[0]))
+            with open(merged_path, "w", newline="", encoding="utf-8") as out:
+                writer = csv.writer(out)
+                writer.writerow(self.headers)
+                self.rows_written = 0
+                for _, group in itertools.groupby(merged, key=lambda item: item[1][0]):
+                    *_, (_, row) = group
+                    writer.writerow(row)
+                    self.rows_written += 1
+        except BaseException:
+            _remove_quietly(merged_path)
+            raise
+        finally:
+            for f in files:
+                f.close()
+        os.replace(merged_path, self.path)
+        for run in existing + runs:
+            os.remove(run)
+        self._existing_path = None
+        self._runs = []
+
+    def abort(self) -> None:
+        """Discard the rows written so far; a CSV set aside by ``merge_existing`` is put back."""
+        self.release()
+        self._heap, self._late = [], []
+        for run in [self._part_path] + self._runs:
+            _remove_quietly(run)
+        self._runs = []
+        if self._existing_path:
+            os.replace(self._existing_path, self.path)
+            self._existing_path = None
+
+    def _emit(self, key: Tuple[float, str], row: List[str]) -> None:
+        if self._last_key is not None and key < self._last_key:
+            self._late.append(row)
+            if len(self._late) >= CSV_SPILL_ROWS:
+                self._spill()
+            return
+        if not self._handle:
+            self._handle = open(self._part_path, "a", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._handle)
+        self._writer.writerow(row)
+        self._last_key = key
+        self.rows_written += 1
+
+    def _spill(self) -> None:
+        fd, run_path = tempfile.mkstemp(suffix=".csvrun", dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(sorted(self._late, key=_row_sort_key))
+        self.rows_written += len(self._late)
+        self._runs.append(run_path)
+        self._late = []
+
+
+def record_digest(report: str, results: Any) -> str:
+    """SHA-256 over a patient's whitespace-normalized report and canonically serialized results."""
+    normalized = " ".join(report.split())
+    canonical = json.dumps(results, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{normalized}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+class RecordSidecar:
+    """
+    Index over a local sidecar record manifest (one JSON line per staged record).
+
+    Only the byte offset of each record's line is held in memory; its report and results
+    are read back with a single seek when the CSV row is built, so the CSV stage never
+    has to look at prompt text.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._handle = open(path, "rb")
+        self._offsets = {}
+        offset = 0
+        for line in self._handle:
+            if line.strip():
+                self._offsets[json.loads(line)["recordId"]] = offset
+            offset += len(line)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __iter__(self) -> Iterator[str]:
+        """Record IDs in file order."""
+        return iter(self._offsets)
+
+    def get(self, record_id: str) -> Optional[dict]:
+        offset = self._offsets.get(record_id)
+        if offset is None:
+            return None
+        self._handle.seek(offset)
+        return json.loads(self._handle.readline())
+
+    @staticmethod
+    def columns(entry: Optional[dict]) -> Tuple[str, str]:
+        """Return the (report, results) CSV columns of a sidecar entry, "NULL" when unknown."""
+        if entry is None:
+            return "NULL", "NULL"
+        return entry["report"] or "NULL", json.dumps(entry["results"], indent=4)
+
+    def close(self) -> None:
+        self._handle.close()
+
+
+class ResultCache:
+    """
+    Content-addressed store of model outputs, so unchanged patients are never classified twice.
+
+    Keys hash a record's digest (normalized report and results) together with the
+    institution profile version and model ID, so editing the template or switching models
+    invalidates old entries naturally. Entries live in a local SQLite file that is trimmed
+    to ``max_bytes`` by least recent use; with ``s3_bucket`` set they are also written to
+    ``s3://<s3_bucket>/<s3_prefix>`` and local misses fall back to it.
+    """
+
+    def __init__(self, path: str = RESULT_CACHE_PATH, max_bytes: int = RESULT_CACHE_MAX_BYTES,
+                 s3_client=None, s3_bucket: Optional[str] = None, s3_prefix: str = "result-cache/"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "key TEXT PRIMARY KEY, output TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def key(digest: str, profile_version: str, model_id: str) -> str:
+        return hashlib.sha256(f"{digest}|{profile_version}|{model_id}".encode("utf-8")).hexdigest()
+
+    def _s3_key(self, key: str) -> str:
+        return f"{self.s3_prefix}{key[:2]}/{key}.json"
+
+    def contains(self, key: str) -> bool:
+        """Whether ``key`` is cached locally or in the S3 tier, without fetching the output."""
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone():
+                return True
+        if not self.s3_bucket:
+            return False
+        try:
+            self.s3_client.head_object(Bucket=self.s3_bucket, Key=self._s3_key(key))
+            return True
+        except ClientError:
+            return False
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT output FROM results WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+                self.hits += 1
+                return row[0]
+        if self.s3_bucket:
+            try:
+                body = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self._s3_key(key))["Body"]
+                output = body.read().decode("utf-8")
+                self._store(key, output)
+                self.hits += 1
+                return output
+            except ClientError:
+                pass
+        self.misses += 1
+        return None
+
+    def put(self, key: str, output: str) -> None:
+        self._store(key, output)
+        if self.s3_bucket:
+            try:
+                self.s3_client.put_object(Bucket=self.s3_bucket, Key=self._s3_key(key),
+                                          Body=output.encode("utf-8"), ContentType="application/json")
+            except ClientError as e:
+                logger.warning(f"Could not write result cache entry {key} to S3: {e}")
+
+    def _store(self, key: str, output: str) -> None:
+        size = len(output.encode("utf-8"))
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO results (key, output, size, last_used) VALUES (?, ?, ?, ?)",
+                             (key, output, size, time.time()))
+            self._size += size - (previous[0] if previous else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the cache is back under 90% of ``max_bytes``."""
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for key, size in self._db.execute("SELECT key, size FROM results ORDER BY last_used").fetchall():
+            if self._size <= target:
+                break
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._size -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} entries from result cache {self.path}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+_METRIC_HELP = {
+    "records": "Records handled, by stage.",
+    "bytes": "Bytes uploaded to and downloaded from S3.",
+    "parse_failures": "Result lines or model outputs that could not be parsed.",
+    "validation_failures": "Model outputs with values outside the institution's valid values.",
+    "json_repairs": "Repairs extract_json applied to model outputs, by kind.",
+    "tokens": "Model tokens reported in responses, by type.",
+    "throttle_retries": "On-demand calls retried after throttling.",
+    "jobs": "Batch jobs that reached a terminal state, by status.",
+    "prompt_fits": "Patient prompts changed or left out to fit the token budget, by action.",
+    "failed_files": "Input files that could not be turned into prompts.",
+    "truncated_outputs": "Model outputs cut off at max_tokens, which are re-run with the model's output limit.",
+}
+
+
+def _prometheus_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class PipelineMetrics:
+    """
+    Stage timers and counters for one pipeline run, shared by all worker threads.
+
+    Stage times are summed across threads, so a stage run by a pool can exceed wall-clock
+    time. Counters are keyed by name and optional labels. ``info`` holds run attributes
+    (run ID, institution...) that label the exports.
+    """
+
+    def __init__(self, **info: Any):
+        self.info: Dict[str, Any] = dict(info)
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.stage_seconds: Dict[str, float] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started)
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def count_usage(self, usage: Optional[dict]) -> None:
+        """Add the token counts of a model response (Anthropic or Nova usage keys), with prompt-cache reads and writes."""
+        for kind, keys in (("input", ("input_tokens", "inputTokens")), ("output", ("output_tokens", "outputTokens")),
+                           ("cache_read", ("cache_read_input_tokens", "cacheReadInputTokens")),
+                           ("cache_write", ("cache_creation_input_tokens", "cacheWriteInputTokens"))):
+            value = next((usage[key] for key in keys if key in usage), None) if usage else None
+            if isinstance(value, (int, float)):
+                self.count("tokens", value, type=kind)
+
+    def summary(self) -> dict:
+        with self._lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels) or "total"] = value
+            return {
+                **self.info,
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+                "wall_seconds": round(time.monotonic() - self._started, 3),
+                "stage_seconds": {stage: round(seconds, 3) for stage, seconds in self.stage_seconds.items()},
+                "counters": counters
+            }
+
+    def prometheus_text(self) -> str:
+        """The metrics in Prometheus text exposition format, labelled with the run ID and institution."""
+        run_labels = {key: str(self.info[key]) for key in ("run_id", "institution") if self.info.get(key)}
+        with self._lock:
+            lines = [
+                f"# HELP {METRICS_NAMESPACE}_wall_seconds Wall-clock duration of the run.",
+                f"# TYPE {METRICS_NAMESPACE}_wall_seconds gauge",
+                f"{METRICS_NAMESPACE}_wall_seconds{_prometheus_labels(run_labels)} "
+                f"{time.monotonic() - self._started:.3f}",
+                f"# HELP {METRICS_NAMESPACE}_stage_seconds Time spent per stage, summed across worker threads.",
+                f"# TYPE {METRICS_NAMESPACE}_stage_seconds gauge",
+            ]
+            lines += [f"{METRICS_NAMESPACE}_stage_seconds{_prometheus_labels({**run_labels, 'stage': stage})} "
+                      f"{seconds:.3f}" for stage, seconds in sorted(self.stage_seconds.items())]
+            for name in sorted({name for name, _ in self.counters}):
+                metric = f"{METRICS_NAMESPACE}_{name}_total"
+                lines += [f"# HELP {metric} {_METRIC_HELP.get(name, name)}", f"# TYPE {metric} counter"]
+                lines += [f"{metric}{_prometheus_labels({**run_labels, **dict(labels)})} {value:.15g}"
+                          for (counter, labels), value in sorted(self.counters.items()) if counter == name]
+        return "\n".join(lines) + "\n"
+
+    def export(self, summary_path: str, prometheus_path: str) -> dict:
+        """Atomically write the run summary JSON and the Prometheus text file; returns the summary."""
+        summary = self.summary()
+        for path, text in ((summary_path, json.dumps(summary, indent=2)), (prometheus_path, self.prometheus_text())):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        return summary
+
+
+def _timed_stage(stage: str):
+    """Decorator adding a BedrockBatch method's duration to ``self.metrics`` under ``stage``."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class _StagedReader:
+    """File object proxy whose reads run in the profiler stages of the thread that started the upload."""
+
+    def __init__(self, fileobj: Any, profiler: "StageProfiler", stages: List[str]):
+        self._fileobj = fileobj
+        self._profiler = profiler
+        self._stages = stages
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._fileobj, name)
+
+    def read(self, *args) -> bytes:
+        with self._profiler._in_stages(self._stages):
+            return self._fileobj.read(*args)
+
+    def readinto(self, buffer) -> int:
+        with self._profiler._in_stages(self._stages):
+            return self._fileobj.readinto(buffer)
+
+
+class StageProfiler:
+    """
+    Opt-in sampling profiler that attributes samples to the BedrockBatch stage each thread is in.
+
+    ``instrument`` wraps the stage methods of one BedrockBatch instance (the class is untouched,
+    so there is no cost when profiling is off). A background thread then samples the stacks of
+    every thread inside a stage each ``interval`` seconds; a sample counts towards every stage
+    on that thread, so nested stages (``extract_and_clean_json`` within ``_build_csv_row``
+    within ``jsonl_to_csv``) each get their own, inclusive profile. Sampling rather than
+    cProfile is used because cProfile only sees the thread that enabled it (prompt generation
+    runs on worker threads) and cannot nest one profiler per stage. The sampler only runs when
+    it gets the GIL, so the interpreter switch interval is lowered while profiling; otherwise
+    samples cluster at the points where stage threads release the GIL for I/O and CPU-bound
+    code such as JSON extraction is never seen. The switch interval is process-wide, so every
+    thread runs slower while profiling. Stage times in ``report`` are thread-seconds, so stages
+    run on worker threads can exceed the wall time.
+
+    Work handed to another thread stays in its stage where it can be followed: the batch's
+    ``upload_fileobj`` is wrapped too, so reads of an upload's file object (which drive any
+    generator behind it) count towards the caller's stages on whichever thread s3transfer
+    makes them.
+
+    Each stage is written as a collapsed-stack file (``profile_<stage>.collapsed``, one
+    ``frame;frame;... count`` line per distinct stack) for flamegraph.pl or speedscope.
+    """
+    STAGES = {
+        "prompt_generation": ("_generate_jsonl_for_file",),
+        "jsonl_to_csv": ("jsonl_to_csv", "packed_jsonl_to_csvs"),
+        "build_csv_row": ("_build_csv_row",),
+        "extract_and_clean_json": ("extract_and_clean_json",),
+    }
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        # Thread ident -> stages it is currently in (innermost last)
+        self._active: Dict[int, List[str]] = {}
+        self.stacks: Dict[str, Counter] = {stage: Counter() for stage in self.STAGES}
+        # Time covered by each stage's samples, summed over its threads
+        self.seconds: Dict[str, float] = {stage: 0.0 for stage in self.STAGES}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._switch_interval: Optional[float] = None
+        self._wrapper_code = None
+
+    def instrument(self, batch: "BedrockBatch") -> None:
+        for stage, methods in self.STAGES.items():
+            for name in methods:
+                setattr(batch, name, self._wrap(stage, getattr(batch, name)))
+        batch.s3_client.upload_fileobj = self._wrap_upload(batch.s3_client.upload_fileobj)
+
+    @contextmanager
+    def _in_stages(self, stages: List[str]) -> Iterator[None]:
+        active = self._active.setdefault(threading.get_ident(), [])
+        active.extend(stages)
+        try:
+            yield
+        finally:
+            del active[len(active) - len(stages):]
+
+    def _wrap(self, stage: str, method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with self._in_stages([stage]):
+                return method(*args, **kwargs)
+        self._wrapper_code = wrapper.__code__
+        return wrapper
+
+    def _wrap_upload(self, upload_fileobj: Callable) -> Callable:
+        @functools.wraps(upload_fileobj)
+        def wrapper(Fileobj, *args, **kwargs):
+            stages = list(self._active.get(threading.get_ident(), ()))
+            if stages:
+                Fileobj = _StagedReader(Fileobj, self, stages)
+            return upload_fileobj(Fileobj, *args, **kwargs)
+        return wrapper
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch_interval, PROFILE_SWITCH_INTERVAL))
+        self._thread = threading.Thread(target=self._sample, name="stage-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._switch_interval is not None:
+            sys.setswitchinterval(self._switch_interval)
+            self._switch_interval = None
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self) -> None:
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            frames = sys._current_frames()
+            for ident, stages in list(self._active.items()):
+                frame = frames.get(ident)
+                if not stages or frame is None:
+                    continue
+                labels = []
+                while frame is not None:
+                    if frame.f_code is not self._wrapper_code:
+                        labels.append(self._frame_label(frame))
+                    frame = frame.f_back
+                stack = ";".join(reversed(labels))
+                for stage in set(stages):
+                    self.stacks[stage][stack] += 1
+                    self.seconds[stage] += elapsed
+
+    def write(self, output_dir: str = ".") -> List[str]:
+        """Write one collapsed-stack file per stage that was sampled; returns their paths."""
+        paths = []
+        for stage, stacks in self.stacks.items():
+            if not stacks:
+                continue
+            path = os.path.join(output_dir, f"profile_{stage}.collapsed")
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            paths.append(path)
+        return paths
+
+    def report(self, top: int = PROFILE_TOP_N) -> str:
+        """The ``top`` functions of each stage by self samples, with their inclusive share."""
+        lines = []
+        for stage, stacks in self.stacks.items():
+            total = sum(stacks.values())
+            if not total:
+                continue
+            own, inclusive = Counter(), Counter()
+            for stack, count in stacks.items():
+                frames = stack.split(";")
+                own[frames[-1]] += count
+                for frame in set(frames):
+                    inclusive[frame] += count
+            lines.append(f"{stage}: {total} samples (~{self.seconds[stage]:.2f}s)")
+            lines.append(f"  {'self%':>6} {'total%':>7}  function")
+            for frame, count in own.most_common(top):
+                lines.append(f"  {100 * count / total:>6.1f} {100 * inclusive[frame] / total:>7.1f}  {frame}")
+        return "\n".join(lines)
+
 
 class BedrockBatch:
     """Batch processing for AWS Bedrock using existing credentials."""
 
     
-    def __init__(self, region='us-west-2'):
+    def __init__(self, region='us-west-2', max_concurrent_requests: int = 8, max_ingest_workers: int = 16,
+                 prompt_caching: bool = True, max_download_workers: int = 8,
+                 result_cache: Optional[ResultCache] = None):
         """Initialize using the profile credentials."""
         self.region = region
+
+        # On-demand concurrency and throttling backoff settings
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_throttle_retries = 6
+        self.throttle_base_delay = 1.0
+        self.throttle_max_delay = 30.0
+        self.max_ingest_workers = max_ingest_workers
+        self.max_download_workers = max_download_workers
+
+        # Mark the static institution prompt as a Bedrock prompt-cache prefix on on-demand calls
+        self.prompt_caching = prompt_caching
+
+        # Previously classified records are served from here instead of being sent to Bedrock
+        self.result_cache = result_cache
+
+        # Stage timers and counters; process_batch_inference starts a fresh set per run
+        self.metrics = PipelineMetrics()
+
+        # Batch service role ARNs by bucket, and roles that may still be propagating
+        self._role_arns = {}
+        self._unpropagated_roles = set()
+
+        # Successful S3 verifications by (bucket, operation) -> expiry on the monotonic clock
+        self._s3_verified = {}
+        self._s3_verify_lock = threading.RLock()
     
         # Create a session using the specified profile
         session = boto3.Session(region_name=region)
@@ -42,6 +1540,8 @@ class BedrockBatch:
         
         # Use the model ID from your bedrock module
         self.llm_model_id = "anthropic.claude-3-5-sonnet-20241022-v2:0"
+        # Context window of the model, which bounds every prompt plus its max_tokens
+        self.context_tokens = MODEL_CONTEXT_TOKENS
         
         logger.info("BedrockBatch initialized successfully")
     
@@ -86,11 +1586,31 @@ class BedrockBatch:
                 logger.error(f"Error checking bucket: {e}")
                 return False
 
+    def _cached_check(self, bucket_name: str, operation: str, check) -> bool:
+        """
+        Run ``check()`` at most once per (bucket, operation) every S3_VERIFY_TTL seconds.
+
+        Only successes are cached, so a failing bucket is re-checked (and fails the same
+        way) on the next call. The (re-entrant) lock makes concurrent uploaders share one check.
+        """
+        key = (bucket_name, operation)
+        with self._s3_verify_lock:
+            expires_at = self._s3_verified.get(key)
+            if expires_at and expires_at > time.monotonic():
+                return True
+            ok = check()
+            if ok:
+                self._s3_verified[key] = time.monotonic() + S3_VERIFY_TTL
+            return ok
+
     def verify_s3_permissions(self, bucket_name: str) -> bool:
-        """Verify S3 permissions for batch processing."""
+        """Verify S3 permissions for batch processing (memoized per bucket, see _cached_check)."""
+        return self._cached_check(bucket_name, "read_write", lambda: self._check_s3_permissions(bucket_name))
+
+    def _check_s3_permissions(self, bucket_name: str) -> bool:
         logger.info(f"Verifying S3 permissions for bucket: {bucket_name}")
         try:
-            if not self.create_s3_bucket_if_not_exists(bucket_name):
+            if not self._cached_check(bucket_name, "exists", lambda: self.create_s3_bucket_if_not_exists(bucket_name)):
                 raise Exception(f"Failed to create or verify bucket {bucket_name}")
                 
             logger.info("Testing S3 permissions...")
@@ -110,6 +1630,11 @@ class BedrockBatch:
             logger.error(f"S3 permission verification failed: {e}")
             return False
 
+    def _ensure_s3_permissions(self, bucket_name: str) -> None:
+        """Raise PermissionError unless the bucket passed (or recently passed) verification."""
+        if not self.verify_s3_permissions(bucket_name):
+            raise PermissionError("Failed to verify S3 permissions")
+
     def create_iam_role(self, role_name: str, bucket_name: str) -> str:
         """Create IAM role for Bedrock batch inference."""
         logger.info(f"Creating IAM role: {role_name}")
@@ -146,44 +1671,46 @@ class BedrockBatch:
             }]
         }
 
+        policy_name = f"{role_name}-policy"
         try:
-            # Check if role already exists
+            changed = False
             try:
                 role_response = self.iam_client.get_role(RoleName=role_name)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'NoSuchEntity':
+                    raise
+                role_response = None
+
+            if role_response:
                 role_arn = role_response['Role']['Arn']
                 logger.info(f"IAM role {role_name} already exists with ARN: {role_arn}")
-                
-                # Update trust policy
-                self.iam_client.update_assume_role_policy(
-                    RoleName=role_name,
-                    PolicyDocument=json.dumps(trust_policy)
-                )
-                logger.info(f"Updated trust policy for existing role: {role_name}")
-                
-                # Update permission policy
-                try:
-                    self.iam_client.get_role_policy(
+
+                # Only touch the policies when they drifted, so warm runs need no propagation
+                if role_response['Role'].get('AssumeRolePolicyDocument') != trust_policy:
+                    self.iam_client.update_assume_role_policy(
                         RoleName=role_name,
-                        PolicyName=f"{role_name}-policy"
+                        PolicyDocument=json.dumps(trust_policy)
                     )
-                    
-                    # Update existing policy
-                    self.iam_client.put_role_policy(
+                    logger.info(f"Updated trust policy for existing role: {role_name}")
+                    changed = True
+
+                try:
+                    current_policy = self.iam_client.get_role_policy(
                         RoleName=role_name,
-                        PolicyName=f"{role_name}-policy",
-                        PolicyDocument=json.dumps(permission_policy)
-                    )
-                    logger.info(f"Updated permission policy for role: {role_name}")
+                        PolicyName=policy_name
+                    )['PolicyDocument']
                 except ClientError:
-                    # Create new policy if it doesn't exist
+                    current_policy = None
+
+                if current_policy != permission_policy:
                     self.iam_client.put_role_policy(
                         RoleName=role_name,
-                        PolicyName=f"{role_name}-policy",
+                        PolicyName=policy_name,
                         PolicyDocument=json.dumps(permission_policy)
                     )
-                    logger.info(f"Created new permission policy for role: {role_name}")
-                    
-            except ClientError:
+                    logger.info(f"Updated permission policy for role: {role_name}")
+                    changed = True
+            else:
                 # Create new role if it doesn't exist
                 role_response = self.iam_client.create_role(
                     RoleName=role_name,
@@ -195,19 +1722,27 @@ class BedrockBatch:
                 # Attach permission policy
                 self.iam_client.put_role_policy(
                     RoleName=role_name,
-                    PolicyName=f"{role_name}-policy",
+                    PolicyName=policy_name,
                     PolicyDocument=json.dumps(permission_policy)
                 )
                 logger.info("Attached permission policy to new role")
+                changed = True
 
-            # Wait for role propagation
-            logger.info("Waiting for IAM role to propagate...")
-            time.sleep(50)
+            # New or changed roles may take a while to propagate; job creation retries for them
+            if changed:
+                self._unpropagated_roles.add(role_arn)
             return role_arn
         except ClientError as e:
             logger.error(f"Error creating/updating IAM role: {e}")
             raise
 
+    def get_batch_role_arn(self, bucket_name: str) -> str:
+        """Return the ARN of the shared batch role for a bucket, provisioning it once per process."""
+        if bucket_name not in self._role_arns:
+            role_name = f"{BATCH_ROLE_NAME}-{bucket_name}"[:64]
+            self._role_arns[bucket_name] = self.create_iam_role(role_name, bucket_name)
+        return self._role_arns[bucket_name]
+
     def upload_file_to_s3(self, local_file_path: str, bucket_name: str, s3_key: str) -> None:
         """Upload file to S3 bucket."""
         logger.info(f"Uploading file {local_file_path} to S3 bucket {bucket_name} with key {s3_key}")
@@ -215,8 +1750,7 @@ class BedrockBatch:
             if not Path(local_file_path).exists():
                 raise FileNotFoundError(f"Input file not found: {local_file_path}")
                 
-            if not self.verify_s3_permissions(bucket_name):
-                raise PermissionError("Failed to verify S3 permissions")
+            self._ensure_s3_permissions(bucket_name)
 
             self.s3_client.upload_file(local_file_path, bucket_name, s3_key)
             logger.info(f"Uploaded {local_file_path} to s3://{bucket_name}/{s3_key}")
@@ -224,50 +1758,77 @@ class BedrockBatch:
             logger.error(f"Error uploading file to S3: {e}")
             raise
 
+    def _is_role_propagation_error(self, error: ClientError) -> bool:
+        """True if job creation failed because Bedrock cannot (yet) assume the service role."""
+        code = error.response.get('Error', {}).get('Code')
+        message = error.response.get('Error', {}).get('Message', '').lower()
+        return code in ('ValidationException', 'AccessDeniedException') and (
+            'assume' in message or 'role' in message)
+
     def create_batch_inference_job(self, job_name: str, input_location: str, 
                                   output_location: str, role_arn: str) -> str:
-        """Create a batch inference job."""
+        """
+        Create a batch inference job.
+
+        When ``role_arn`` was just created or updated, job creation is retried with backoff
+        (up to ROLE_PROPAGATION_TIMEOUT seconds) while Bedrock reports it cannot assume the
+        role, instead of sleeping a fixed time after every role update.
+        """
         logger.info(f"Creating batch inference job: {job_name}")
-        try:
-            response = self.bedrock_client.create_model_invocation_job(
-                modelId=self.llm_model_id,
-                jobName=job_name,
-                inputDataConfig={
-                    "s3InputDataConfig": {
-                        "s3Uri": input_location
-                    }
-                },
-                outputDataConfig={
-                    "s3OutputDataConfig": {
-                        "s3Uri": output_location
-                    }
-                },
-                roleArn=role_arn
-            )
-            job_arn = response.get('jobArn')
-            job_id = job_arn.split('/')[-1]
-            logger.info(f"Created batch inference job: {job_id}")
-            return job_id
-        except ClientError as e:
-            logger.error(f"Error creating batch inference job: {e}")
-            raise
+        deadline = time.monotonic() + ROLE_PROPAGATION_TIMEOUT
+        delay = 2
+        while True:
+            try:
+                response = self.bedrock_client.create_model_invocation_job(
+                    modelId=self.llm_model_id,
+                    jobName=job_name,
+                    inputDataConfig={
+                        "s3InputDataConfig": {
+                            "s3Uri": input_location
+                        }
+                    },
+                    outputDataConfig={
+                        "s3OutputDataConfig": {
+                            "s3Uri": output_location
+                        }
+                    },
+                    roleArn=role_arn
+                )
+                self._unpropagated_roles.discard(role_arn)
+                job_arn = response.get('jobArn')
+                job_id = job_arn.split('/')[-1]
+                logger.info(f"Created batch inference job: {job_id}")
+                return job_id
+            except ClientError as e:
+                if (role_arn in self._unpropagated_roles and self._is_role_propagation_error(e)
+                        and time.monotonic() + delay < deadline):
+                    logger.info(f"IAM role not yet usable by Bedrock, retrying in {delay}s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 20)
+                    continue
+                logger.error(f"Error creating batch inference job: {e}")
+                raise
+
+    def get_job_status(self, job_id: str) -> Tuple[str, str]:
+        """Return the (status, message) of a batch job."""
+        job_arn = f"arn:aws:bedrock:{self.region}:{self.account_id}:model-invocation-job/{job_id}"
+        response = self.bedrock_client.get_model_invocation_job(jobIdentifier=job_arn)
+        return response['status'], response.get('message', '')
 
     def monitor_job_status(self, job_id: str) -> str:
         """Monitor the status of a batch job until completion."""
         logger.info(f"Monitoring job status for job ID: {job_id}")
         while True:
             try:
-                job_arn = f"arn:aws:bedrock:{self.region}:{self.account_id}:model-invocation-job/{job_id}"
-                response = self.bedrock_client.get_model_invocation_job(jobIdentifier=job_arn)
-                status = response['status']
+                status, message = self.get_job_status(job_id)
                 logger.info(f"Job status: {status}")
 
                 if status.upper() == 'FAILED':
                     # Get and log the failure reason
-                    failure_reason = response.get('message', 'No failure reason provided')
+                    failure_reason = message or 'No failure reason provided'
                     logger.error(f"Job failed with reason: {failure_reason}")
                     return status
-                elif status.upper() in ['COMPLETED', 'STOPPED']:
+                elif status.upper() in TERMINAL_JOB_STATES:
                     return status
 
                 time.sleep(30)  # Check every 30 seconds
@@ -275,343 +1836,1244 @@ class BedrockBatch:
                 logger.error(f"Error monitoring job status: {e}")
                 raise
 
-    def download_batch_results(self, bucket_name: str, s3_prefix: str = "output/") -> Optional[str]:
-        """Download batch inference results from S3."""
+    def _list_result_parts(self, bucket_name: str, s3_prefix: str) -> List[Tuple[str, int]]:
+        """List every output part (key, size) under a job's output prefix, across all pages."""
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        parts = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix):
+            parts.extend((obj["Key"], obj["Size"]) for obj in page.get("Contents", [])
+                         if obj["Key"].endswith(RESULT_SUFFIX))
+        return sorted(parts)
+
+    def _download_range(self, bucket_name: str, key: str, start: int, end: int,
+                        output_file: str, file_offset: int) -> None:
+        """Fetch bytes [start, end) of an object and write them at ``file_offset`` of ``output_file``."""
+        body = self.s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={start}-{end - 1}")["Body"]
+        with open(output_file, "r+b") as f:
+            f.seek(file_offset)
+            for chunk in iter(lambda: body.read(STREAM_CHUNK_SIZE), b""):
+                f.write(chunk)
+
+    @_timed_stage("download")
+    def download_batch_results(self, bucket_name: str, s3_prefix: str = "output/",
+                               output_file: Optional[str] = None) -> Optional[str]:
+        """
+        Download every output part of a batch job into one local .jsonl.out file.
+
+        ``s3_prefix`` should be the job's own output prefix (``<output prefix><job id>/``) so
+        that other jobs' results are never picked up. All pages are listed, and the parts are
+        fetched with parallel ranged GETs written straight to their offsets in the output
+        file; a newline separates consecutive parts.
+        """
         logger.info(f"Downloading batch results from bucket: {bucket_name} with prefix: {s3_prefix}")
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=bucket_name,
-                Prefix=s3_prefix
-            )
-
-            jsonl_out_file = None
-            latest_time = 0
-
-            for obj in response.get('Contents', []):
-                key = obj['Key']
-                if key.endswith('.jsonl.out'):
-                    logger.info(f"Found candidate output file: {key}")
-                    if obj['LastModified'].timestamp() > latest_time:
-                        latest_time = obj['LastModified'].timestamp()
-                        jsonl_out_file = key
-
-            if not jsonl_out_file:
-                logger.error(f"No .jsonl.out file found in bucket {bucket_name} with prefix {s3_prefix}")
+            parts = self._list_result_parts(bucket_name, s3_prefix)
+            if not parts:
+                logger.error(f"No {RESULT_SUFFIX} file found in bucket {bucket_name} with prefix {s3_prefix}")
                 return None
 
-            output_file = f"downloaded_results_{int(time.time())}.jsonl.out"
-            self.s3_client.download_file(
-                bucket_name,
-                jsonl_out_file,
-                output_file
-            )
-
-            if os.path.exists(output_file):
-                logger.info(f"Successfully downloaded file to: {output_file}")
-            else:
-                logger.error(f"Download reported success but file not found locally: {output_file}")
-
+            output_file = output_file or f"downloaded_results_{int(time.time())}{RESULT_SUFFIX}"
+            ranges = []
+            offset = 0
+            for key, size in parts:
+                logger.info(f"Found output part: {key} ({size} bytes)")
+                for start in range(0, size, RESULT_RANGE_BYTES):
+                    ranges.append((key, start, min(start + RESULT_RANGE_BYTES, size), offset + start))
+                offset += size + 1
+
+            # Pre-size the file with a newline after each part; ranges then fill in the gaps
+            tmp_file = f"{output_file}.part"
+            with open(tmp_file, "wb") as f:
+                f.truncate(offset)
+                separator = 0
+                for _, size in parts:
+                    separator += size
+                    f.seek(separator)
+                    f.write(b"\n")
+                    separator += 1
+
+            with ThreadPoolExecutor(max_workers=self.max_download_workers) as executor:
+                futures = [executor.submit(self._download_range, bucket_name, key, start, end, tmp_file, file_offset)
+                           for key, start, end, file_offset in ranges]
+                for future in as_completed(futures):
+                    future.result()
+            os.replace(tmp_file, output_file)
+            self.metrics.count("bytes", offset - len(parts), direction="downloaded")
+
+            logger.info(f"Successfully downloaded {len(parts)} parts ({offset - len(parts)} bytes) to: {output_file}")
             return output_file
 
         except ClientError as e:
             logger.error(f"Error downloading batch results: {e}")
             return None
 
-    def process_texts_individually(self, texts: List[str]) -> Dict[int, Dict[str, Any]]:
-        """Process texts using direct API calls instead of batch processing."""
-        logger.info(f"Processing {len(texts)} texts using direct API calls")
-        results = {}
-        
-        for i, text in enumerate(texts):
+    def iter_batch_results(self, bucket_name: str, s3_prefix: str) -> Iterator[str]:
+        """Stream the lines of every output part under a job's output prefix, without a local file."""
+        for key, _ in self._list_result_parts(bucket_name, s3_prefix):
+            body = self.s3_client.get_object(Bucket=bucket_name, Key=key)["Body"]
+            for line in body.iter_lines():
+                self.metrics.count("bytes", len(line) + 1, direction="downloaded")
+                yield line.decode("utf-8")
+
+    def _invoke_with_backoff(self, request_body: str, label: str) -> Dict[str, Any]:
+        """Invoke the model on-demand, backing off and retrying when throttled."""
+        for attempt in range(self.max_throttle_retries + 1):
             try:
-                # Prepare prompt
-                prompt = self.prepare_batch_prompt(text)
-                
-                # Prepare request body
-                request_body = json.dumps({
+                response = self.bedrock_runtime_client.invoke_model(
+                    modelId=self.llm_model_id,
+                    body=request_body,
+                    contentType="application/json",
+                    accept="application/json"
+                )
+                return json.loads(response['body'].read().decode('utf-8'))
+            except ClientError as e:
+                error_code = e.response.get('Error', {}).get('Code')
+                if error_code != 'ThrottlingException' or attempt == self.max_throttle_retries:
+                    raise
+                self.metrics.count("throttle_retries")
+                delay = min(self.throttle_max_delay, self.throttle_base_delay * (2 ** attempt))
+                delay = random.uniform(delay / 2, delay)
+                logger.warning(f"Throttled on {label}, retrying in {delay:.1f}s "
+                               f"(attempt {attempt + 1}/{self.max_throttle_retries})")
+                time.sleep(delay)
+
+    def _process_single_text(self, i: int, text: str, total: int, static_prompt: str = "",
+                             max_tokens: int = DEFAULT_MAX_TOKENS) -> Dict[str, Any]:
+        """
+        Classify one prompt with a direct API call; returns {} on unrecoverable errors.
+
+        The response body is returned as is, like a batch job's ``modelOutput``: the CSV stage
+        parses its text with extract_json and reads its ``stop_reason`` and ``usage``.
+        """
+        try:
+            # Prepare request body
+            if static_prompt:
+                model_input = self._build_model_input(static_prompt, text, cache_prefix=self.prompt_caching,
+                                                      max_tokens=max_tokens)
+            else:
+                model_input = {
                     "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 4096,
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": prompt
-                                }
-                            ]
-                        }
-                    ]
-                })
-                
-                # Call the LLM directly using your existing function
-                logger.info(f"Processing text {i+1}/{len(texts)} using direct API call")
-                response = invoke_llm(request_body)
-                
-                # Parse response
-                response_body = json.loads(response['body'].read().decode('utf-8'))
-                if 'content' in response_body and len(response_body['content']) > 0:
-                    response_text = response_body['content'][0]['text']
-                    
-                    # Parse JSON from response text
-                    try:
-                        response_json = json.loads(response_text)
-                        results[i] = response_json
-                    except json.JSONDecodeError:
-                        logger.warning(f"Could not parse JSON from response for text {i}")
-                        results[i] = {}
-                else:
-                    logger.warning(f"Empty or invalid response for text {i}")
-                    results[i] = {}
-                    
-            except Exception as e:
-                logger.error(f"Error processing text {i}: {str(e)}")
-                results[i] = {}
-        
-        return results
-    
-    def generate_jsonl_from_raw_json_files(self, input_bucket: str, input_prefix: str, output_prefix: str,
-                                           institution: str, config_path: str = "config.json",
-                                           local_output_dir: str = "batch_inputs") -> List[str]:
-        os.makedirs(local_output_dir, exist_ok=True)
-        with open(config_path, "r", encoding="utf-8") as file:
-            config = json.load(file)
+                    "max_tokens": max_tokens,
+                    "messages": [{"role": "user", "content": [{"type": "text", "text": text}]}]
+                }
+            request_body = json.dumps(model_input)
+
+            logger.info(f"Processing text {i+1}/{total} using direct API call")
+            response_body = self._invoke_with_backoff(request_body, label=f"text {i}")
+            if response_body.get("stop_reason") == "max_tokens" and max_tokens < MODEL_MAX_OUTPUT_TOKENS:
+                # The cut-off output is discarded, so its tokens are counted here rather than by the CSV stage
+                self.metrics.count_usage(response_body.get("usage"))
+                self.metrics.count("truncated_outputs")
+                logger.warning(f"Output for text {i} was cut off at {max_tokens} tokens, "
+                               f"retrying with {MODEL_MAX_OUTPUT_TOKENS}")
+                return self._process_single_text(i, text, total, static_prompt, MODEL_MAX_OUTPUT_TOKENS)
+
+            if not response_body.get("content"):
+                logger.warning(f"Empty or invalid response for text {i}")
+            return response_body
 
-        institution_data = config["templates"].get(institution, {})
-        template = institution_data.get("template", {})
-        valid_values = institution_data.get("valid_values", {})
-        rules = institution_data.get("processing_rules", {}).get("rules", [])
+        except Exception as e:
+            logger.error(f"Error processing text {i}: {str(e)}")
+            return {}
 
-        if not template:
-            raise ValueError(f"No template found for institution '{institution}'")
+    def process_texts_individually(self, texts: List[str], max_workers: Optional[int] = None,
+                                   static_prompt: str = "",
+                                   max_tokens: int = DEFAULT_MAX_TOKENS) -> Dict[int, Dict[str, Any]]:
+        """
+        Process texts using concurrent direct API calls instead of batch processing.
+
+        At most ``max_workers`` requests are in flight at once (defaults to
+        ``self.max_concurrent_requests``). Throttled calls are retried with
+        exponential backoff; the returned dict is keyed and ordered by text index.
+        When ``static_prompt`` is given it is sent ahead of each text as a
+        prompt-cache prefix. Requests that start before the cache entry exists
+        each write it, so if the prefix is long enough to be cached the first
+        text is sent on its own before the rest are fanned out.
+        """
+        max_workers = max_workers or self.max_concurrent_requests
+        logger.info(f"Processing {len(texts)} texts using direct API calls "
+                    f"({max_workers} concurrent requests)")
+        unordered = {}
+        if (static_prompt and self.prompt_caching and len(texts) > 1
+                and estimate_tokens(static_prompt) >= PROMPT_CACHE_MIN_TOKENS):
+            unordered[0] = self._process_single_text(0, texts[0], len(texts), static_prompt, max_tokens)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._process_single_text, i, texts[i], len(texts), static_prompt, max_tokens): i
+                for i in range(len(unordered), len(texts))
+            }
+            for future in as_completed(futures):
+                unordered[futures[future]] = future.result()
+
+        return {i: unordered[i] for i in range(len(texts))}
+
+    def _list_input_files(self, bucket_name: str, prefix: str, suffix: str = ".json") -> List[str]:
+        """List every key under a prefix (all pages), sorted for deterministic ordering."""
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        keys = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(suffix))
+        logger.info(f"Found {len(keys)} {suffix} files under s3://{bucket_name}/{prefix}")
+        return sorted(keys)
+
+    def _build_patient_prompt(self, report: str, results: Any, degree_hint: str = "",
+                              compact: bool = False) -> str:
+        """Build the per-patient part of the prompt that follows the static prefix."""
+        results_json = json.dumps(results, separators=(",", ":")) if compact else json.dumps(results, indent=4)
+        prompt = (
+            "**Hearing Report:**\n\n"
+            f"{report}\n\n"
+            "**Audiometric Test Results:**\n\n"
+            f"{results_json}\n"
+        )
+        if degree_hint:
+            prompt += ("\n**Degree of Loss From Thresholds (computed from the results above; use as given):**\n\n"
+                       f"{degree_hint}")
+        return prompt
 
-        response = self.s3_client.list_objects_v2(Bucket=input_bucket, Prefix=input_prefix)
-        input_files = [obj["Key"] for obj in response.get("Contents", []) if obj["Key"].endswith(".json")]
+    def _fit_patient_prompt(self, report: str, results: Any, degree_hint: str,
+                            profile: InstitutionProfile) -> Tuple[Optional[str], str]:
+        """
+        Build a patient prompt that fits the token budget, returning (prompt, action).
 
-        jsonl_keys = []
+        The budget is what the context window leaves after the profile's static prompt, its
+        max_tokens and the message framing, measured with estimate_tokens. Over-budget prompts
+        are handled in this order, each step only when the previous one is not enough:
 
-        for file_key in input_files:
-            file_obj = self.s3_client.get_object(Bucket=input_bucket, Key=file_key)
-            input_json = json.loads(file_obj["Body"].read().decode("utf-8"))
+        1. ``compacted``: the results are rendered without indentation (no content is lost).
+        2. ``report_trimmed``: the middle of the report is cut, keeping its first third and
+           last two thirds (reason for test, and interpretation/recommendations) around a
+           REPORT_TRIM_MARKER that says how much was left out. Results are never trimmed.
+        3. ``over_budget``: the results alone do not fit; no prompt is returned and the
+           record is not sent to the model.
+
+        Reports are trimmed rather than split across requests because every record needs
+        exactly one classification. The action is "" for prompts that fit as built.
+        """
+        budget = self.context_tokens - profile.max_tokens - profile.static_prompt_tokens - PROMPT_OVERHEAD_TOKENS
+        prompt = self._build_patient_prompt(report, results, degree_hint)
+        if estimate_tokens(prompt) <= budget:
+            return prompt, ""
+        prompt = self._build_patient_prompt(report, results, degree_hint, compact=True)
+        excess = estimate_tokens(prompt) - budget
+        if excess <= 0:
+            return prompt, "compacted"
+
+        marker = REPORT_TRIM_MARKER.format(omitted=len(report))
+        keep = len(report) - excess * CHARS_PER_TOKEN - len(marker)
+        if keep <= 0:
+            return None, "over_budget"
+        head = keep // 3
+        omitted = len(report) - keep
+        trimmed = report[:head] + REPORT_TRIM_MARKER.format(omitted=omitted) + report[len(report) - (keep - head):]
+        return self._build_patient_prompt(trimmed, results, degree_hint, compact=True), "report_trimmed"
+
+    def _build_model_input(self, static_prompt: str, patient_prompt: str, cache_prefix: bool = False,
+                           max_tokens: int = DEFAULT_MAX_TOKENS) -> dict:
+        """
+        Build the Anthropic messages body with the static prefix and patient data as separate blocks.
 
-            batch_inputs = []
-            for idx, patient in enumerate(input_json, start=1):
-                report = patient.get("report") or patient.get("Report", "").strip()
-                results = patient.get("results") or patient.get("Results", [])
+        With ``cache_prefix`` a prompt-cache checkpoint is placed after the static block
+        (on-demand only; batch inference does not use prompt caching). ``max_tokens`` is the
+        institution profile's output limit.
+        """
+        static_block = {"type": "text", "text": static_prompt}
+        if cache_prefix:
+            static_block["cache_control"] = {"type": "ephemeral"}
+        return {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "messages": [{
+                "role": "user",
+                "content": [static_block, {"type": "text", "text": patient_prompt}]
+            }]
+        }
+
+    @staticmethod
+    def _patient_fields(patient: dict) -> Tuple[str, Any]:
+        """Return (report, results) for a raw patient, accepting lower or capitalized keys."""
+        report = (patient.get("report") or patient.get("Report") or "").strip()
+        results = patient.get("results") or patient.get("Results") or []
+        return report, results
+
+    def _iter_patients(self, body, stream_input: bool = True) -> Iterator[dict]:
+        """Iterate patient objects from an S3 body, streaming unless ``stream_input`` is False."""
+        if stream_input:
+            return iter_json_array(body)
+        return iter(json.loads(body.read().decode("utf-8")))
+
+    def _generate_jsonl_for_file(self, input_bucket: str, file_key: str, institution: str,
+                                 profile: InstitutionProfile, stream_input: bool = True,
+                                 preclassifier: Optional[AudiogramPreclassifier] = None) -> Optional[BatchInputManifest]:
+        """
+        Fetch one raw JSON file, build its prompts and upload its sidecar. Returns its manifest or None.
+
+        The model inputs are spooled to a local temporary file (``manifest.spool``) for
+        pack_batch_inputs, so they are uploaded to S3 only once, already in batch-job shards.
+
+        Patients already in the result cache, or fully classified by ``preclassifier``, get a
+        sidecar entry (marked ``cached`` or carrying the ``preclassified`` output) but no prompt.
+        Prompts are fitted to the token budget (see ``_fit_patient_prompt``); patients that
+        cannot be made to fit are marked ``over_budget`` in the sidecar and get no prompt either.
+        """
+        def timed(stage: str, started: float) -> None:
+            self.metrics.add_time(stage, time.perf_counter() - started)
+
+        def patients() -> Iterator[Tuple[int, dict]]:
+            started = time.perf_counter()
+            file_obj = self.s3_client.get_object(Bucket=input_bucket, Key=file_key)
+            stream = enumerate(self._iter_patients(file_obj["Body"], stream_input), start=1)
+            timed("ingestion", started)
+            while True:
+                started = time.perf_counter()
+                item = next(stream, None)
+                timed("ingestion", started)
+                if item is None:
+                    return
+                yield item
+
+        input_filename = file_key.split("/")[-1].replace(".json", f"_{institution.lower()}_batch.jsonl")
+        manifest = BatchInputManifest(source_key=file_key, s3_key=f"input/{input_filename}",
+                                      static_prompt=profile.static_prompt, max_tokens=profile.max_tokens)
+        sidecar = tempfile.SpooledTemporaryFile(max_size=SIDECAR_SPOOL_BYTES)
+
+        def build_records() -> None:
+            for idx, patient in patients():
+                started = time.perf_counter()
+                report, results = self._patient_fields(patient)
 
                 if not report and not results:
                     continue
 
                 record_id = f"PAT{idx:08d}"
-                prompt = (
-                    "You are an expert **pediatric** audiologist assistant responsible for extracting explicit hearing test data and classifying hearing loss with precision."
-                    " Your classification must strictly follow given templates and clinical guidelines.\n\n"
-                    "**Hearing Report:**\n\n"
-                    f"{report}\n\n"
-                    "**Audiometric Test Results:**\n\n"
-                    f"{json.dumps(results, indent=4)}\n\n"
-                    "**Classification Template:**\n\n"
-                    f"{json.dumps(template, indent=4)}\n\n"
-                    "**Valid Values:**\n"
-                    f"```json\n{json.dumps(valid_values, indent=4)}\n```\n\n"
-                    "**Classification Guidelines (MUST FOLLOW):**\n"
-                    f"```json\n{json.dumps(rules, indent=4)}\n```\n\n"
-                    "**Processing Rules (MUST Follow):**\n"
-                    "- **Use only explicitly provided threshold values**; do not infer missing values.\n"
-                    "- **If multiple severities are listed, assign the most severe classification.**\n\n"
-                    "**Output Requirements:**\n"
-                    "- Fill in missing values using classification rules.\n"
-                    "- Assign the correct 'Better Ear' based on hearing loss severity.\n"
-                    "- Use only valid options listed above (strict validation).\n"
-                    "- Provide **reasoning** for each classification decision.\n"
-                    "- Cite **guidelines** used in decisions.\n"
-                    "- Return classification in **EXACT JSON format** as per the template, with no modifications.\n"
-                    "- Provide **precise reasoning** for each classification.\n"
-                    "- Make sure there is a **detailed, thorough, chain of thought reasoning for each attribute's output** and how it came to that conclusion."
-                    "- Reasoning must include thorough reasoning for the left ear, right ear, and risk factors"
-                    "- **Cite guideline numbers** when making classification decisions.\n"
-                    "- **DO NOT include any additional explanations, assumptions, or commentary.**\n"
-                )
-
-                batch_inputs.append({
+                digest = record_digest(report, results)
+                cached = bool(self.result_cache) and self.result_cache.contains(
+                    ResultCache.key(digest, profile.version, self.llm_model_id))
+                preclassified, degree_hint = None, ""
+                if preclassifier and not cached:
+                    preclassified, degree_hint = preclassifier.classify(report, results)
+                prompt, fit = None, ""
+                if not cached and not preclassified:
+                    prompt, fit = self._fit_patient_prompt(report, results, degree_hint, profile)
+                sidecar.write((json.dumps({
                     "recordId": record_id,
-                    "modelInput": {
-                        "anthropic_version": "bedrock-2023-05-31",
-                        "max_tokens": 4096, # 1024
-                        "messages": [{
-                            "role": "user",
-                            "content": [{"type": "text", "text": prompt}]
-                        }]
-                    }
-                })
+                    "source": file_key,
+                    "index": idx,
+                    "digest": digest,
+                    "cached": cached,
+                    "preclassified": preclassified,
+                    "over_budget": prompt is None and fit == "over_budget",
+                    "report": report,
+                    "results": results
+                }) + "\n").encode("utf-8"))
+                if cached:
+                    manifest.cached_ids.append(record_id)
+                    timed("prompt_build", started)
+                    continue
+                if preclassified:
+                    manifest.preclassified_ids.append(record_id)
+                    timed("prompt_build", started)
+                    continue
+                if fit:
+                    self.metrics.count("prompt_fits", action=fit)
+                if prompt is None:
+                    logger.warning(f"{file_key} record {record_id}: results alone exceed the token budget, "
+                                   f"not sent to the model")
+                    manifest.over_budget_ids.append(record_id)
+                    timed("prompt_build", started)
+                    continue
+                if fit:
+                    manifest.trimmed_ids.append(record_id)
+
+                manifest.add_record(record_id, self._build_model_input(profile.static_prompt, prompt,
+                                                                       max_tokens=profile.max_tokens))
+                manifest.input_tokens += profile.static_prompt_tokens + estimate_tokens(prompt)
+                if manifest.prompts is not None:
+                    manifest.prompts.append(prompt)
+                    if len(manifest.prompts) >= BATCH_MIN_RECORDS:
+                        manifest.prompts = None
+                timed("prompt_build", started)
+
+        with sidecar:
+            try:
+                build_records()
+            except BaseException:
+                manifest.close()
+                raise
+            if (not manifest.record_ids and not manifest.cached_ids and not manifest.preclassified_ids
+                    and not manifest.over_budget_ids):
+                return None
 
-            if not batch_inputs:
-                continue
+            self._ensure_s3_permissions(input_bucket)
+            manifest.sidecar_key = manifest.s3_key.replace(".jsonl", SIDECAR_SUFFIX)
+            sidecar_bytes = sidecar.tell()
+            sidecar.seek(0)
+            try:
+                with self.metrics.timer("upload"):
+                    self.s3_client.upload_fileobj(
+                        sidecar,
+                        input_bucket,
+                        manifest.sidecar_key,
+                        ExtraArgs={"ContentType": "application/json"}
+                    )
+            except BaseException:
+                manifest.close()
+                raise
+
+        self.metrics.count("bytes", sidecar_bytes, direction="uploaded")
+        self.metrics.count("records", manifest.record_count, stage="prompted")
+        self.metrics.count("records", len(manifest.cached_ids), stage="cached")
+        self.metrics.count("records", len(manifest.preclassified_ids), stage="preclassified")
+        return manifest
 
-            input_filename = file_key.split("/")[-1].replace(".json", f"_{institution.lower()}_batch.jsonl")
-            local_jsonl_path = os.path.join(local_output_dir, input_filename)
+    def generate_jsonl_from_raw_json_files(self, input_bucket: str, input_prefix: str, output_prefix: str,
+                                           institution: str, config_path: str = "config.json",
+                                           max_workers: Optional[int] = None,
+                                           stream_input: bool = True,
+                                           preclassify: bool = True,
+                                           failed_files: Optional[Dict[str, str]] = None) -> List[BatchInputManifest]:
+        """
+        Build Bedrock batch JSONL inputs for every raw .json file under ``input_prefix``.
+
+        Listing is paginated, and files are fetched and turned into prompts by a pool of
+        ``max_workers`` threads (defaults to ``self.max_ingest_workers``). The returned
+        manifests follow the sorted order of the source keys regardless of completion order.
+
+        With ``stream_input`` (the default) patients are decoded one at a time from the S3
+        body and their model inputs spooled to local temporary files, so memory stays flat
+        for very large exports; the manifests' spools are closed with ``close()`` once the
+        inputs are packed. Each file gets a sidecar record manifest (``*.records.jsonl``)
+        with the source key, patient index, digest, report and results of every record,
+        which the CSV stage joins on instead of parsing prompts back out of the outputs.
+        Records found in ``self.result_cache`` are left out of the batch input, as are
+        clear normal-hearing audiograms when ``preclassify`` is set and numpy is available
+        (see AudiogramPreclassifier). Every request carries the profile's ``max_tokens``,
+        and prompts too large for the context window are trimmed or left out as described
+        in ``_fit_patient_prompt``.
+
+        A file that cannot be processed never stops the others. Once all files are done,
+        the failures are added to ``failed_files`` (source key -> error) when it is given,
+        and otherwise raised as a RuntimeError.
+        """
+        profile = load_institution_profiles(config_path).get(institution)
+        if not profile or not profile.template:
+            raise ValueError(f"No template found for institution '{institution}'")
+
+        preclassifier = AudiogramPreclassifier.from_profile(profile) if preclassify else None
+        input_files = self._list_input_files(input_bucket, input_prefix)
+        max_workers = max_workers or self.max_ingest_workers
+
+        results_by_index = {}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._generate_jsonl_for_file, input_bucket, file_key, institution,
+                                profile, stream_input, preclassifier): i
+                for i, file_key in enumerate(input_files)
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                try:
+                    results_by_index[i] = future.result()
+                    manifest = results_by_index[i]
+                    status = (f"{manifest.s3_key} ({manifest.record_count} records, {manifest.total_bytes} bytes, "
+                              f"{len(manifest.cached_ids)} cached, {len(manifest.preclassified_ids)} pre-classified, "
+                              f"{len(manifest.trimmed_ids)} trimmed, {len(manifest.over_budget_ids)} over budget)"
+                              if manifest else "no patient records, skipped")
+                    logger.info(f"[{done}/{len(input_files)}] {input_files[i]} -> {status}")
+                except Exception as e:
+                    logger.error(f"[{done}/{len(input_files)}] Failed to build prompts for {input_files[i]}: {e}")
+                    errors[input_files[i]] = str(e)
+
+        if errors:
+            self.metrics.count("failed_files", len(errors))
+            if failed_files is None:
+                raise RuntimeError(f"Failed to build prompts for {len(errors)} of {len(input_files)} input files: "
+                                   + ", ".join(sorted(errors)))
+            failed_files.update(errors)
+        return [results_by_index[i] for i in sorted(results_by_index) if results_by_index[i]]
+
+    def _plan_shards(self, manifests: List[BatchInputManifest], max_records: int = BATCH_MAX_RECORDS,
+                     max_bytes: int = BATCH_MAX_BYTES) -> List[Tuple[int, int]]:
+        """
+        Split the concatenated records of all manifests into contiguous [start, end) ranges.
 
-            with open(local_jsonl_path, "w", encoding="utf-8") as jsonl_file:
-                for entry in batch_inputs:
-                    jsonl_file.write(json.dumps(entry) + "\n")
+        Shards are balanced to roughly equal record counts, closed early if the byte limit
+        would be exceeded, and a short trailing shard borrows records from its neighbour so
+        every shard meets BATCH_MIN_RECORDS.
+        """
+        sizes = [size for manifest in manifests for size in manifest.record_sizes]
+        total_records = len(sizes)
+        shard_count = max(math.ceil(total_records / max_records), math.ceil(sum(sizes) / max_bytes), 1)
+        target = math.ceil(total_records / shard_count)
+
+        bounds = []
+        start, shard_bytes = 0, 0
+        for i, size in enumerate(sizes):
+            if i > start and (i - start >= target or shard_bytes + size > max_bytes):
+                bounds.append((start, i))
+                start, shard_bytes = i, 0
+            shard_bytes += size
+        bounds.append((start, total_records))
+
+        if len(bounds) > 1 and bounds[-1][1] - bounds[-1][0] < BATCH_MIN_RECORDS:
+            (prev_start, split), (_, end) = bounds[-2], bounds[-1]
+            new_split = end - BATCH_MIN_RECORDS
+            if new_split - prev_start >= BATCH_MIN_RECORDS and sum(sizes[new_split:end]) <= max_bytes:
+                bounds[-2:] = [(prev_start, new_split), (new_split, end)]
+            else:
+                logger.warning(f"Trailing shard has only {end - split} records; Bedrock may reject it")
+        return bounds
+
+    @staticmethod
+    def _iter_spooled_records(manifests: List[BatchInputManifest]) -> Iterator[Tuple[BatchInputManifest, str, bytes]]:
+        """Yield (manifest, record ID, serialized modelInput) for every spooled record, in manifest order."""
+        for manifest in manifests:
+            if not manifest.record_count:
+                continue
+            manifest.spool.seek(0)
+            for record_id, line in zip(manifest.record_ids, manifest.spool):
+                yield manifest, record_id, line.rstrip(b"\n")
 
-            print({local_jsonl_path})
-            output_s3_key = f"input/{input_filename}"
-            self.s3_client.upload_file(local_jsonl_path, input_bucket, output_s3_key, ExtraArgs={"ContentType": "application/json"})
-            jsonl_keys.append(output_s3_key)
+    def pack_batch_inputs(self, bucket_name: str, manifests: List[BatchInputManifest],
+                          run_id: Optional[str] = None) -> Tuple[List[BatchInputManifest], Dict[str, Tuple[str, str]]]:
+        """
+        Pack the spooled per-file inputs into as few batch-job shards as Bedrock limits allow.
 
-        return jsonl_keys
-    
-    def process_batch_inference(self, input_bucket: str, input_prefix: str, output_prefix: str,
-                                       institution: str, config_path: str = "config.json",
-                                       local_output_dir: str = "batch_inputs") -> Dict[str, Any]:
-        jsonl_keys = self.generate_jsonl_from_raw_json_files(
-            input_bucket=input_bucket,
-            input_prefix=input_prefix,
-            output_prefix="input/",  # Save JSONL to input/ folder
-            institution=institution,
-            config_path=config_path,
-            local_output_dir=local_output_dir
+        The spools are read once, in order, and each record is streamed straight into its
+        shard's upload. Records are renumbered with globally unique IDs (``REC00000001``...)
+        and written to ``input/packed/<run_id>/``. Returns the shard manifests and a map from
+        packed record ID to (source file key, original record ID), which is also saved next
+        to the shards.
+        """
+        run_id = run_id or str(int(time.time()))
+        prefix = f"input/packed/{run_id}"
+        self._ensure_s3_permissions(bucket_name)
+        record_map = {}
+        shards = []
+        counter = itertools.count(1)
+        records = self._iter_spooled_records(manifests)
+
+        for shard_no, (start, end) in enumerate(self._plan_shards(manifests), start=1):
+            shard = BatchInputManifest(source_key=prefix, s3_key=f"{prefix}/shard_{shard_no:04d}.jsonl", prompts=None)
+
+            def entries(count=end - start, shard=shard) -> Iterator[bytes]:
+                for manifest, record_id, model_input in itertools.islice(records, count):
+                    packed_id = f"{PACKED_RECORD_PREFIX}{next(counter):08d}"
+                    record_map[packed_id] = (manifest.source_key, record_id)
+                    line = b'{"recordId": "' + packed_id.encode("ascii") + b'", "modelInput": ' + model_input + b"}\n"
+                    shard.record_ids.append(packed_id)
+                    shard.record_sizes.append(len(line))
+                    yield line
+
+            with self.metrics.timer("upload"):
+                self.s3_client.upload_fileobj(
+                    JsonlUploadStream(entries()),
+                    bucket_name,
+                    shard.s3_key,
+                    ExtraArgs={"ContentType": "application/json"}
+                )
+            self.metrics.count("bytes", shard.total_bytes, direction="uploaded")
+            logger.info(f"Packed shard {shard.s3_key}: {shard.record_count} records, {shard.total_bytes} bytes")
+            shards.append(shard)
+
+        self._save_record_map(bucket_name, run_id, record_map)
+        return shards, record_map
+
+    def _save_record_map(self, bucket_name: str, run_id: str, record_map: Dict[str, Tuple[str, str]]) -> None:
+        self.s3_client.put_object(
+            Bucket=bucket_name,
+            Key=f"input/packed/{run_id}/record_map.json",
+            Body=json.dumps(record_map),
+            ContentType="application/json"
         )
 
-        for key in jsonl_keys:
-            local_path = os.path.join(local_output_dir, key.split("/")[-1])
-            self.s3_client.download_file(input_bucket, key, local_path)
-
-            with open(local_path, "r", encoding="utf-8") as f:
-                lines = [json.loads(l) for l in f.readlines()]
-                real_records = [l for l in lines if not l["recordId"].startswith("dummy_")]
-
-            texts = []
-            record_map = {}
-            for i, record in enumerate(real_records):
-                messages = record.get("modelInput", {}).get("messages", [])
-                if messages:
-                    text = messages[0].get("content", [])[0].get("text", "")
-                    texts.append(text)
-                    record_map[record["recordId"]] = i
-
-            if len(texts) >= 100:
-                role_arn = self.create_iam_role(f"pediatric-aud-batch{int(time.time())}", input_bucket)
-                input_uri = f"s3://{input_bucket}/{key}"
-                output_uri = f"s3://{input_bucket}/{output_prefix}"
-                job_id = self.create_batch_inference_job(
-                    job_name=f"pediatric-aud-batch-{int(time.time())}",
-                    input_location=input_uri,
+    @_timed_stage("on_demand")
+    def classify_on_demand(self, bucket_name: str, manifests: List[BatchInputManifest],
+                           run_id: str) -> Tuple[str, Dict[str, Tuple[str, str]]]:
+        """
+        Classify runs too small for a batch job with direct calls, saving the outputs like a job's.
+
+        Response bodies are written unchanged to ``ondemand_results_<run_id>.jsonl.out`` under
+        packed record IDs and the record map is saved as for packed shards, so the CSV stage
+        parses, validates and counts the tokens of them the same way as batch results.
+        """
+        self._ensure_s3_permissions(bucket_name)
+        output_file = f"ondemand_results_{run_id}{RESULT_SUFFIX}"
+        record_map = {}
+        counter = itertools.count(1)
+        with open(output_file, "w", encoding="utf-8") as f:
+            for manifest in manifests:
+                if not manifest.prompts:
+                    continue
+                results = self.process_texts_individually(manifest.prompts, static_prompt=manifest.static_prompt,
+                                                          max_tokens=manifest.max_tokens)
+                for i, result in results.items():
+                    packed_id = f"{PACKED_RECORD_PREFIX}{next(counter):08d}"
+                    record_map[packed_id] = (manifest.source_key, manifest.record_ids[i])
+                    f.write(json.dumps({"recordId": packed_id, "modelOutput": result}) + "\n")
+                self.metrics.count("records", len(results), stage="on_demand")
+        self._save_record_map(bucket_name, run_id, record_map)
+        logger.info(f"Classified {len(record_map)} records on-demand into {output_file}")
+        return output_file, record_map
+
+    def _new_jobs(self, run_id: str, shards: List[BatchInputManifest]) -> List[dict]:
+        """Job manifest entries for packed shards, not yet submitted."""
+        return [
+            {
+                "job_name": f"pediatric-aud-batch-{run_id}-{shard_no:04d}",
+                "input_key": shard.s3_key,
+                "record_count": shard.record_count,
+                "job_id": None,
+                "status": "Pending",
+                "result_file": None
+            }
+            for shard_no, shard in enumerate(shards, start=1)
+        ]
+
+    def _save_job_manifest(self, path: str, job_manifest: dict) -> None:
+        """Atomically write the job manifest so a killed run never leaves it half-written."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job_manifest, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def _load_job_manifest(self, path: str, input_bucket: str, input_prefix: str,
+                           institution: str) -> Optional[dict]:
+        """Load an unfinished job manifest for the same bucket, prefix and institution, if any."""
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            job_manifest = json.load(f)
+        if job_manifest.get("finished"):
+            return None
+        if (job_manifest.get("input_bucket"), job_manifest.get("input_prefix"),
+                job_manifest.get("institution")) != (input_bucket, input_prefix, institution):
+            logger.warning(f"Ignoring job manifest {path}: it belongs to a different run")
+            return None
+        return job_manifest
+
+    def orchestrate_batch_jobs(self, job_manifest: dict, manifest_path: str = JOB_MANIFEST_PATH,
+                               stream_results: bool = False) -> List[str]:
+        """
+        Submit every pending job in ``job_manifest`` up front, then poll them together.
+
+        Job IDs and states are persisted to ``manifest_path`` after every change, so a
+        restarted process picks up where it left off instead of resubmitting. Polling backs
+        off from POLL_MIN_INTERVAL to POLL_MAX_INTERVAL while nothing changes. Results of
+        each successful job are downloaded from the job's own output prefix as soon as it
+        finishes, or with ``stream_results`` only that prefix is recorded (as an s3:// URI)
+        for the CSV stage to stream from. A download that fails is tried again on the next
+        polls; after RESULT_DOWNLOAD_ATTEMPTS a RuntimeError is raised with the manifest left
+        unfinished, so a restart tries the download again rather than dropping the job's records.
+
+        Returns:
+            Local .jsonl.out paths (or s3:// output prefixes) of the job results, in job order.
+        """
+        bucket = job_manifest["input_bucket"]
+        output_uri = f"s3://{bucket}/{job_manifest['output_prefix']}"
+        jobs = job_manifest["jobs"]
+
+        pending = [job for job in jobs if not job.get("job_id")]
+        if pending:
+            role_arn = self.get_batch_role_arn(bucket)
+            for job in pending:
+                job["job_id"] = self.create_batch_inference_job(
+                    job_name=job["job_name"],
+                    input_location=f"s3://{bucket}/{job['input_key']}",
                     output_location=output_uri,
                     role_arn=role_arn
                 )
-                status = self.monitor_job_status(job_id)
-                if status == "COMPLETED" or "Completed":
-                    # result_file = self.download_batch_results(input_bucket, s3_prefix=output_prefix)
-                    # print({result_file})
-                    # if result_file:
-                    #     csv_path = self.jsonl_to_csv(result_file, institution=institution, config_path=config_path)
-                    #     logger.info(f"CSV generated: {csv_path}")
-                    
-                    result_file = self.download_batch_results(input_bucket, s3_prefix=output_prefix)
-                    print({result_file})
-                    
-                    # Determine original input file name to match with .json
-                    original_name = key.split("/")[-1].replace("_batch.jsonl", ".json")
-
-                    # Use original file name in CSV output
-                    if result_file:
-                        custom_csv_name = result_file.replace(".jsonl.out", f"_{original_name.replace('.json', '')}_output.csv")
-                        csv_path = self.jsonl_to_csv(result_file, institution=institution, config_path=config_path)
-                        os.rename(csv_path, custom_csv_name)
-                        logger.info(f"CSV generated for {original_name}: {custom_csv_name}")
+                job["status"] = "Submitted"
+                job["submitted_at"] = time.time()
+                self._save_job_manifest(manifest_path, job_manifest)
 
+        interval = POLL_MIN_INTERVAL
+        while True:
+            changed = False
+            for job in jobs:
+                if job["status"].upper() not in TERMINAL_JOB_STATES:
+                    status, message = self.get_job_status(job["job_id"])
+                    if status != job["status"]:
+                        logger.info(f"Job {job['job_id']} ({job['input_key']}): {job['status']} -> {status}")
+                        job["status"], changed = status, True
+                        if status.upper() == "INPROGRESS":
+                            job["started_at"] = time.time()
+                        elif status.upper() in TERMINAL_JOB_STATES:
+                            self._record_job_times(job)
+                        if status.upper() == "FAILED":
+                            logger.error(f"Job {job['job_id']} failed with reason: {message or 'No failure reason provided'}")
+
+                if self._awaits_download(job):
+                    job_prefix = f"{job_manifest['output_prefix']}{job['job_id']}/"
+                    if stream_results:
+                        job["result_file"] = f"s3://{bucket}/{job_prefix}"
                     else:
-                        results = {}
-                else:
-                    results = {}
-            else:
-                results = self.process_texts_individually(texts)
+                        job["result_file"] = self.download_batch_results(
+                            bucket, s3_prefix=job_prefix,
+                            output_file=f"downloaded_results_{job['job_id']}{RESULT_SUFFIX}")
+                        if not job["result_file"]:
+                            job["download_attempts"] = job.get("download_attempts", 0) + 1
+                    changed = True
+
+            if changed:
+                self._save_job_manifest(manifest_path, job_manifest)
+                interval = POLL_MIN_INTERVAL
+            if all(job["status"].upper() in TERMINAL_JOB_STATES for job in jobs) and not any(
+                    self._awaits_download(job) and job.get("download_attempts", 0) < RESULT_DOWNLOAD_ATTEMPTS
+                    for job in jobs):
+                break
+
+            running = sum(job["status"].upper() not in TERMINAL_JOB_STATES for job in jobs)
+            logger.info(f"{running}/{len(jobs)} jobs still running; next poll in {interval}s")
+            time.sleep(interval)
+            if not changed:
+                interval = min(POLL_MAX_INTERVAL, int(interval * 1.5))
+
+        undownloaded = [job["job_id"] for job in jobs if self._awaits_download(job)]
+        if undownloaded:
+            raise RuntimeError(f"Results of job(s) {', '.join(undownloaded)} could not be downloaded; "
+                               f"run again to resume from {manifest_path}")
+        return [job["result_file"] for job in jobs if job.get("result_file")]
+
+    @staticmethod
+    def _awaits_download(job: dict) -> bool:
+        return job["status"].upper() in SUCCESSFUL_JOB_STATES and not job.get("result_file")
+
+    def preflight_report(self, manifests: List[BatchInputManifest], profile: InstitutionProfile,
+                         batch: bool = True) -> Dict[str, Any]:
+        """
+        Log the estimated tokens and cost of the staged records before anything is submitted.
+
+        Input tokens are the local estimate of each record's static and patient prompt (batch
+        inference has no prompt caching; on-demand cache discounts are not applied, so that
+        estimate is an upper bound). Output tokens are the profile's expected output per record,
+        with its max_tokens per record as the ceiling. Costs use MODEL_PRICES for the model, at
+        BATCH_PRICE_FACTOR for batch jobs, and are None for models without a price. The report
+        is also added to the run summary.
+        """
+        records = sum(manifest.record_count for manifest in manifests)
+        report = {
+            "mode": "batch" if batch else "on_demand",
+            "records": records,
+            "input_tokens": sum(manifest.input_tokens for manifest in manifests),
+            "expected_output_tokens": records * profile.expected_output_tokens,
+            "max_output_tokens": records * profile.max_tokens,
+            "max_tokens": profile.max_tokens,
+            "trimmed_records": sum(len(manifest.trimmed_ids) for manifest in manifests),
+            "over_budget_records": sum(len(manifest.over_budget_ids) for manifest in manifests),
+            "estimated_cost_usd": None,
+            "max_cost_usd": None,
+        }
+        prices = MODEL_PRICES.get(self.llm_model_id)
+        if prices:
+            factor = BATCH_PRICE_FACTOR if batch else 1.0
+            for key, output_tokens in (("estimated_cost_usd", report["expected_output_tokens"]),
+                                       ("max_cost_usd", report["max_output_tokens"])):
+                report[key] = round(factor * (report["input_tokens"] * prices[0]
+                                              + output_tokens * prices[1]) / 1e6, 2)
+
+        cost = (f"estimated cost ${report['estimated_cost_usd']:.2f} (at most ${report['max_cost_usd']:.2f})"
+                if prices else f"no price known for {self.llm_model_id}")
+        logger.info(f"Pre-flight ({report['mode']}): {records} records, ~{report['input_tokens']} input tokens, "
+                    f"~{report['expected_output_tokens']} output tokens (max_tokens {profile.max_tokens}), {cost}")
+        if report["trimmed_records"] or report["over_budget_records"]:
+            logger.warning(f"Pre-flight: {report['trimmed_records']} prompts trimmed to fit the context window, "
+                           f"{report['over_budget_records']} records too large to send")
+        self.metrics.info["preflight"] = report
+        return report
+
+    def _record_job_times(self, job: dict) -> None:
+        """
+        Add a job that just reached a terminal state to the job_queue and job_run timers.
 
-            # all_file_results[key] = results
+        Start and end times are when the status change was observed, so they are accurate to
+        the polling interval; a job never seen InProgress counts as all queue time.
+        """
+        job["ended_at"] = time.time()
+        self.metrics.count("jobs", status=job["status"])
+        if job.get("submitted_at"):
+            started_at = job.get("started_at") or job["ended_at"]
+            self.metrics.add_time("job_queue", started_at - job["submitted_at"])
+            self.metrics.add_time("job_run", job["ended_at"] - started_at)
 
-        # return all_file_results
-        
-    def extract_and_clean_json(self, text: str) -> dict:
+    def process_batch_inference(self, input_bucket: str, input_prefix: str, output_prefix: str,
+                                       institution: str, config_path: str = "config.json",
+                                       manifest_path: str = JOB_MANIFEST_PATH,
+                                       stream_results: bool = False,
+                                       rerun_failures: bool = True) -> Dict[str, Any]:
         """
-        Attempts to robustly extract and clean a JSON object from a messy LLM string.
-        Handles wrapping, escape issues, and incomplete formatting.
+        Run the pipeline for every raw file under ``input_prefix`` and write one CSV per file.
+
+        The run's stage timers and counters (see PipelineMetrics) are exported to
+        RUN_SUMMARY_PATH and METRICS_PROM_PATH when it ends, also when it fails. Input files
+        that could not be processed are listed under ``failed_inputs`` in the summary (and in
+        the job manifest); the other files are still classified.
+
+        Returns:
+            The run summary.
         """
+        self.metrics = PipelineMetrics(institution=institution, input_bucket=input_bucket,
+                                       input_prefix=input_prefix, finished=False)
         try:
-            # Step 1: Try extracting from markdown block
-            match = re.search(r"```json\s*({.*?})\s*```", text, re.DOTALL)
-            if not match:
-                match = re.search(r"({.*})", text, re.DOTALL)
-
-            if not match:
-                raise ValueError("No JSON block found in model output.")
+            self._run_batch_inference(input_bucket, input_prefix, output_prefix, institution, config_path,
+                                      manifest_path, stream_results, rerun_failures)
+        finally:
+            run_id = self.metrics.info.get("run_id", "unknown")
+            summary = self.metrics.export(RUN_SUMMARY_PATH.format(run_id=run_id),
+                                          METRICS_PROM_PATH.format(run_id=run_id))
+            logger.info(f"Run {run_id} stage times (s): "
+                        + ", ".join(f"{stage}={seconds}" for stage, seconds in summary["stage_seconds"].items()))
+        return summary
+
+    def _run_batch_inference(self, input_bucket: str, input_prefix: str, output_prefix: str,
+                             institution: str, config_path: str, manifest_path: str,
+                             stream_results: bool, rerun_failures: bool) -> None:
+        job_manifest = self._load_job_manifest(manifest_path, input_bucket, input_prefix, institution)
+
+        record_map = None
+        if job_manifest:
+            logger.info(f"Resuming run {job_manifest['run_id']} from {manifest_path}")
+        else:
+            failed_files = {}
+            manifests = self.generate_jsonl_from_raw_json_files(
+                input_bucket=input_bucket,
+                input_prefix=input_prefix,
+                output_prefix="input/",  # Save JSONL to input/ folder
+                institution=institution,
+                config_path=config_path,
+                failed_files=failed_files
+            )
 
-            raw_json = match.group(1)
+            total_records = sum(manifest.record_count for manifest in manifests)
+            cached_records = sum(len(manifest.cached_ids) for manifest in manifests)
+            preclassified_records = sum(len(manifest.preclassified_ids) for manifest in manifests)
+            if cached_records or preclassified_records:
+                logger.info(f"{cached_records} records served from the result cache, {preclassified_records} "
+                            f"pre-classified from thresholds, {total_records} left for the model")
 
-            # Step 2: Clean up badly escaped characters
-            raw_json = raw_json.replace('\\"', '"')
-            raw_json = raw_json.replace('\\\\n', '\\n')
-            raw_json = raw_json.replace('\\n', '\n').replace('\\t', '\t')
+            self.preflight_report(manifests, get_institution_profile(config_path, institution),
+                                  batch=total_records >= BATCH_MIN_RECORDS)
 
-            # Remove non-printable characters
-            raw_json = re.sub(r'[\x00-\x1F\x7F]', '', raw_json)
+            run_id = str(int(time.time()))
+            shards, on_demand_file = [], None
+            try:
+                if total_records < BATCH_MIN_RECORDS:
+                    # Too few records across all files for a batch job
+                    on_demand_file, record_map = self.classify_on_demand(input_bucket, manifests, run_id)
+                else:
+                    shards, record_map = self.pack_batch_inputs(input_bucket, manifests, run_id=run_id)
+                    logger.info(f"Packed {total_records} records from {len(manifests)} files "
+                                f"into {len(shards)} batch jobs")
+            finally:
+                for manifest in manifests:
+                    manifest.close()
+
+            job_manifest = {
+                "run_id": run_id,
+                "input_bucket": input_bucket,
+                "input_prefix": input_prefix,
+                "output_prefix": output_prefix,
+                "institution": institution,
+                "record_map_key": f"input/packed/{run_id}/record_map.json",
+                "sidecar_keys": {manifest.source_key: manifest.sidecar_key for manifest in manifests},
+                "failed_inputs": failed_files,
+                "on_demand_file": on_demand_file,
+                "finished": False,
+                "jobs": self._new_jobs(run_id, shards)
+            }
+            self._save_job_manifest(manifest_path, job_manifest)
+
+        self.metrics.info["run_id"] = job_manifest["run_id"]
+        # Input files that produced no prompts; they get no CSV, and main() exits non-zero
+        self.metrics.info["failed_inputs"] = job_manifest.get("failed_inputs", {})
+        result_files = self.orchestrate_batch_jobs(job_manifest, manifest_path, stream_results=stream_results)
+        if job_manifest.get("on_demand_file"):
+            result_files.append(job_manifest["on_demand_file"])
+
+        if record_map is None:
+            body = self.s3_client.get_object(Bucket=input_bucket, Key=job_manifest["record_map_key"])["Body"]
+            record_map = {packed_id: tuple(source) for packed_id, source in json.loads(body.read()).items()}
+
+        # Write one CSV per original input file, joining report/results from the sidecars
+        # and filling in cached records; then re-run only the records that failed validation
+        with tempfile.TemporaryDirectory() as sidecar_dir:
+            sidecars = self.download_sidecars(input_bucket, job_manifest.get("sidecar_keys", {}), sidecar_dir)
+            try:
+                failures = {} if rerun_failures else None
+                csv_paths = self.packed_jsonl_to_csvs(result_files, institution=institution,
+                                                      record_map=record_map, config_path=config_path,
+                                                      sidecars=sidecars, failures=failures)
+                if failures:
+                    logger.info(f"{len(failures)} records failed parsing or validation; re-running only those")
+                    rerun_files, rerun_map = self.rerun_failed_records(
+                        job_manifest, failures, sidecars, get_institution_profile(config_path, institution),
+                        manifest_path=manifest_path, stream_results=stream_results)
+                    remaining = {}
+                    csv_paths.update(self.packed_jsonl_to_csvs(
+                        rerun_files, institution=institution, record_map=rerun_map, config_path=config_path,
+                        sidecars=sidecars, failures=remaining, fill_missing=False, merge_existing=True))
+                    logger.info(f"Re-run recovered {len(failures) - len(remaining)}/{len(failures)} records")
+                    if remaining:
+                        logger.warning(f"{len(remaining)} records still fail after the re-run; see the error logs")
+            finally:
+                for sidecar in sidecars.values():
+                    sidecar.close()
+        for source_key, csv_path in csv_paths.items():
+            logger.info(f"CSV generated for {source_key}: {csv_path}")
+
+        job_manifest["finished"] = True
+        self._save_job_manifest(manifest_path, job_manifest)
+        self.metrics.info["finished"] = True
+
+    def rerun_failed_records(self, job_manifest: dict, failures: Dict[Tuple[str, str], str],
+                             sidecars: Dict[str, RecordSidecar], profile: InstitutionProfile,
+                             manifest_path: str = JOB_MANIFEST_PATH,
+                             stream_results: bool = False) -> Tuple[List[str], Dict[str, Tuple[str, str]]]:
+        """
+        Classify again only the records listed in ``failures`` (source key, record ID -> reason).
+
+        Prompts are rebuilt from the sidecars, with a note naming what was wrong with the
+        previous output. Records whose output was truncated are sent with the model's output
+        limit (MODEL_MAX_OUTPUT_TOKENS) instead of the profile's max_tokens, with the prompt
+        budget adjusted to match. Fewer than BATCH_MIN_RECORDS records go on-demand; larger sets are
+        packed into shards under ``input/packed/<run_id>/`` and submitted as batch jobs tracked
+        in their own job manifest (``<manifest>_retry.json``). Returns the result files and
+        record map, for ``packed_jsonl_to_csvs`` with ``merge_existing``.
+        """
+        bucket = job_manifest["input_bucket"]
+        run_id = f"{job_manifest['run_id']}-retry"
+        retry_path = f"{os.path.splitext(manifest_path)[0]}_retry.json"
+
+        retry_manifest = self._load_job_manifest(retry_path, bucket, job_manifest["input_prefix"],
+                                                 job_manifest["institution"])
+        if retry_manifest and retry_manifest["run_id"] == run_id:
+            logger.info(f"Resuming re-run {run_id} from {retry_path}")
+        else:
+            preclassifier = AudiogramPreclassifier.from_profile(profile)
+            truncated_profile = replace(profile, max_tokens=max(profile.max_tokens, MODEL_MAX_OUTPUT_TOKENS))
+            manifests = {}
+            for (source_key, record_id), reason in sorted(failures.items()):
+                entry = sidecars[source_key].get(record_id) if source_key in sidecars else None
+                if entry is None:
+                    continue
+                manifest = manifests.get(source_key)
+                if manifest is None:
+                    manifest = manifests[source_key] = BatchInputManifest(
+                        source_key=source_key, s3_key=f"input/retry/{run_id}/{len(manifests):06d}.jsonl",
+                        static_prompt=profile.static_prompt, max_tokens=profile.max_tokens)
+                record_profile = truncated_profile if TRUNCATED_OUTPUT_REASON in reason else profile
+                hint = preclassifier.classify(entry["report"], entry["results"])[1] if preclassifier else ""
+                prompt, _ = self._fit_patient_prompt(entry["report"], entry["results"], hint, record_profile)
+                if prompt is None:
+                    continue
+                prompt += RERUN_PROMPT_NOTE.format(reason=reason)
+                manifest.add_record(record_id, self._build_model_input(profile.static_prompt, prompt,
+                                                                       max_tokens=record_profile.max_tokens))
+                manifest.prompts.append(prompt)
+                # On-demand calls use one limit per manifest
+                manifest.max_tokens = max(manifest.max_tokens, record_profile.max_tokens)
+            manifests = list(manifests.values())
+            total_records = sum(manifest.record_count for manifest in manifests)
 
-            # Step 3: Try loading with standard JSON
             try:
-                return json.loads(raw_json)
-            except json.JSONDecodeError as e:
-                # Step 4: Attempt partial fix by trimming to last closing brace
-                if raw_json.count("{") > raw_json.count("}"):
-                    raw_json += "}" * (raw_json.count("{") - raw_json.count("}"))
+                if total_records < BATCH_MIN_RECORDS:
+                    result_file, record_map = self.classify_on_demand(bucket, manifests, run_id)
+                    return [result_file], record_map
+                shards, _ = self.pack_batch_inputs(bucket, manifests, run_id=run_id)
+            finally:
+                for manifest in manifests:
+                    manifest.close()
+            retry_manifest = dict(job_manifest, run_id=run_id, record_map_key=f"input/packed/{run_id}/record_map.json",
+                                  on_demand_file=None, finished=False, jobs=self._new_jobs(run_id, shards))
+            self._save_job_manifest(retry_path, retry_manifest)
+
+        result_files = self.orchestrate_batch_jobs(retry_manifest, retry_path, stream_results=stream_results)
+        body = self.s3_client.get_object(Bucket=bucket, Key=retry_manifest["record_map_key"])["Body"]
+        record_map = {packed_id: tuple(source) for packed_id, source in json.loads(body.read()).items()}
+        retry_manifest["finished"] = True
+        self._save_job_manifest(retry_path, retry_manifest)
+        return result_files, record_map
+
+    def download_sidecars(self, bucket_name: str, sidecar_keys: Dict[str, str],
+                          local_dir: str) -> Dict[str, RecordSidecar]:
+        """Download the sidecar record manifest of each source file and index it by record ID."""
+        sidecars = {}
+        for i, (source_key, sidecar_key) in enumerate(sorted(sidecar_keys.items())):
+            if not sidecar_key:
+                continue
+            local_path = os.path.join(local_dir, f"{i:06d}{SIDECAR_SUFFIX}")
+            try:
+                self.s3_client.download_file(bucket_name, sidecar_key, local_path)
+            except ClientError as e:
+                logger.warning(f"Sidecar {sidecar_key} unavailable, report/results will be NULL: {e}")
+                continue
+            sidecars[source_key] = RecordSidecar(local_path)
+        return sidecars
 
-                try:
-                    return json.loads(raw_json)
-                except json.JSONDecodeError:
-                    # Step 5: Final fallback: ast.literal_eval (can handle single quotes, minor syntax issues)
-                    return ast.literal_eval(raw_json)
+    def extract_and_clean_json(self, text: str, repairs_out: Optional[List[str]] = None) -> dict:
+        """
+        Attempts to robustly extract and clean a JSON object from a messy LLM string.
+        Handles wrapping, escape issues, and incomplete formatting (see extract_json).
+        The names of the repairs applied are added to ``repairs_out`` if given.
+        """
+        parsed, repairs = extract_json(text)
+        if repairs:
+            logger.debug(f"Repaired model JSON: {', '.join(repairs)}")
+            for repair in repairs:
+                self.metrics.count("json_repairs", repair=repair)
+            if repairs_out is not None:
+                repairs_out.extend(repairs)
+        return parsed
+
+    def _cache_key(self, digest: str, profile: InstitutionProfile) -> str:
+        return ResultCache.key(digest, profile.version, self.llm_model_id)
+
+    @staticmethod
+    def _output_text(record: dict) -> str:
+        return record.get("modelOutput", {}).get("content", [{}])[0].get("text", "")
+
+    def _iter_csv_rows(self, jsonl_filename: str, profile: InstitutionProfile, f_log,
+                       lookup: Optional[Callable[[str], Optional[dict]]] = None,
+                       failures: Optional[Dict[str, str]] = None) -> Iterator[List[str]]:
+        """
+        Yield a CSV row per parseable record in a .jsonl.out file, logging failures to ``f_log``.
 
-        except Exception as e:
-            raise ValueError(f"JSON decode failed: {e}")
+        ``jsonl_filename`` may also be an ``s3://bucket/<output prefix><job id>/`` URI, whose
+        output parts are then streamed from S3 (see ``_open_result_lines``).
+
+        ``lookup`` maps a record ID to its sidecar entry, which supplies the report/results
+        columns and the key under which the output is stored in ``self.result_cache``;
+        without it they are parsed back out of the echoed prompt (outputs staged before
+        sidecars existed).
+
+        Every output is checked against the institution's valid values before it is cached;
+        invalid rows are logged and still yielded but never cached. With ``failures``, records
+        whose output is unparseable or invalid are also added to it (record ID -> reason).
+        """
+        with self._open_result_lines(jsonl_filename) as f_in:
+            for line_num, line in enumerate(f_in, 1):
+                if not line.strip():
+                    continue
+                try:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        record = json.loads(self._sanitize_line(line))
+                    self.metrics.count_usage(record.get("modelOutput", {}).get("usage"))
+                    entry = lookup(record.get("recordId")) if lookup else None
+                    problems = []
+                    row = self._build_csv_row(record, profile, line_num,
+                                              RecordSidecar.columns(entry) if lookup else None, problems)
+                    if problems and row:
+                        self.metrics.count("validation_failures")
+                    if problems:
+                        reason = "; ".join(problems)
+                        f_log.write(f"[Line {line_num}] Invalid output for {record.get('recordId')}: {reason}\n\n")
+                        if failures is not None and record.get("recordId"):
+                            failures[record["recordId"]] = reason
+                    if row:
+                        if entry and self.result_cache and not problems:
+                            self.result_cache.put(self._cache_key(entry["digest"], profile),
+                                                  self._output_text(record))
+                        self.metrics.count("records", stage="model_output")
+                        yield row
+                except Exception as e:
+                    self._log_parsing_error(f_log, line_num, line, e)
 
-    def jsonl_to_csv(self, jsonl_filename: str, institution: str, config_path: str = "config.json") -> str:
+    def _iter_cached_rows(self, sidecar: RecordSidecar, seen: set, profile: InstitutionProfile,
+                          f_log, failures: Optional[Dict[str, str]] = None) -> Iterator[List[str]]:
+        """
+        Yield CSV rows for sidecar records that had no fresh output: pre-classified records
+        from their stored output, the rest from the result cache. Records found in neither
+        are added to ``failures`` unless already listed there.
+        """
+        for record_id in sidecar:
+            if record_id in seen:
+                continue
+            entry = sidecar.get(record_id)
+            output = entry.get("preclassified")
+            if output is None and self.result_cache:
+                output = self.result_cache.get(self._cache_key(entry["digest"], profile))
+            if output is None and entry.get("over_budget"):
+                f_log.write(f"[{record_id}] Error: prompt exceeds the model's token budget, not classified\n\n")
+                continue
+            if output is None:
+                if entry.get("cached"):
+                    f_log.write(f"[{record_id}] Error: cached result no longer available\n\n")
+                if failures is not None:
+                    failures.setdefault(record_id, "no model output")
+                continue
+            record = {"recordId": record_id, "modelOutput": {"content": [{"text": output}]}}
+            row = self._build_csv_row(record, profile, entry["index"], RecordSidecar.columns(entry))
+            if row:
+                self.metrics.count("records", stage="preclassified_output" if entry.get("preclassified")
+                                   else "cached_output")
+                yield row
+
+    @contextmanager
+    def _open_result_lines(self, source: str) -> Iterator[Iterator[str]]:
+        """Open batch results as lines: a local .jsonl.out file, or a job's output prefix as an s3:// URI."""
+        if source.startswith("s3://"):
+            bucket_name, _, s3_prefix = source[len("s3://"):].partition("/")
+            yield self.iter_batch_results(bucket_name, s3_prefix)
+        else:
+            with open(source, "r", encoding="utf-8") as f:
+                yield f
+
+    @staticmethod
+    def _result_basename(source: str) -> str:
+        """Local path stem for files derived from a results source (CSV, error log)."""
+        if source.startswith("s3://"):
+            return f"streamed_results_{source.rstrip('/').split('/')[-1]}"
+        return source[:-len(RESULT_SUFFIX)] if source.endswith(RESULT_SUFFIX) else source
+
+    @_timed_stage("csv_conversion")
+    def jsonl_to_csv(self, jsonl_filename: str, institution: str, config_path: str = "config.json",
+                     sidecar_path: Optional[str] = None) -> str:
         """
         Convert a .jsonl.out file to a CSV file based on institution-specific headers and mappings.
 
         Args:
-            jsonl_filename: Path to the .jsonl.out file.
+            jsonl_filename: Path to the .jsonl.out file, or a job's s3:// output prefix to stream.
             institution: Institution name used to load config.
             config_path: Path to the config JSON file.
+            sidecar_path: Local copy of the staged input's sidecar record manifest, if available.
 
         Returns:
             Path to the generated CSV file.
         """
-        config = self._load_config(config_path, institution)
-        headers = config["csv_headers"]
-        csv_filename = jsonl_filename.replace(".jsonl.out", f"_{institution.lower()}_output.csv")
-        error_log = jsonl_filename.replace(".jsonl.out", f"_{institution.lower()}_error_log.txt")
+        profile = get_institution_profile(config_path, institution)
+        basename = self._result_basename(jsonl_filename)
+        csv_filename = f"{basename}_{institution.lower()}_output.csv"
+        error_log = f"{basename}_{institution.lower()}_error_log.txt"
 
-        rows = []
-        with open(jsonl_filename, "r", encoding="utf-8") as f_in, open(error_log, "w", encoding="utf-8") as f_log:
-            for line_num, line in enumerate(f_in, 1):
-                try:
-                    record = json.loads(self._sanitize_line(line))
-                    row = self._build_csv_row(record, headers, config, line_num)
-                    if row:
-                        rows.append(row)
-                except Exception as e:
-                    self._log_parsing_error(f_log, line_num, line, e)
+        sidecar = RecordSidecar(sidecar_path) if sidecar_path else None
+        writer = SortedCsvWriter(csv_filename, profile.csv_headers)
+        try:
+            with open(error_log, "w", encoding="utf-8") as f_log:
+                seen = set()
+                for row in self._iter_csv_rows(jsonl_filename, profile, f_log,
+                                               sidecar.get if sidecar else None):
+                    seen.add(row[0])
+                    writer.add(row)
+                if sidecar:
+                    for row in self._iter_cached_rows(sidecar, seen, profile, f_log):
+                        writer.add(row)
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            if sidecar:
+                sidecar.close()
 
-        self._write_csv(csv_filename, headers, rows)
-        logger.info(f"CSV written to: {csv_filename}")
+        logger.info(f"CSV written to: {csv_filename} ({writer.rows_written} rows)")
         return csv_filename
-    
-    def _load_config(self, path: str, institution: str) -> dict:
-        with open(path, "r", encoding="utf-8") as f:
-            config = json.load(f)
-        if institution not in config["templates"]:
-            raise ValueError(f"Institution '{institution}' not found in config")
-        return config["templates"][institution]
+
+    @_timed_stage("csv_conversion")
+    def packed_jsonl_to_csvs(self, jsonl_filenames: List[str], institution: str,
+                             record_map: Dict[str, Tuple[str, str]], config_path: str = "config.json",
+                             output_dir: str = ".",
+                             sidecars: Optional[Dict[str, RecordSidecar]] = None,
+                             failures: Optional[Dict[Tuple[str, str], str]] = None,
+                             fill_missing: bool = True, merge_existing: bool = False) -> Dict[str, str]:
+        """
+        Convert the outputs of packed batch jobs back into one CSV per original input file.
+
+        Rows are reordered by packed record number (which follows source file order) in a
+        bounded buffer, so each source's CSV is written in one contiguous stretch and only
+        one output file is open at a time. Sidecar records without a fresh output are then
+        filled in from their pre-classified output or ``self.result_cache`` (merged into
+        order when each CSV is closed).
+
+        Args:
+            jsonl_filenames: Paths to the .jsonl.out files of every shard, or s3:// output prefixes to stream.
+            institution: Institution name used to load config.
+            record_map: Packed record ID -> (source file key, original record ID).
+            config_path: Path to the config JSON file.
+            output_dir: Directory the CSV files are written to.
+            sidecars: Source file key -> its sidecar record manifest, for the report/results columns.
+            failures: If given, validate outputs and collect (source file key, original record ID)
+                -> reason for every unparseable, invalid or missing record.
+            fill_missing: Fill in sidecar records without a fresh output (off for re-runs).
+            merge_existing: Merge into CSVs already on disk, replacing rows with the same record ID.
+
+        Returns:
+            Mapping of source file key to the generated CSV path.
+        """
+        profile = get_institution_profile(config_path, institution)
+        lookup = None
+        if sidecars is not None:
+            def lookup(packed_id: str) -> Optional[dict]:
+                source_key, record_id = record_map.get(packed_id, (None, None))
+                sidecar = sidecars.get(source_key)
+                return sidecar.get(record_id) if sidecar else None
+        seen = {}
+
+        def mapped_rows() -> Iterator[Tuple[int, str, List[str]]]:
+            for jsonl_filename in jsonl_filenames:
+                error_log = f"{self._result_basename(jsonl_filename)}_{institution.lower()}_error_log.txt"
+                file_failures = {} if failures is not None else None
+                with open(error_log, "w", encoding="utf-8") as f_log:
+                    for row in self._iter_csv_rows(jsonl_filename, profile, f_log, lookup, file_failures):
+                        if row[0] not in record_map:
+                            logger.warning(f"Record {row[0]} in {jsonl_filename} is not in the record map, skipping")
+                            continue
+                        packed_number = int(row[0][len(PACKED_RECORD_PREFIX):])
+                        source_key, row[0] = record_map[row[0]]
+                        seen.setdefault(source_key, set()).add(row[0])
+                        yield packed_number, source_key, row
+                for packed_id, reason in (file_failures or {}).items():
+                    if packed_id in record_map:
+                        failures[tuple(record_map[packed_id])] = reason
+
+        writers = {}
+        current = None
+
+        def add(source_key: str, row: List[str]) -> None:
+            nonlocal current
+            writer = writers.get(source_key)
+            if writer is None:
+                source_name = source_key.split("/")[-1].replace(".json", "")
+                csv_filename = os.path.join(output_dir, f"{source_name}_{institution.lower()}_output.csv")
+                writer = writers[source_key] = SortedCsvWriter(csv_filename, profile.csv_headers, buffer_size=0,
+                                                               merge_existing=merge_existing)
+            if current is not writer:
+                if current:
+                    current.release()
+                current = writer
+            writer.add(row)
+
+        csv_paths = {}
+        try:
+            for _, source_key, row in _reorder(mapped_rows(), key=lambda item: item[0],
+                                               buffer_size=CSV_REORDER_BUFFER_ROWS):
+                add(source_key, row)
+
+            if sidecars and fill_missing:
+                error_log = os.path.join(output_dir, f"cached_results_{institution.lower()}_error_log.txt")
+                with open(error_log, "w", encoding="utf-8") as f_log:
+                    for source_key, sidecar in sidecars.items():
+                        source_failures = {} if failures is not None else None
+                        for row in self._iter_cached_rows(sidecar, seen.get(source_key, set()), profile, f_log,
+                                                          source_failures):
+                            add(source_key, row)
+                        for record_id, reason in (source_failures or {}).items():
+                            failures.setdefault((source_key, record_id), reason)
+
+            for source_key, writer in writers.items():
+                writer.close()
+                logger.info(f"CSV written to: {writer.path} ({writer.rows_written} rows)")
+                csv_paths[source_key] = writer.path
+        except BaseException:
+            # CSVs closed before the failure are complete and kept
+            for source_key, writer in writers.items():
+                if source_key not in csv_paths:
+                    writer.abort()
+            raise
+        return csv_paths
 
     def _sanitize_line(self, line: str) -> str:
         clean = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', line)
@@ -619,27 +3081,47 @@ class BedrockBatch:
         return clean
 
     def _log_parsing_error(self, log_file, line_num: int, raw_line: str, error: Exception):
+        self.metrics.count("parse_failures", kind="line")
         log_file.write(f"[Line {line_num}] Error: {error}\n")
         log_file.write(f"Raw content: {raw_line}\n\n")
 
-    def _build_csv_row(self, record: dict, headers: List[str], config: dict, line_number: int) -> Optional[List[str]]:
+    def _build_csv_row(self, record: dict, profile: InstitutionProfile, line_number: int,
+                       sections: Optional[Tuple[str, str]] = None,
+                       problems: Optional[List[str]] = None) -> Optional[List[str]]:
+        """
+        Build a record's CSV row; with ``problems``, parse and validation failures are appended to it.
+
+        An output that stopped at max_tokens, or whose JSON had to be closed by the "truncated"
+        repair, is a failure (TRUNCATED_OUTPUT_REASON) even if what remains is valid.
+        """
         patient_id = record.get("recordId", f"PAT{str(line_number).zfill(8)}")
-        raw_report, test_results = self._extract_sections(record)
+        raw_report, test_results = sections if sections else self._extract_sections(record)
+        truncated = record.get("modelOutput", {}).get("stop_reason") == "max_tokens"
 
+        repairs = []
         try:
-            raw_output = record.get("modelOutput", {}).get("content", [{}])[0].get("text", "")
-            clean_output = self._sanitize_line(raw_output)
-            attributes_json = self.extract_and_clean_json(clean_output)
+            raw_output = self._output_text(record)
+            attributes_json = self.extract_and_clean_json(raw_output, repairs)
         except Exception as e:
             logger.warning(f"Failed to extract JSON from record {patient_id}: {e}")
+            self.metrics.count("parse_failures", kind="output")
+            if problems is not None:
+                problems.append(f"unparseable output: {e}")
+                if truncated:
+                    self.metrics.count("truncated_outputs")
+                    problems.append(TRUNCATED_OUTPUT_REASON)
             return None
 
         attributes = attributes_json.get("Attributes", attributes_json)
+        if problems is not None:
+            if truncated or "truncated" in repairs:
+                self.metrics.count("truncated_outputs")
+                problems.append(TRUNCATED_OUTPUT_REASON)
+            problems.extend(profile.validate(attributes))
 
         row = [patient_id, raw_report, test_results]
-        for header in headers[3:]:  # Skip first 3 (ID, report, results)
-            value = self._extract_value_by_header(attributes, header)
-            row.append(value)
+        for path in profile.header_paths:
+            row.append(self._extract_value_by_path(attributes, path))
         return row
 
     def _extract_sections(self, record: dict) -> tuple[str, str]:
@@ -662,57 +3144,57 @@ class BedrockBatch:
         except IndexError:
             return "NULL"
 
-    def _extract_value_by_header(self, attributes: dict, header: str) -> str:
-        path = self._map_header_to_path(header)
-        parts = path.split(">")
+    def _extract_value_by_path(self, attributes: dict, path: Tuple[str, ...]) -> str:
         val = attributes
-        for part in parts:
+        for part in path:
             val = val.get(part, "") if isinstance(val, dict) else ""
         if isinstance(val, list):
             return ", ".join(map(str, val))
         return val if isinstance(val, str) else json.dumps(val)
 
-    def _map_header_to_path(self, header: str) -> str:
-        if "Left Ear" in header:
-            return f"Hearing Type>Left Ear>{header.split('Left Ear ')[1]}"
-        elif "Right Ear" in header:
-            return f"Hearing Type>Right Ear>{header.split('Right Ear ')[1]}"
-        elif "Tier One" in header:
-            return "Known Hearing Loss Risk Indicators>Risk Factors>Tier One"
-        elif "Tier Two" in header:
-            return "Known Hearing Loss Risk Indicators>Risk Factors>Tier Two"
-        elif header == "Known Hearing Loss Risk":
-            return "Known Hearing Loss Risk Indicators>Known Hearing Loss Risk"
-        elif header == "Reasoning":
-            return "Reasoning"
-        return header
-
-    def _write_csv(self, path: str, headers: List[str], rows: List[List[str]]):
-        rows_sorted = sorted(rows, key=lambda r: int(re.search(r"PAT(\d+)", r[0]).group(1)) if re.search(r"PAT(\d+)", r[0]) else float('inf'))
-        with open(path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(headers)
-            for row in rows_sorted:
-                writer.writerow(row)
-
 def main():
+    parser = argparse.ArgumentParser(description="Classify audiology reports with Bedrock batch inference.")
+    parser.add_argument("--profile", action="store_true",
+                        help="sample the pipeline stages and write per-stage collapsed-stack profiles; "
+                             f"lowers the interpreter switch interval to {PROFILE_SWITCH_INTERVAL * 1e6:g}us, "
+                             "which slows every thread, so timings of a profiled run are not representative")
+    parser.add_argument("--profile-dir", default=".", help="directory for the profile_<stage>.collapsed files")
+    parser.add_argument("--profile-interval", type=float, default=PROFILE_INTERVAL, help="sampling interval (s)")
+    parser.add_argument("--profile-top", type=int, default=PROFILE_TOP_N, help="hot functions listed per stage")
+    args = parser.parse_args()
+
     input_bucket = "pallavi-bedrock-batch-inference"
     input_prefix = "meei-deidentidfied-data-raw/"
     output_prefix = "output/"
     institution = "Redcap"
     config_path = "config.json"
-    local_output_dir = "batch_inputs"
 
-    processor = BedrockBatch(region="us-west-2")
+    processor = BedrockBatch(region="us-west-2", result_cache=ResultCache(RESULT_CACHE_PATH))
 
-    results = processor.process_batch_inference(
-        input_bucket=input_bucket,
-        input_prefix=input_prefix,
-        output_prefix=output_prefix,
-        institution=institution,
-        config_path=config_path,
-        local_output_dir=local_output_dir
-    )
+    profiler = StageProfiler(args.profile_interval) if args.profile else None
+    if profiler:
+        profiler.instrument(processor)
+        profiler.start()
+    try:
+        results = processor.process_batch_inference(
+            input_bucket=input_bucket,
+            input_prefix=input_prefix,
+            output_prefix=output_prefix,
+            institution=institution,
+            config_path=config_path
+        )
+    finally:
+        if profiler:
+            profiler.stop()
+            os.makedirs(args.profile_dir, exist_ok=True)
+            for path in profiler.write(args.profile_dir):
+                logger.info(f"Stage profile written to {path}")
+            print("\n=== HOT FUNCTIONS BY STAGE ===\n" + profiler.report(args.profile_top))
+
+    if results.get("failed_inputs"):
+        for file_key, error in results["failed_inputs"].items():
+            logger.error(f"No CSV for {file_key}: {error}")
+        sys.exit(f"{len(results['failed_inputs'])} input files failed; see the run summary")
 
     print("\n=== BATCH INFERENCE COMPLETED - CSV CREATED ===")
     
@@ -0,0 +1,158 @@
+"""
+Micro-benchmark: single-pass extract_json vs. the previous regex-based extractor.
+
+Runs both extractors over the model outputs in one or more .jsonl.out files and
+reports per-call latency, success counts and which repairs the new extractor applied.
+Without input files, a synthetic set of clean, messy and pathological outputs is used.
+
+Usage:
+    python benchmarks/extract_json_bench.py downloaded_results_*.jsonl.out
+    python benchmarks/extract_json_bench.py --synthetic --repeat 5
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from automated_aud_batch import extract_json  # noqa: E402
+
+
+def legacy_sanitize_line(line: str) -> str:
+    """BedrockBatch._sanitize_line as it was applied to every model output."""
+    clean = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', line)
+    clean = re.sub(r'\\(?![btnfr"\\/])', r'\\\\', clean)
+    return clean
+
+
+def legacy_extract_and_clean_json(text: str) -> dict:
+    """The regex-based extractor that extract_json replaced, kept verbatim for comparison."""
+    try:
+        match = re.search(r"```json\s*({.*?})\s*```", text, re.DOTALL)
+        if not match:
+            match = re.search(r"({.*})", text, re.DOTALL)
+
+        if not match:
+            raise ValueError("No JSON block found in model output.")
+
+        raw_json = match.group(1)
+
+        raw_json = raw_json.replace('\\"', '"')
+        raw_json = raw_json.replace('\\\\n', '\\n')
+        raw_json = raw_json.replace('\\n', '\n').replace('\\t', '\t')
+
+        raw_json = re.sub(r'[\x00-\x1F\x7F]', '', raw_json)
+
+        try:
+            return json.loads(raw_json)
+        except json.JSONDecodeError:
+            if raw_json.count("{") > raw_json.count("}"):
+                raw_json += "}" * (raw_json.count("{") - raw_json.count("}"))
+
+            try:
+                return json.loads(raw_json)
+            except json.JSONDecodeError:
+                return ast.literal_eval(raw_json)
+
+    except Exception as e:
+        raise ValueError(f"JSON decode failed: {e}")
+
+
+def load_outputs(paths: List[str]) -> List[str]:
+    """Collect modelOutput texts from .jsonl.out files."""
+    texts = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    record = json.loads(legacy_sanitize_line(line))
+                content = record.get("modelOutput", {}).get("content", [{}])
+                if content:
+                    texts.append(content[0].get("text", ""))
+    return texts
+
+
+def synthetic_outputs() -> List[str]:
+    """Clean, messy and pathological model outputs shaped like real classifications."""
+    attributes = {
+        "formtype": "Redcap",
+        "Attributes": {
+            "Hearing Type": {
+                "Left Ear": {"Type": "Sensorineural", "Degree": "Mild (26-40 dB HL)"},
+                "Right Ear": {"Type": "No hearing loss", "Degree": "No hearing loss"}
+            },
+            "Known Hearing Loss Risk Indicators": {
+                "Known Hearing Loss Risk": "Yes",
+                "Risk Factors": {"Tier One": ["cCMV"], "Tier Two": []}
+            },
+            "Reasoning": "Left Ear: thresholds of 30-40 dB HL at 1k-4k Hz (guideline #9a). " * 20
+        }
+    }
+    clean = json.dumps(attributes, indent=2)
+    chain_of_thought = "Let me reason about each ear step by step. " * 400
+    return [
+        clean,
+        f"```json\n{clean}\n```",
+        f"{chain_of_thought}\n```json\n{clean}\n```",
+        clean.replace('"Yes",', '"Yes",\n'),
+        clean[:-40],                                  # truncated
+        clean.replace('": "', "\": 'x\\d y', \"_\": \"", 1),  # invalid escape
+        chain_of_thought + "{ unterminated prose " * 200,   # no JSON at all
+    ]
+
+
+def bench(name: str, fn: Callable[[str], object], texts: List[str], repeat: int) -> dict:
+    ok = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        ok = 0
+        for text in texts:
+            try:
+                fn(text)
+                ok += 1
+            except ValueError:
+                pass
+    elapsed = time.perf_counter() - start
+    calls = len(texts) * repeat
+    return {"extractor": name, "parsed": ok, "total": len(texts),
+            "us_per_call": round(elapsed / calls * 1e6, 1) if calls else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help=".jsonl.out files to take model outputs from")
+    parser.add_argument("--synthetic", action="store_true", help="use generated outputs instead of files")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the sample set")
+    args = parser.parse_args()
+
+    texts = synthetic_outputs() if args.synthetic or not args.files else load_outputs(args.files)
+    print(f"{len(texts)} model outputs, {args.repeat} passes")
+
+    results = [
+        bench("legacy (sanitize + regex)", lambda t: legacy_extract_and_clean_json(legacy_sanitize_line(t)),
+              texts, args.repeat),
+        bench("extract_json", extract_json, texts, args.repeat),
+    ]
+    for result in results:
+        print(f"  {result['extractor']:<28} {result['parsed']:>6}/{result['total']} parsed  "
+              f"{result['us_per_call']:>10} us/call")
+
+    repairs = Counter()
+    for text in texts:
+        try:
+            repairs.update(extract_json(text)[1] or ("none",))
+        except ValueError:
+            repairs["failed"] += 1
+    print("  repairs applied by extract_json: " + ", ".join(f"{k}={v}" for k, v in repairs.most_common()))
+
+
+if __name__ == "__main__":
+    main()
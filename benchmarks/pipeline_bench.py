@@ -0,0 +1,261 @@
+"""
+Offline load test: drive BedrockBatch end to end against local S3/Bedrock stand-ins.
+
+Synthetic pediatric reports and audiograms (benchmarks/synthetic.py) are uploaded to a local
+S3 and pushed through the pipeline stages, each timed separately:
+
+    generation   generate_jsonl_from_raw_json_files (prompts, sidecars, local input spools)
+    upload       pack_batch_inputs (batch-job shards written from the spools)
+    dispatch     orchestrate_batch_jobs (job submission and polling; stub jobs run the model)
+    download     download_batch_results for every job
+    jsonl_to_csv packed_jsonl_to_csvs, joined on the downloaded sidecars
+    on_demand    process_texts_individually against the throttling runtime (--on-demand-records)
+
+Records/s and peak traced Python memory (tracemalloc) are reported per stage and saved as JSON
+with the parameters and stand-in counters, so runs of different versions can be compared with
+--compare. tracemalloc slows allocation-heavy stages; use --no-memory for timing-only runs.
+--profile DIR samples the BedrockBatch stages with StageProfiler and writes their
+collapsed-stack profiles to DIR (best combined with --no-memory). The profiler lowers the
+interpreter switch interval, which slows every thread, so do not compare the timings of a
+profiled run.
+
+Usage:
+    python benchmarks/pipeline_bench.py --records 5000 --files 10
+    python benchmarks/pipeline_bench.py --model-latency-ms 500 --throttle-rate 0.2 --on-demand-records 200
+    python benchmarks/pipeline_bench.py --compare benchmarks/results/pipeline_20250101T000000Z.json
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, Tuple
+from unittest import mock
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import automated_aud_batch as aud  # noqa: E402
+from stubs import LocalAws, StubModel  # noqa: E402
+from synthetic import generate_files, generate_patients  # noqa: E402
+
+BUCKET = "bench-bucket"
+RAW_PREFIX = "raw/"
+OUTPUT_PREFIX = "output/"
+
+
+def measure(name: str, records: int, fn: Callable[[], object], track_memory: bool) -> Tuple[object, dict]:
+    """Run one stage, returning its result and its records/s and peak memory."""
+    gc.collect()
+    if track_memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    stats = {
+        "records": records,
+        "seconds": round(elapsed, 4),
+        "records_per_second": round(records / elapsed, 1) if elapsed > 0 else None,
+    }
+    if track_memory:
+        stats["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+    print(f"  {name:<13} {records:>8} records  {stats['seconds']:>9.3f}s  "
+          f"{stats['records_per_second'] or 0:>10.1f} rec/s"
+          + (f"  {stats['peak_memory_mb']:>8.1f} MB peak" if track_memory else ""))
+    return result, stats
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(["git", "-C", REPO_DIR, "describe", "--always", "--dirty"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args) -> dict:
+    config_path = os.path.abspath(args.config)
+    profile = aud.get_institution_profile(config_path, args.institution)
+    model = StubModel(profile, output_chars=args.output_chars, invalid_rate=args.invalid_rate)
+    aws = LocalAws(model, s3_latency=args.s3_latency_ms / 1000,
+                   s3_bytes_per_second=args.s3_mbps * 1e6 if args.s3_mbps else None,
+                   model_latency=args.model_latency_ms / 1000, throttle_rate=args.throttle_rate,
+                   job_seconds=args.job_seconds, control_latency=args.control_latency_ms / 1000,
+                   seed=args.seed)
+
+    for name, patients in generate_files(args.records, args.files, args.seed, args.normal_fraction).items():
+        aws.s3.put_object(Bucket=BUCKET, Key=f"{RAW_PREFIX}{name}", Body=json.dumps(patients))
+    aws.s3.requests = aws.s3.bytes_in = 0
+
+    stages = {}
+    with mock.patch.object(aud.boto3, "Session", aws.session), \
+            mock.patch.object(aud, "POLL_MIN_INTERVAL", args.poll_interval), \
+            tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        batch = aud.BedrockBatch(max_concurrent_requests=args.concurrency)
+        batch.throttle_base_delay = args.backoff_base
+        profiler = aud.StageProfiler(args.profile_interval) if args.profile else None
+        if profiler:
+            profiler.instrument(batch)
+            profiler.start()
+        track = not args.no_memory
+        if track:
+            tracemalloc.start()
+
+        manifests, stages["generation"] = measure(
+            "generation", args.records,
+            lambda: batch.generate_jsonl_from_raw_json_files(BUCKET, RAW_PREFIX, "input/", args.institution,
+                                                             config_path=config_path,
+                                                             preclassify=not args.no_preclassify),
+            track)
+        model_records = sum(manifest.record_count for manifest in manifests)
+
+        run_id = "bench"
+        (shards, record_map), stages["upload"] = measure(
+            "upload", model_records, lambda: batch.pack_batch_inputs(BUCKET, manifests, run_id=run_id), track)
+
+        job_manifest = {"run_id": run_id, "input_bucket": BUCKET, "output_prefix": OUTPUT_PREFIX,
+                        "jobs": batch._new_jobs(run_id, shards)}
+        _, stages["dispatch"] = measure(
+            "dispatch", model_records,
+            lambda: batch.orchestrate_batch_jobs(job_manifest, os.path.join(work_dir, "jobs.json"),
+                                                 stream_results=True),
+            track)
+
+        result_files, stages["download"] = measure(
+            "download", model_records,
+            lambda: [batch.download_batch_results(BUCKET, s3_prefix=f"{OUTPUT_PREFIX}{job['job_id']}/",
+                                                  output_file=f"results_{job['job_id']}{aud.RESULT_SUFFIX}")
+                     for job in job_manifest["jobs"]],
+            track)
+
+        sidecars = batch.download_sidecars(BUCKET, {m.source_key: m.sidecar_key for m in manifests}, work_dir)
+        failures = {}
+        try:
+            _, stages["jsonl_to_csv"] = measure(
+                "jsonl_to_csv", args.records,
+                lambda: batch.packed_jsonl_to_csvs(result_files, args.institution, record_map, config_path,
+                                                   output_dir=work_dir, sidecars=sidecars, failures=failures),
+                track)
+        finally:
+            for sidecar in sidecars.values():
+                sidecar.close()
+
+        if args.on_demand_records:
+            prompts = [batch._build_patient_prompt(*batch._patient_fields(patient))
+                       for patient in generate_patients(args.on_demand_records, args.seed + 1, args.normal_fraction)]
+            _, stages["on_demand"] = measure(
+                "on_demand", len(prompts),
+                lambda: batch.process_texts_individually(prompts, static_prompt=profile.static_prompt,
+                                                         max_tokens=profile.max_tokens), track)
+
+        if track:
+            tracemalloc.stop()
+        os.chdir(REPO_DIR)
+        if profiler:
+            profiler.stop()
+            os.makedirs(args.profile, exist_ok=True)
+            profiler.write(args.profile)
+            print(profiler.report())
+
+    return {
+        "benchmark": "pipeline",
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": vars(args),
+        "stages": stages,
+        "summary": {
+            "records": args.records,
+            "model_records": model_records,
+            "batch_jobs": len(shards),
+            "validation_failures": len(failures),
+            "total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 4),
+        },
+        "counters": aws.counters(),
+        "pipeline_metrics": batch.metrics.summary(),
+    }
+
+
+def compare(current: dict, baseline_path: str) -> None:
+    """Print the records/s change of every stage against a saved run."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nvs. {baseline_path} ({baseline.get('version')}, {baseline.get('timestamp')}):")
+    for name, stage in current["stages"].items():
+        before = baseline.get("stages", {}).get(name, {}).get("records_per_second")
+        after = stage.get("records_per_second")
+        if before and after:
+            print(f"  {name:<13} {before:>10.1f} -> {after:>10.1f} rec/s  ({(after - before) / before:+.1%})")
+        else:
+            print(f"  {name:<13} no baseline")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000, help="synthetic patients in the run")
+    parser.add_argument("--files", type=int, default=4, help="raw export files the patients are split across")
+    parser.add_argument("--institution", default="MassEyeAndEar", help="institution in config.json")
+    parser.add_argument("--config", default=os.path.join(REPO_DIR, "config.json"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--normal-fraction", type=float, default=0.3,
+                        help="share of ears generated with normal hearing")
+    parser.add_argument("--no-preclassify", action="store_true", help="send every record to the model")
+    parser.add_argument("--output-chars", type=int, default=1200, help="reasoning length of stub answers")
+    parser.add_argument("--invalid-rate", type=float, default=0.02,
+                        help="share of stub answers with a value outside the valid values")
+    parser.add_argument("--s3-latency-ms", type=float, default=5.0, help="latency of every S3 request")
+    parser.add_argument("--s3-mbps", type=float, default=0.0, help="S3 bandwidth limit in MB/s (0: unlimited)")
+    parser.add_argument("--control-latency-ms", type=float, default=50.0,
+                        help="latency of Bedrock job create/get calls")
+    parser.add_argument("--job-seconds", type=float, default=0.0, help="time a stub batch job stays InProgress")
+    parser.add_argument("--poll-interval", type=int, default=1, help="replaces POLL_MIN_INTERVAL")
+    parser.add_argument("--model-latency-ms", type=float, default=300.0, help="latency of every invoke_model")
+    parser.add_argument("--throttle-rate", type=float, default=0.1, help="share of invoke_model calls throttled")
+    parser.add_argument("--backoff-base", type=float, default=0.1,
+                        help="throttle_base_delay for the run (the pipeline default is 1s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="max_concurrent_requests for on-demand calls")
+    parser.add_argument("--on-demand-records", type=int, default=50, help="records for the on-demand stage (0: skip)")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc peak memory tracking")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write per-stage collapsed-stack profiles to DIR (slows every thread; "
+                             "timings are not comparable)")
+    parser.add_argument("--profile-interval", type=float, default=aud.PROFILE_INTERVAL,
+                        help="profiler sampling interval (s)")
+    parser.add_argument("--output", help="result JSON path (default: benchmarks/results/pipeline_<time>.json)")
+    parser.add_argument("--compare", help="earlier result JSON to compare records/s against")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's INFO logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{args.records} records in {args.files} files, institution {args.institution}")
+    result = run(args)
+    summary = result["summary"]
+    print(f"  {summary['model_records']} sent to the model in {summary['batch_jobs']} jobs, "
+          f"{summary['validation_failures']} failed validation, {summary['total_seconds']:.2f}s total")
+
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"pipeline_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+In-process stand-ins for the S3, Bedrock, Bedrock Runtime, IAM and STS clients used by BedrockBatch.
+
+They implement only the calls the pipeline makes, with configurable per-request latency,
+S3 bandwidth and Bedrock Runtime throttling, so the pipeline can be driven end to end without
+AWS credentials or cost. Batch jobs run their records through StubModel when they are created
+and report ``InProgress`` until ``job_seconds`` have passed.
+
+Install them with ``LocalAws(...).session`` in place of ``boto3.Session``.
+"""
+import io
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+
+def _client_error(code: str, message: str, operation: str, status: int = 400) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": message},
+                        "ResponseMetadata": {"HTTPStatusCode": status}}, operation)
+
+
+def _split_s3_uri(uri: str) -> Tuple[str, str]:
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+
+class StreamingBody(io.BytesIO):
+    """BytesIO with the ``iter_lines`` of botocore's StreamingBody."""
+
+    def iter_lines(self, chunk_size: int = 1024, keepends: bool = False):
+        for line in self.getvalue().splitlines(keepends):
+            yield line
+
+
+class LocalS3:
+    """Dict-backed S3 with a fixed latency per request and an optional bandwidth limit."""
+
+    def __init__(self, latency: float = 0.0, bytes_per_second: Optional[float] = None):
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.objects: Dict[Tuple[str, str], bytes] = {}
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def _wait(self, size: int = 0, inbound: bool = True) -> None:
+        with self._lock:
+            self.requests += 1
+            if inbound:
+                self.bytes_in += size
+            else:
+                self.bytes_out += size
+        delay = self.latency + (size / self.bytes_per_second if self.bytes_per_second else 0.0)
+        if delay:
+            time.sleep(delay)
+
+    def _get(self, bucket: str, key: str, operation: str) -> bytes:
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise _client_error("NoSuchKey", f"The specified key does not exist: {key}", operation, 404)
+
+    def head_bucket(self, Bucket):
+        self._wait()
+        return {}
+
+    def create_bucket(self, Bucket, **kwargs):
+        self._wait()
+        return {}
+
+    def get_waiter(self, name):
+        class Waiter:
+            def wait(self, **kwargs):
+                pass
+        return Waiter()
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        data = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        self._wait(len(data))
+        self.objects[(Bucket, Key)] = data
+        return {"ETag": f'"{zlib.crc32(data):08x}"'}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, Callback=None):
+        chunks = []
+        for chunk in iter(lambda: Fileobj.read(8 * 1024 * 1024), b""):
+            chunks.append(chunk)
+        self.put_object(Bucket=Bucket, Key=Key, Body=b"".join(chunks))
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None, Callback=None):
+        with open(Filename, "rb") as f:
+            self.upload_fileobj(f, Bucket, Key)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data = self._get(Bucket, Key, "GetObject")
+        if Range:
+            start, _, end = Range[len("bytes="):].partition("-")
+            data = data[int(start):int(end) + 1]
+        self._wait(len(data), inbound=False)
+        return {"Body": StreamingBody(data), "ContentLength": len(data),
+                "ETag": f'"{zlib.crc32(data):08x}"'}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data = self._get(Bucket, Key, "HeadObject")
+        self._wait()
+        return {"ContentLength": len(data), "ETag": f'"{zlib.crc32(data):08x}"'}
+
+    def download_file(self, Bucket, Key, Filename, ExtraArgs=None, Config=None, Callback=None):
+        body = self.get_object(Bucket=Bucket, Key=Key)["Body"]
+        with open(Filename, "wb") as f:
+            f.write(body.getvalue())
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._wait()
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, ContinuationToken=None, **kwargs):
+        self._wait()
+        keys = sorted(key for bucket, key in list(self.objects) if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        now = datetime.now(timezone.utc)
+        response = {"KeyCount": len(page),
+                    "Contents": [{"Key": key, "Size": len(self.objects[(Bucket, key)]), "LastModified": now}
+                                 for key in page]}
+        if start + MaxKeys < len(keys):
+            response.update(IsTruncated=True, NextContinuationToken=str(start + MaxKeys))
+        return response
+
+    def get_paginator(self, name):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                token = None
+                while True:
+                    page = s3.list_objects_v2(ContinuationToken=token, **kwargs)
+                    yield page
+                    token = page.get("NextContinuationToken")
+                    if not token:
+                        return
+        return Paginator()
+
+
+class StubModel:
+    """
+    Deterministic stand-in for the classification model.
+
+    Answers with the institution's attribute structure filled from its valid values (picked by
+    a hash of the prompt), padded with reasoning to ``output_chars``. A fraction ``invalid_rate``
+    of answers carry a value outside the valid values, which exercises validation and re-runs.
+    """
+
+    def __init__(self, profile, output_chars: int = 1200, invalid_rate: float = 0.0):
+        self.profile = profile
+        self.output_chars = output_chars
+        self.invalid_rate = invalid_rate
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    def respond(self, prompt: str, max_tokens: Optional[int] = None) -> Tuple[str, dict, str]:
+        """Return (text, usage, stop reason); text beyond ``max_tokens`` (4 characters each) is cut off."""
+        seed = zlib.crc32(prompt.encode("utf-8"))
+        invalid = (seed % 10000) / 10000 < self.invalid_rate
+        attributes = {}
+        for i, (path, allowed) in enumerate(zip(self.profile.header_paths, self.profile.column_valid_sets)):
+            if path == ("Reasoning",):
+                continue
+            value = sorted(allowed)[(seed >> i) % len(allowed)] if allowed else "Not specified"
+            if invalid and allowed:
+                value, invalid = "Not a valid value", False
+            node = attributes
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = value
+        reasoning = "Thresholds and report wording support this classification per the guidelines. "
+        attributes["Reasoning"] = (reasoning * (self.output_chars // len(reasoning) + 1))[:self.output_chars]
+        text = json.dumps({"formtype": self.profile.name, "Attributes": attributes}, indent=2)
+        stop_reason = "end_turn"
+        if max_tokens and len(text) > max_tokens * 4:
+            text, stop_reason = text[:max_tokens * 4], "max_tokens"
+
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(text) // 4}
+        with self._lock:
+            self.input_tokens += usage["input_tokens"]
+            self.output_tokens += usage["output_tokens"]
+        return text, usage, stop_reason
+
+    @staticmethod
+    def prompt_text(model_input: dict) -> str:
+        """The text of every content block of an Anthropic messages body."""
+        return "\n".join(block.get("text", "") for message in model_input.get("messages", [])
+                         for block in message.get("content", []))
+
+
+class LocalBedrockRuntime:
+    """invoke_model with a fixed latency, rejecting a fraction ``throttle_rate`` of calls as throttled."""
+
+    def __init__(self, model: StubModel, latency: float = 0.3, throttle_rate: float = 0.0, seed: int = 0):
+        self.model = model
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = 0
+        self.throttled = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body, contentType="application/json", accept="application/json", **kwargs):
+        with self._lock:
+            self.calls += 1
+            throttle = self._rng.random() < self.throttle_rate
+            self.throttled += throttle
+        if throttle:
+            time.sleep(self.latency / 10)
+            raise _client_error("ThrottlingException", "Too many requests, please wait before trying again.",
+                                "InvokeModel", 429)
+        time.sleep(self.latency)
+        model_input = json.loads(body)
+        text, usage, stop_reason = self.model.respond(StubModel.prompt_text(model_input), model_input.get("max_tokens"))
+        payload = {"content": [{"type": "text", "text": text}], "usage": usage, "stop_reason": stop_reason}
+        return {"body": StreamingBody(json.dumps(payload).encode("utf-8"))}
+
+
+class LocalBedrock:
+    """
+    Batch inference jobs over LocalS3: outputs are written to ``<output uri><job id>/<input name>.out``
+    when the job is created, and the job reports Completed once ``job_seconds`` have passed.
+    """
+
+    def __init__(self, s3: LocalS3, model: StubModel, job_seconds: float = 0.0, latency: float = 0.0):
+        self.s3 = s3
+        self.model = model
+        self.job_seconds = job_seconds
+        self.latency = latency
+        self.jobs: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def create_model_invocation_job(self, modelId, jobName, inputDataConfig, outputDataConfig, roleArn, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            job_id = f"stubjob{len(self.jobs) + 1:06d}"
+            self.jobs[job_id] = {"status": "InProgress", "ready_at": time.monotonic() + self.job_seconds}
+
+        in_bucket, in_key = _split_s3_uri(inputDataConfig["s3InputDataConfig"]["s3Uri"])
+        out_bucket, out_prefix = _split_s3_uri(outputDataConfig["s3OutputDataConfig"]["s3Uri"])
+        lines = []
+        for line in self.s3.get_object(Bucket=in_bucket, Key=in_key)["Body"].iter_lines():
+            record = json.loads(line)
+            text, usage, stop_reason = self.model.respond(StubModel.prompt_text(record["modelInput"]),
+                                                          record["modelInput"].get("max_tokens"))
+            record["modelOutput"] = {"content": [{"type": "text", "text": text}], "usage": usage,
+                                     "stop_reason": stop_reason}
+            lines.append(json.dumps(record))
+        output_key = f"{out_prefix}{job_id}/{in_key.rsplit('/', 1)[-1]}.out"
+        self.s3.put_object(Bucket=out_bucket, Key=output_key, Body="\n".join(lines) + "\n")
+        self.s3.put_object(Bucket=out_bucket, Key=f"{out_prefix}{job_id}/manifest.json.out",
+                           Body=json.dumps({"processedRecordCount": len(lines)}))
+        return {"jobArn": f"arn:aws:bedrock:us-west-2:000000000000:model-invocation-job/{job_id}"}
+
+    def get_model_invocation_job(self, jobIdentifier, **kwargs):
+        time.sleep(self.latency)
+        job = self.jobs[jobIdentifier.rsplit("/", 1)[-1]]
+        if job["status"] == "InProgress" and time.monotonic() >= job["ready_at"]:
+            job["status"] = "Completed"
+        return {"status": job["status"], "message": ""}
+
+
+class LocalIAM:
+    def __init__(self):
+        self.roles: Dict[str, dict] = {}
+        self.policies: Dict[Tuple[str, str], dict] = {}
+
+    def get_role(self, RoleName):
+        if RoleName not in self.roles:
+            raise _client_error("NoSuchEntity", f"The role with name {RoleName} cannot be found.", "GetRole", 404)
+        return {"Role": self.roles[RoleName]}
+
+    def create_role(self, RoleName, AssumeRolePolicyDocument, **kwargs):
+        self.roles[RoleName] = {"RoleName": RoleName, "Arn": f"arn:aws:iam::000000000000:role/{RoleName}",
+                                "AssumeRolePolicyDocument": json.loads(AssumeRolePolicyDocument)}
+        return {"Role": self.roles[RoleName]}
+
+    def update_assume_role_policy(self, RoleName, PolicyDocument):
+        self.roles[RoleName]["AssumeRolePolicyDocument"] = json.loads(PolicyDocument)
+
+    def get_role_policy(self, RoleName, PolicyName):
+        if (RoleName, PolicyName) not in self.policies:
+            raise _client_error("NoSuchEntity", f"Policy {PolicyName} not found.", "GetRolePolicy", 404)
+        return {"PolicyDocument": self.policies[(RoleName, PolicyName)]}
+
+    def put_role_policy(self, RoleName, PolicyName, PolicyDocument):
+        self.policies[(RoleName, PolicyName)] = json.loads(PolicyDocument)
+
+
+class LocalSTS:
+    def get_caller_identity(self):
+        return {"Account": "000000000000"}
+
+
+class LocalAws:
+    """One set of local services, shared by every session created through ``session``."""
+
+    def __init__(self, model: StubModel, s3_latency: float = 0.005, s3_bytes_per_second: Optional[float] = None,
+                 model_latency: float = 0.3, throttle_rate: float = 0.0, job_seconds: float = 0.0,
+                 control_latency: float = 0.05, seed: int = 0):
+        self.model = model
+        self.s3 = LocalS3(s3_latency, s3_bytes_per_second)
+        self.bedrock = LocalBedrock(self.s3, model, job_seconds, control_latency)
+        self.bedrock_runtime = LocalBedrockRuntime(model, model_latency, throttle_rate, seed)
+        self.iam = LocalIAM()
+        self.sts = LocalSTS()
+
+    def session(self, region_name: Optional[str] = None, **kwargs) -> "LocalAws":
+        """Drop-in for ``boto3.Session``."""
+        return self
+
+    def client(self, service_name: str, **kwargs):
+        return {"s3": self.s3, "bedrock": self.bedrock, "bedrock-runtime": self.bedrock_runtime,
+                "iam": self.iam, "sts": self.sts}[service_name]
+
+    def counters(self) -> dict:
+        return {
+            "s3_requests": self.s3.requests,
+            "s3_bytes_in": self.s3.bytes_in,
+            "s3_bytes_out": self.s3.bytes_out,
+            "batch_jobs": len(self.bedrock.jobs),
+            "runtime_calls": self.bedrock_runtime.calls,
+            "runtime_throttled": self.bedrock_runtime.throttled,
+            "input_tokens": self.model.input_tokens,
+            "output_tokens": self.model.output_tokens,
+        }
@@ -0,0 +1,124 @@
+"""
+Synthetic pediatric audiology records shaped like the raw ``Report``/``Results`` inputs.
+
+Reports are assembled from the phrasing of real newborn and pediatric diagnostic
+reports (ABR, OAE, tympanometry, risk indicators); results are per-ear threshold lists
+in the same form as the README example. Generation is seeded, so a given seed always
+produces the same records.
+"""
+import random
+from typing import Dict, Iterator, List, Tuple
+
+# (label, low dB HL, high dB HL) used both for thresholds and the report wording
+DEGREES = (
+    ("normal hearing", 0, 15),
+    ("slight", 16, 25),
+    ("mild", 26, 40),
+    ("moderate", 41, 55),
+    ("moderately severe", 56, 70),
+    ("severe", 71, 90),
+    ("profound", 91, 110),
+)
+LOSS_TYPES = ("sensorineural", "conductive", "mixed")
+FREQUENCIES = (500, 1000, 2000, 4000)
+EXTRA_FREQUENCIES = (250, 8000)
+STIM_TYPES = ("TONE BURST", "WARBLE", "PURE TONE")
+AIR_TRANSDUCERS = ("INSERT", "SUPRA-AURAL")
+RISK_FACTORS = (
+    "NICU stay greater than 5 days",
+    "positive CMV findings at birth",
+    "family history of permanent childhood hearing loss",
+    "hyperbilirubinemia requiring exchange transfusion",
+    "craniofacial anomalies",
+    "bacterial meningitis",
+    "ototoxic medication exposure",
+)
+HISTORY = (
+    "Patient was referred following a failed newborn hearing screening in {ear}.",
+    "Parents report concerns regarding speech and language development.",
+    "Patient was seen for follow-up after pressure-equalization tube placement.",
+    "Patient was referred by ENT for diagnostic evaluation.",
+    "Child passed the newborn hearing screening; seen due to ongoing monitoring.",
+)
+FILLER = (
+    "Otoscopy revealed clear ear canals bilaterally.",
+    "The child was tested in natural sleep and state was maintained throughout testing.",
+    "Results were discussed with the family, who had the opportunity to ask questions.",
+    "Reliability was judged to be good.",
+    "Distortion product otoacoustic emissions were {oae} in the {ear}.",
+    "Tympanometry revealed {tymp} in the {ear}.",
+    "Recommend audiological re-evaluation in {months} months or sooner if concerns arise.",
+)
+
+
+def _ear_profile(rng: random.Random, normal_fraction: float) -> Tuple[Tuple[str, int, int], str]:
+    """Pick a degree band and loss type for one ear."""
+    if rng.random() < normal_fraction:
+        return DEGREES[0], ""
+    return rng.choice(DEGREES[1:]), rng.choice(LOSS_TYPES)
+
+
+def _thresholds(rng: random.Random, side: str, degree: Tuple[str, int, int], loss_type: str) -> List[dict]:
+    """Air (and for conductive/mixed losses bone) conduction thresholds for one ear."""
+    _, low, high = degree
+    frequencies = FREQUENCIES + tuple(f for f in EXTRA_FREQUENCIES if rng.random() < 0.5)
+    stim = rng.choice(STIM_TYPES)
+    transducer = rng.choice(AIR_TRANSDUCERS)
+    results = []
+    for frequency in frequencies:
+        level = 5 * round(rng.randint(low, high) / 5)
+        results.append({"TransducerType": transducer, "Side": side, "StimType": stim,
+                        "Frequency": frequency, "DB_HL": level, "Type": "THRESHOLD"})
+        if loss_type in ("conductive", "mixed") and frequency in FREQUENCIES:
+            bone = max(0, level - rng.randint(20, 40)) if loss_type == "conductive" else level - 15
+            results.append({"TransducerType": "BONE", "Side": side, "StimType": stim,
+                            "Frequency": frequency, "DB_HL": 5 * round(bone / 5), "Type": "THRESHOLD"})
+    return results
+
+
+def _describe_ear(ear: str, degree: Tuple[str, int, int], loss_type: str) -> str:
+    label = degree[0]
+    if not loss_type:
+        return f"Results for the {ear} are consistent with {label}."
+    return (f"Results for the {ear} are consistent with a {label} {loss_type} hearing loss "
+            f"({degree[1]}-{degree[2]} dB HL).")
+
+
+def generate_patient(rng: random.Random, normal_fraction: float = 0.3, filler_sentences: int = 6) -> dict:
+    """One raw patient record: a free-text report and its audiometric threshold results."""
+    ears = {"left ear": _ear_profile(rng, normal_fraction), "right ear": _ear_profile(rng, normal_fraction)}
+    risks = rng.sample(RISK_FACTORS, k=rng.choice((0, 0, 1, 2)))
+    context = {"ear": rng.choice(("the left ear", "the right ear", "both ears")),
+               "oae": rng.choice(("present", "absent", "present but reduced")),
+               "tymp": rng.choice(("normal middle ear function", "flat tracings consistent with fluid")),
+               "months": rng.choice((3, 6, 12))}
+
+    sentences = [f"AUDIOLOGY REPORT - Age {rng.randint(1, 96)} months.", rng.choice(HISTORY).format(**context)]
+    sentences += [rng.choice(FILLER).format(**context) for _ in range(filler_sentences)]
+    sentences += [_describe_ear(ear, *profile) for ear, profile in ears.items()]
+    if risks:
+        sentences.append("Risk indicators for hearing loss include " + " and ".join(risks) + ".")
+    else:
+        sentences.append("No risk indicators for hearing loss were reported.")
+
+    results = []
+    for side, ear in (("LEFT", "left ear"), ("RIGHT", "right ear")):
+        results.extend(_thresholds(rng, side, *ears[ear]))
+    return {"Report": " ".join(sentences), "Results": results}
+
+
+def generate_patients(count: int, seed: int = 0, normal_fraction: float = 0.3,
+                      filler_sentences: int = 6) -> Iterator[dict]:
+    """Yield ``count`` reproducible synthetic patients."""
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield generate_patient(rng, normal_fraction, filler_sentences)
+
+
+def generate_files(records: int, files: int, seed: int = 0, normal_fraction: float = 0.3,
+                   filler_sentences: int = 6) -> Dict[str, List[dict]]:
+    """Split ``records`` synthetic patients across ``files`` raw export files (name -> patients)."""
+    patients = list(generate_patients(records, seed, normal_fraction, filler_sentences))
+    per_file = -(-records // max(files, 1))
+    return {f"export_{i + 1:04d}.json": patients[start:start + per_file]
+            for i, start in enumerate(range(0, records, per_file))}
@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from automated_aud_batch import MODEL_CONTEXT_TOKENS, BedrockBatch, PipelineMetrics, load_institution_profiles
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "..", "config.json")
+
+
+@pytest.fixture(scope="session")
+def config_path():
+    return CONFIG_PATH
+
+
+@pytest.fixture(scope="session")
+def profiles():
+    return load_institution_profiles(CONFIG_PATH)
+
+
+@pytest.fixture
+def batch():
+    """A BedrockBatch without AWS clients; tests add the clients and settings they need."""
+    batch = BedrockBatch.__new__(BedrockBatch)
+    batch.metrics = PipelineMetrics()
+    batch.prompt_caching = False
+    batch.context_tokens = MODEL_CONTEXT_TOKENS
+    return batch
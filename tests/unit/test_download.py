@@ -0,0 +1,60 @@
+import io
+
+import pytest
+
+import automated_aud_batch
+
+
+class RangedS3:
+    """Serves list_objects_v2 pages and ranged GETs from in-memory objects."""
+
+    def __init__(self, objects, page_size=2):
+        self.objects = objects
+        self.page_size = page_size
+        self.ranges = []
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        for i in range(0, len(keys), self.page_size):
+            yield {"Contents": [{"Key": key, "Size": len(self.objects[key])} for key in keys[i:i + self.page_size]]}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(n) for n in Range[len("bytes="):].split("-"))
+        self.ranges.append((Key, start, end))
+        return {"Body": io.BytesIO(self.objects[Key][start:end + 1])}
+
+
+@pytest.fixture
+def batch(batch, monkeypatch):
+    monkeypatch.setattr(automated_aud_batch, "RESULT_RANGE_BYTES", 7)
+    batch.max_download_workers = 4
+    return batch
+
+
+def test_parts_are_joined_with_newlines_from_unaligned_ranges(batch, tmp_path):
+    parts = {
+        "output/job/a.jsonl.out": b'{"recordId": "REC00000001"}\n{"recordId": "REC00000002"}',
+        "output/job/b.jsonl.out": b'{"recordId": "REC00000003"}\n',
+        "output/job/c.jsonl.out": b"short",
+        "output/job/manifest.json.out": b"not a result part",
+    }
+    batch.s3_client = RangedS3(parts)
+    output_file = str(tmp_path / "results.jsonl.out")
+
+    assert batch.download_batch_results("bucket", "output/job/", output_file) == output_file
+
+    with open(output_file, "rb") as f:
+        assert f.read() == b"\n".join(body for key, body in sorted(parts.items())
+                                      if key.endswith(".jsonl.out")) + b"\n"
+    assert {key for key, _, _ in batch.s3_client.ranges} == {
+        "output/job/a.jsonl.out", "output/job/b.jsonl.out", "output/job/c.jsonl.out"}
+    assert len(batch.s3_client.ranges) == 8 + 4 + 1
+    assert not (tmp_path / "results.jsonl.out.part").exists()
+
+
+def test_no_parts_returns_none(batch, tmp_path):
+    batch.s3_client = RangedS3({})
+    assert batch.download_batch_results("bucket", "output/job/", str(tmp_path / "results.jsonl.out")) is None
@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from automated_aud_batch import extract_json
+
+EXPECTED = {"Degree": "Mild", "Reasoning": "PTA of 30 dB HL"}
+
+
+@pytest.mark.parametrize("text", [
+    '{"Degree": "Mild", "Reasoning": "PTA of 30 dB HL"}',
+    'Here is the classification:\n```json\n{"Degree": "Mild", "Reasoning": "PTA of 30 dB HL"}\n```\nDone.',
+    'Using {guideline 3} as cited: {"Degree": "Mild", "Reasoning": "PTA of 30 dB HL"} trailing {prose',
+])
+def test_valid_objects_need_no_repairs(text):
+    assert extract_json(text) == (EXPECTED, ())
+
+
+def test_fence_is_preferred_over_earlier_objects():
+    text = '{"Degree": "Severe"}\n```json\n{"Degree": "Mild", "Reasoning": "PTA of 30 dB HL"}\n```'
+    assert extract_json(text)[0] == EXPECTED
+
+
+@pytest.mark.parametrize("text,repair", [
+    ('{"Degree": "Mild", "Reasoning": "PTA of\n30 dB HL"}', "control_chars"),
+    ('{"Degree": "Mild", "Reasoning": "PTA of 30 dB HL",}', "trailing_commas"),
+    ("{'Degree': 'Mild', 'Reasoning': 'PTA of 30 dB HL'}", "single_quotes"),
+    ('{"Degree": "Mild", "Reasoning": "PTA of 30 dB HL", "Notes": None}', "python_literals"),
+    ('{"Degree": "Mild", "Reasoning": "PTA of 30 dB HL \\d"}', "invalid_escapes"),
+    ('{\\"Degree\\": \\"Mild\\", \\"Reasoning\\": \\"PTA of 30 dB HL\\"}', "double_escaped"),
+    ('{"Degree": "Mild", "Reasoning": "PTA of 30 dB', "truncated"),
+])
+def test_repairs_are_applied_and_reported(text, repair):
+    parsed, repairs = extract_json(text)
+    assert repair in repairs
+    assert parsed["Degree"] == "Mild"
+
+
+def test_truncated_outer_object_is_repaired_rather_than_a_nested_one():
+    parsed, repairs = extract_json('{"Left Ear": {"Degree": "Mild"}, "Right Ear": {"Degree": "Mod')
+    assert parsed == {"Left Ear": {"Degree": "Mild"}, "Right Ear": {"Degree": "Mod"}}
+    assert "truncated" in repairs
+
+
+@pytest.mark.parametrize("text", ["", "no json here", "[1, 2, 3]", '{"a": 1 "b": 2}'])
+def test_unparseable_output_raises_value_error(text):
+    with pytest.raises(ValueError):
+        extract_json(text)
+
+
+def test_many_unbalanced_braces_stay_linear():
+    text = "{" * 200000
+    started = time.perf_counter()
+    with pytest.raises(ValueError):
+        extract_json(text)
+    assert time.perf_counter() - started < 2
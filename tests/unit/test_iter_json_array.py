@@ -0,0 +1,56 @@
+import io
+import json
+
+import pytest
+
+from automated_aud_batch import iter_json_array
+
+CHUNK_SIZES = [1, 2, 3, 4, 5, 7, 16, 1024]
+
+
+def parse(text, chunk_size):
+    return list(iter_json_array(io.BytesIO(text.encode("utf-8")), chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", [
+    "[1.5]",
+    "[-2.5]",
+    "[1e10, -0.25E-3, 12345678901234567890, 0]",
+    '[true, false, null, "x"]',
+    '[ {"Report": "mild \\u00e9 loss", "Results": [{"Frequency": 500, "DB_HL": 10.5}]} , [] , {} ]',
+    '["café — ñ", "\U0001f600"]',
+    "[]",
+    "  [ ]  ",
+    "﻿[1, 2]",
+    "[\n  1 ,\n  2\n]\n",
+])
+def test_matches_json_loads_at_every_chunk_size(text, chunk_size):
+    assert parse(text, chunk_size) == json.loads(text.lstrip("﻿"))
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", [
+    "[1 2]",
+    "[1,,2]",
+    "[,1]",
+    "[1,]",
+    "[1",
+    "[1,",
+    '{"a": 1}',
+    "[1x]",
+])
+def test_rejects_malformed_arrays(text, chunk_size):
+    with pytest.raises(ValueError):
+        parse(text, chunk_size)
+
+
+def test_empty_stream_yields_nothing():
+    assert parse("", 4) == []
+
+
+def test_elements_are_yielded_before_the_stream_is_exhausted():
+    stream = io.BytesIO(b'[{"a": 1}, {"b": 2}, ' + b" " * 10000 + b"3]")
+    items = iter_json_array(stream, chunk_size=64)
+    assert next(items) == {"a": 1}
+    assert stream.tell() < 1000
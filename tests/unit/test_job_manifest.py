@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import automated_aud_batch
+from automated_aud_batch import RESULT_DOWNLOAD_ATTEMPTS
+
+
+class StubBedrock:
+    """Batch job control plane; every job has completed by the time it is polled."""
+
+    def __init__(self):
+        self.created = []
+        self.polls = {}
+
+    def create_model_invocation_job(self, modelId, jobName, inputDataConfig, outputDataConfig, roleArn):
+        self.created.append(jobName)
+        return {"jobArn": f"arn:aws:bedrock:us-east-1:123:model-invocation-job/job{len(self.created)}"}
+
+    def get_model_invocation_job(self, jobIdentifier):
+        job_id = jobIdentifier.rsplit("/", 1)[-1]
+        self.polls[job_id] = self.polls.get(job_id, 0) + 1
+        return {"status": "Completed"}
+
+
+@pytest.fixture
+def batch(batch, monkeypatch):
+    monkeypatch.setattr(automated_aud_batch, "POLL_MIN_INTERVAL", 0)
+    batch.bedrock_client = StubBedrock()
+    batch.region, batch.account_id, batch.llm_model_id = "us-east-1", "123", "model"
+    batch._unpropagated_roles = set()
+    batch.downloads, batch.downloads_fail = [], False
+
+    def download(bucket_name, s3_prefix, output_file):
+        batch.downloads.append(s3_prefix)
+        return None if batch.downloads_fail else output_file
+
+    monkeypatch.setattr(batch, "get_batch_role_arn", lambda bucket_name: "arn:aws:iam::123:role/batch")
+    monkeypatch.setattr(batch, "download_batch_results", download)
+    return batch
+
+
+def job_manifest(*jobs):
+    return {"run_id": "run", "input_bucket": "bucket", "input_prefix": "raw/", "output_prefix": "output/",
+            "institution": "CDC", "finished": False,
+            "jobs": [dict({"job_name": f"job-{i}", "input_key": f"input/{i}.jsonl", "record_count": 100,
+                           "job_id": None, "status": "Pending", "result_file": None}, **job)
+                     for i, job in enumerate(jobs)]}
+
+
+def test_resume_polls_submitted_jobs_and_submits_only_pending_ones(batch, tmp_path):
+    path = str(tmp_path / "manifest.json")
+    batch._save_job_manifest(path, job_manifest(
+        {"job_id": "done", "status": "Completed", "result_file": "downloaded_results_done.jsonl.out"},
+        {"job_id": "running", "status": "InProgress"},
+        {}))
+
+    resumed = batch._load_job_manifest(path, "bucket", "raw/", "CDC")
+    result_files = batch.orchestrate_batch_jobs(resumed, path)
+
+    assert batch.bedrock_client.created == ["job-2"]
+    assert set(batch.bedrock_client.polls) == {"running", "job1"}
+    assert batch.downloads == ["output/running/", "output/job1/"]
+    assert result_files == ["downloaded_results_done.jsonl.out", "downloaded_results_running.jsonl.out",
+                            "downloaded_results_job1.jsonl.out"]
+    with open(path, encoding="utf-8") as f:
+        assert [job["status"] for job in json.load(f)["jobs"]] == ["Completed"] * 3
+
+
+@pytest.mark.parametrize("change", [{"finished": True}, {"input_prefix": "other/"}, {"institution": "Redcap"}])
+def test_finished_or_foreign_manifest_is_not_resumed(batch, tmp_path, change):
+    path = str(tmp_path / "manifest.json")
+    batch._save_job_manifest(path, dict(job_manifest({}), **change))
+    assert batch._load_job_manifest(path, "bucket", "raw/", "CDC") is None
+
+
+def test_failed_download_is_retried_then_resumed_without_resubmitting(batch, tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = job_manifest({})
+    batch._save_job_manifest(path, manifest)
+    batch.downloads_fail = True
+
+    with pytest.raises(RuntimeError, match="job1"):
+        batch.orchestrate_batch_jobs(manifest, path)
+    assert batch.downloads == ["output/job1/"] * RESULT_DOWNLOAD_ATTEMPTS
+
+    batch.downloads_fail = False
+    resumed = batch._load_job_manifest(path, "bucket", "raw/", "CDC")
+    assert batch.orchestrate_batch_jobs(resumed, path) == ["downloaded_results_job1.jsonl.out"]
+    assert batch.bedrock_client.created == ["job-0"]
@@ -0,0 +1,77 @@
+import io
+import json
+import threading
+
+import pytest
+
+from automated_aud_batch import CHARS_PER_TOKEN, PROMPT_CACHE_MIN_TOKENS, BatchInputManifest
+
+LONG_PREFIX = "x" * (PROMPT_CACHE_MIN_TOKENS * CHARS_PER_TOKEN)
+SHORT_PREFIX = "x" * (PROMPT_CACHE_MIN_TOKENS * CHARS_PER_TOKEN // 2)
+
+
+@pytest.fixture
+def recording_batch(batch, monkeypatch):
+    batch.max_concurrent_requests = 4
+    batch.prompt_caching = True
+    batch.calls = []
+    lock = threading.Lock()
+
+    def process_single_text(i, text, total, static_prompt="", max_tokens=0):
+        with lock:
+            batch.calls.append(("start", i))
+        with lock:
+            batch.calls.append(("end", i))
+        return {"text": text}
+
+    monkeypatch.setattr(batch, "_process_single_text", process_single_text)
+    return batch
+
+
+def test_cacheable_prefix_is_written_by_one_request_before_fan_out(recording_batch):
+    batch = recording_batch
+    results = batch.process_texts_individually(["a", "b", "c", "d"], static_prompt=LONG_PREFIX)
+    assert results == {0: {"text": "a"}, 1: {"text": "b"}, 2: {"text": "c"}, 3: {"text": "d"}}
+    assert batch.calls[:2] == [("start", 0), ("end", 0)]
+    assert sorted(i for event, i in batch.calls if event == "start") == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize("static_prompt,prompt_caching", [(SHORT_PREFIX, True), (LONG_PREFIX, False), ("", True)])
+def test_no_warm_up_when_prefix_cannot_be_cached(recording_batch, static_prompt, prompt_caching):
+    batch = recording_batch
+    batch.prompt_caching = prompt_caching
+    barrier = threading.Barrier(2, timeout=5)
+    original = batch._process_single_text
+
+    def wait_for_each_other(i, *args, **kwargs):
+        barrier.wait()
+        return original(i, *args, **kwargs)
+
+    batch._process_single_text = wait_for_each_other
+    results = batch.process_texts_individually(["a", "b"], static_prompt=static_prompt)
+    assert list(results) == [0, 1]
+
+
+def test_on_demand_outputs_are_saved_unchanged_and_parsed_like_batch_outputs(batch, profiles, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    attributes = {"Hearing Type": {ear: {"Overall Result": "No hearing loss", "Degree": "1"}
+                                   for ear in ("Left Ear", "Right Ear")}, "Reasoning": "Normal thresholds."}
+    response = {"content": [{"type": "text", "text": f"Here is the classification:\n```json\n"
+                                                     f"{json.dumps({'Attributes': attributes})}\n```"}],
+                "stop_reason": "end_turn", "usage": {"input_tokens": 100, "output_tokens": 40}}
+    batch.max_concurrent_requests = 2
+    monkeypatch.setattr(batch, "_invoke_with_backoff", lambda request_body, label: response)
+    monkeypatch.setattr(batch, "_ensure_s3_permissions", lambda bucket_name: None)
+    monkeypatch.setattr(batch, "_save_record_map", lambda bucket_name, run_id, record_map: None)
+    manifest = BatchInputManifest(source_key="raw/a.json", s3_key="input/a.jsonl", record_ids=["PAT00000001"],
+                                  prompts=["patient"], static_prompt="static")
+
+    output_file, record_map = batch.classify_on_demand("bucket", [manifest], "run")
+
+    with open(output_file, encoding="utf-8") as f:
+        assert [json.loads(line)["modelOutput"] for line in f] == [response]
+    failures = {}
+    rows = list(batch._iter_csv_rows(output_file, profiles["CDC"], io.StringIO(), failures=failures))
+    assert [row[3:] for row in rows] == [["No hearing loss", "1", "No hearing loss", "1", "Normal thresholds."]]
+    assert failures == {}
+    assert batch.metrics.counters[("tokens", (("type", "input"),))] == 100
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from automated_aud_batch import (
+    BATCH_MIN_RECORDS,
+    BatchInputManifest,
+    PACKED_RECORD_PREFIX,
+)
+
+
+class RecordingS3:
+    """Just enough of an S3 client for pack_batch_inputs; keeps every object in memory."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, Callback=None):
+        self.objects[Key] = Fileobj.read()
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self.objects[Key] = Body.encode("utf-8") if isinstance(Body, str) else Body
+
+
+@pytest.fixture
+def batch(batch, monkeypatch):
+    batch.s3_client = RecordingS3()
+    monkeypatch.setattr(batch, "_ensure_s3_permissions", lambda bucket_name: None)
+    return batch
+
+
+def manifest_with_sizes(*sizes):
+    return BatchInputManifest(source_key="input/a.json", s3_key="input/a.jsonl", record_sizes=list(sizes),
+                              record_ids=[f"R{i}" for i in range(len(sizes))])
+
+
+def assert_contiguous(bounds, total):
+    assert bounds[0][0] == 0 and bounds[-1][1] == total
+    assert all(prev[1] == cur[0] for prev, cur in zip(bounds, bounds[1:]))
+
+
+def test_plan_shards_single_shard_under_limits(batch):
+    assert batch._plan_shards([manifest_with_sizes(*[10] * 150)]) == [(0, 150)]
+
+
+def test_plan_shards_balances_record_counts_across_manifests(batch):
+    manifests = [manifest_with_sizes(*[10] * 250), manifest_with_sizes(*[10] * 250)]
+    bounds = batch._plan_shards(manifests, max_records=200)
+    assert_contiguous(bounds, 500)
+    assert [end - start for start, end in bounds] == [167, 167, 166]
+
+
+def test_plan_shards_respects_byte_limit(batch):
+    sizes = [100] * 300 + [5000] * 10 + [100] * 300
+    bounds = batch._plan_shards([manifest_with_sizes(*sizes)], max_bytes=20000)
+    assert_contiguous(bounds, len(sizes))
+    assert all(sum(sizes[start:end]) <= 20000 for start, end in bounds)
+
+
+def test_plan_shards_trailing_shard_borrows_to_minimum(batch):
+    bounds = batch._plan_shards([manifest_with_sizes(*[10] * 260)], max_records=250)
+    assert_contiguous(bounds, 260)
+    assert all(end - start >= BATCH_MIN_RECORDS for start, end in bounds)
+
+
+def test_plan_shards_empty(batch):
+    assert batch._plan_shards([]) == [(0, 0)]
+
+
+def test_pack_batch_inputs_streams_spools_into_shards(batch, monkeypatch):
+    monkeypatch.setattr(batch, "_plan_shards", lambda manifests: [(0, 3), (3, 5)])
+    manifests = []
+    for name, count in (("a", 2), ("empty", 0), ("b", 3)):
+        manifest = BatchInputManifest(source_key=f"input/{name}.json", s3_key=f"input/{name}.jsonl")
+        for i in range(count):
+            manifest.add_record(f"PAT{i:08d}", {"messages": [{"role": "user", "content": f"{name} {i}"}]})
+        manifests.append(manifest)
+
+    shards, record_map = batch.pack_batch_inputs("bucket", manifests, run_id="run")
+
+    lines = [json.loads(line) for shard in shards for line in batch.s3_client.objects[shard.s3_key].splitlines()]
+    assert [shard.record_count for shard in shards] == [3, 2]
+    assert [line["recordId"] for line in lines] == [f"{PACKED_RECORD_PREFIX}{i:08d}" for i in range(1, 6)]
+    assert [line["modelInput"]["messages"][0]["content"] for line in lines] == ["a 0", "a 1", "b 0", "b 1", "b 2"]
+    assert [record_map[line["recordId"]] for line in lines] == [
+        ("input/a.json", "PAT00000000"), ("input/a.json", "PAT00000001"),
+        ("input/b.json", "PAT00000000"), ("input/b.json", "PAT00000001"), ("input/b.json", "PAT00000002"),
+    ]
+    # Generated and packed record IDs have the same width, so the planning estimate is exact
+    assert sum(shard.total_bytes for shard in shards) == sum(manifest.total_bytes for manifest in manifests)
+    assert json.loads(batch.s3_client.objects["input/packed/run/record_map.json"]) == {
+        key: list(value) for key, value in record_map.items()
+    }
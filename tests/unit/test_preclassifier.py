@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from automated_aud_batch import AudiogramPreclassifier, InstitutionProfile
+
+NORMAL_REPORT = "Hearing screening for speech delay. Responses were reliable."
+
+
+def preclassifier(profiles, institution):
+    return AudiogramPreclassifier.from_profile(profiles[institution])
+
+
+def audiogram(left, right=None, left_fields=None):
+    """Air-conduction thresholds for each ear as {frequency: DB_HL}, with extra fields per left-ear frequency."""
+    results = []
+    for side, levels in (("LEFT", left), ("RIGHT", left if right is None else right)):
+        for frequency, level in levels.items():
+            fields = (left_fields or {}).get(frequency, {}) if side == "LEFT" else {}
+            results.append({"TransducerType": "INSERT", "Side": side, "StimType": "TONE", "Frequency": frequency,
+                            "DB_HL": level, "Type": "THRESHOLD", **fields})
+    return results
+
+
+NORMAL = {500: 10, 1000: 5, 2000: 10, 4000: 15}
+MILD = {500: 30, 1000: 35, 2000: 35, 4000: 30}
+
+
+def attributes(output):
+    return json.loads(output)["Attributes"]
+
+
+def test_normal_hearing_uses_each_institutions_values(profiles):
+    cdc = attributes(preclassifier(profiles, "CDC").classify(NORMAL_REPORT, audiogram(NORMAL))[0])
+    assert cdc["Hearing Type"]["Left Ear"] == {"Overall Result": "No hearing loss", "Degree": "1"}
+    assert cdc["Hearing Type"]["Right Ear"] == {"Overall Result": "No hearing loss", "Degree": "1"}
+
+    mee = attributes(preclassifier(profiles, "MassEyeAndEar").classify(NORMAL_REPORT, audiogram(NORMAL))[0])
+    assert mee["Hearing Type"]["Left Ear"] == {"Type of Loss": "Normal hearing (-10 - 15 dB)",
+                                               "Degree of Loss": "", "Neuro Type": ""}
+
+
+@pytest.mark.parametrize("institution", ["MassEyeAndEar", "CDC", "Dawn"])
+def test_bypass_output_passes_validation(profiles, institution):
+    output = preclassifier(profiles, institution).classify(NORMAL_REPORT, audiogram(NORMAL))[0]
+    assert profiles[institution].validate(attributes(output)) == []
+
+
+def test_institution_without_normal_hearing_map_is_never_bypassed(profiles):
+    assert preclassifier(profiles, "Redcap").classify(NORMAL_REPORT, audiogram(NORMAL)) == (None, "")
+
+
+def test_normal_hearing_map_must_name_csv_columns():
+    with pytest.raises(ValueError):
+        InstitutionProfile.compile("X", {"csv_headers": ["Patient Index", "Raw Report", "Results", "Left Ear Degree"],
+                                         "normal_hearing": {"Left Ear Type": "Normal"}})
+
+
+def test_report_guard_sends_record_to_the_model(profiles):
+    output, hint = preclassifier(profiles, "CDC").classify("Mild conductive component noted.", audiogram(NORMAL))
+    assert output is None
+    assert hint.startswith("Left Ear: 1 ")
+
+
+def test_loss_gives_degree_hint(profiles):
+    output, hint = preclassifier(profiles, "Redcap").classify(NORMAL_REPORT, audiogram(MILD, NORMAL))
+    assert output is None
+    assert hint == "Left Ear: Mild (26-40 dB HL) (pure-tone average 32 dB HL)\n"
+
+
+def test_threshold_outside_the_average_band_is_ambiguous(profiles):
+    output, hint = preclassifier(profiles, "CDC").classify(NORMAL_REPORT, audiogram({**NORMAL, 4000: 45}, NORMAL))
+    assert output is None
+    assert hint.startswith("Right Ear: ")
+
+
+def test_one_missing_pta_frequency_is_tolerated(profiles):
+    three = {500: 10, 1000: 5, 2000: 10}
+    assert preclassifier(profiles, "CDC").classify(NORMAL_REPORT, audiogram(three))[0] is not None
+
+
+@pytest.mark.parametrize("left", [
+    {**NORMAL, 4000: "NR"},
+    {**NORMAL, 4000: None},
+    {**NORMAL, 4000: "not tested"},
+    {500: 10, 1000: 5, 2000: 10, 4000: "NR"},
+])
+def test_non_numeric_threshold_makes_ear_ambiguous(profiles, left):
+    output, hint = preclassifier(profiles, "CDC").classify(NORMAL_REPORT, audiogram(left, NORMAL))
+    assert output is None
+    assert not hint.startswith("Left Ear")
+
+
+@pytest.mark.parametrize("extra", [{"NoResponse": True}, {"NR": "Y"}, {"Type": "NO RESPONSE"}])
+def test_no_response_flag_makes_ear_ambiguous(profiles, extra):
+    results = audiogram(NORMAL, NORMAL, left_fields={4000: extra})
+    output, hint = preclassifier(profiles, "CDC").classify(NORMAL_REPORT, results)
+    assert output is None
+    assert not hint.startswith("Left Ear")
+
+
+def test_unset_no_response_flag_is_ignored(profiles):
+    results = audiogram(NORMAL, left_fields={500: {"NoResponse": False, "NR": "N"}})
+    assert preclassifier(profiles, "CDC").classify(NORMAL_REPORT, results)[0] is not None
+
+
+def test_bone_conduction_and_repeats(profiles):
+    _, _, unusable = AudiogramPreclassifier.thresholds(
+        audiogram({500: 10}) + [{"TransducerType": "BONE", "Side": "LEFT", "Frequency": 500, "DB_HL": "NR",
+                                 "Type": "THRESHOLD"}])
+    assert not unusable.any()
+    grid, frequencies, _ = AudiogramPreclassifier.thresholds(audiogram({500: 10}) + audiogram({500: 20}, {500: 5}))
+    assert frequencies == (500,)
+    assert grid.tolist() == [[20.0], [10.0]]
@@ -0,0 +1,117 @@
+import csv
+import random
+
+import pytest
+
+import automated_aud_batch
+from automated_aud_batch import SortedCsvWriter
+
+HEADERS = ("Record ID", "Value")
+
+
+def row(index, value="new"):
+    return [f"PAT{index:08d}", value]
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+
+def leftover_files(tmp_path, keep="out.csv"):
+    return sorted(p.name for p in tmp_path.iterdir() if p.name != keep)
+
+
+@pytest.fixture
+def small_spills(monkeypatch):
+    monkeypatch.setattr(automated_aud_batch, "CSV_SPILL_ROWS", 3)
+
+
+@pytest.mark.parametrize("buffer_size", [0, 2, 1000])
+def test_rows_come_out_sorted(tmp_path, small_spills, buffer_size):
+    indexes = list(range(50))
+    random.Random(buffer_size).shuffle(indexes)
+    path = str(tmp_path / "out.csv")
+    writer = SortedCsvWriter(path, HEADERS, buffer_size=buffer_size)
+    for index in indexes:
+        writer.add(row(index))
+    writer.close()
+
+    assert read_csv(path) == [list(HEADERS)] + [row(index) for index in range(50)]
+    assert writer.rows_written == 50
+    assert leftover_files(tmp_path) == []
+
+
+def test_merge_existing_replaces_rows_with_the_same_record_id(tmp_path, small_spills):
+    path = str(tmp_path / "out.csv")
+    writer = SortedCsvWriter(path, HEADERS)
+    for index in range(0, 10, 2):
+        writer.add(row(index, "old"))
+    writer.close()
+
+    writer = SortedCsvWriter(path, HEADERS, buffer_size=0, merge_existing=True)
+    for index in (9, 4, 1, 8):
+        writer.add(row(index))
+    writer.close()
+
+    expected = {0: "old", 1: "new", 2: "old", 4: "new", 6: "old", 8: "new", 9: "new"}
+    assert read_csv(path) == [list(HEADERS)] + [row(index, value) for index, value in sorted(expected.items())]
+    assert writer.rows_written == len(expected)
+    assert leftover_files(tmp_path) == []
+
+
+def test_abort_removes_temporary_files(tmp_path, small_spills):
+    path = str(tmp_path / "out.csv")
+    writer = SortedCsvWriter(path, HEADERS, buffer_size=0)
+    for index in (5, 4, 3, 2, 1, 0):
+        writer.add(row(index))
+    assert len(leftover_files(tmp_path)) > 1  # part file and spilled runs
+    writer.abort()
+
+    assert leftover_files(tmp_path, keep=None) == []
+
+
+def test_abort_puts_back_the_existing_csv(tmp_path):
+    path = str(tmp_path / "out.csv")
+    writer = SortedCsvWriter(path, HEADERS)
+    writer.add(row(1, "old"))
+    writer.close()
+
+    writer = SortedCsvWriter(path, HEADERS, merge_existing=True)
+    writer.add(row(1))
+    writer.abort()
+
+    assert read_csv(path) == [list(HEADERS), row(1, "old")]
+    assert leftover_files(tmp_path) == []
+
+
+def test_failed_merge_keeps_the_existing_csv(tmp_path, monkeypatch):
+    path = str(tmp_path / "out.csv")
+    writer = SortedCsvWriter(path, HEADERS)
+    writer.add(row(1, "old"))
+    writer.close()
+
+    writer = SortedCsvWriter(path, HEADERS, merge_existing=True)
+    writer.add(row(2))
+    monkeypatch.setattr(automated_aud_batch.heapq, "merge", lambda *args, **kwargs: iter([(1, None)]))
+    with pytest.raises(TypeError):
+        writer.close()
+    writer.abort()
+
+    assert read_csv(path) == [list(HEADERS), row(1, "old")]
+    assert leftover_files(tmp_path) == []
+
+
+def test_jsonl_to_csv_leaves_no_partial_files_on_failure(tmp_path, monkeypatch, small_spills, batch, config_path):
+    monkeypatch.chdir(tmp_path)
+
+    def failing_rows(jsonl_filename, profile, f_log, lookup=None, failures=None):
+        for index in (5, 4, 3, 2, 1, 0):
+            yield [f"PAT{index:08d}"] + [""] * (len(profile.csv_headers) - 1)
+        raise OSError("connection reset")
+
+    monkeypatch.setattr(batch, "_iter_csv_rows", failing_rows)
+    with pytest.raises(OSError):
+        batch.jsonl_to_csv("results.jsonl.out", "CDC", config_path=config_path)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["results_cdc_error_log.txt"]
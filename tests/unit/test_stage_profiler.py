@@ -0,0 +1,70 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from automated_aud_batch import JsonlUploadStream, StageProfiler
+
+
+class ThreadedUploadS3:
+    """Reads the uploaded file object on a transfer thread, as s3transfer does."""
+
+    def __init__(self):
+        self.objects = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transfer")
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, Callback=None):
+        self.objects[Key] = self._executor.submit(Fileobj.read).result()
+
+
+def busy_records(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        yield {"value": sum(range(2000))}
+
+
+class StagedBatch:
+    def __init__(self):
+        self.s3_client = ThreadedUploadS3()
+
+    def _generate_jsonl_for_file(self):
+        self.s3_client.upload_fileobj(JsonlUploadStream(busy_records(0.3)), "bucket", "key")
+
+    def jsonl_to_csv(self):
+        pass
+
+    def packed_jsonl_to_csvs(self):
+        pass
+
+    def _build_csv_row(self):
+        pass
+
+    def extract_and_clean_json(self):
+        pass
+
+
+def sampled_functions(profiler, stage):
+    return {frame.split(" (")[0] for stack in profiler.stacks[stage] for frame in stack.split(";")}
+
+
+def test_upload_read_on_another_thread_counts_towards_the_callers_stage():
+    batch = StagedBatch()
+    profiler = StageProfiler(interval=0.001)
+    profiler.instrument(batch)
+    profiler.start()
+    try:
+        batch._generate_jsonl_for_file()
+    finally:
+        profiler.stop()
+
+    assert batch.s3_client.objects["key"].startswith(b'{"value": ')
+    assert "busy_records" in sampled_functions(profiler, "prompt_generation")
+    assert not sampled_functions(profiler, "jsonl_to_csv")
+
+
+def test_stop_restores_the_switch_interval():
+    before = sys.getswitchinterval()
+    profiler = StageProfiler()
+    profiler.start()
+    assert sys.getswitchinterval() < before
+    profiler.stop()
+    assert sys.getswitchinterval() == before
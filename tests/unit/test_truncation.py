@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from automated_aud_batch import MODEL_MAX_OUTPUT_TOKENS, TRUNCATED_OUTPUT_REASON
+VALID = {"Attributes": {"Hearing Type": {"Left Ear": {"Overall Result": "No hearing loss", "Degree": "1"},
+                                         "Right Ear": {"Overall Result": "No hearing loss", "Degree": "1"}},
+                        "Reasoning": "Normal thresholds."}}
+
+
+def output_record(text, stop_reason=None):
+    model_output = {"content": [{"text": text}]}
+    if stop_reason:
+        model_output["stop_reason"] = stop_reason
+    return {"recordId": "PAT00000001", "modelOutput": model_output}
+
+
+@pytest.mark.parametrize("text,stop_reason", [
+    (json.dumps(VALID), "max_tokens"),
+    (json.dumps(VALID)[:-3], None),
+    (json.dumps(VALID)[:-3], "max_tokens"),
+], ids=["stop_reason", "repair", "both"])
+def test_truncated_output_is_a_failure(batch, profiles, text, stop_reason):
+    problems = []
+    row = batch._build_csv_row(output_record(text, stop_reason), profiles["CDC"], 1, ("", ""), problems)
+
+    assert row is not None
+    assert problems == [TRUNCATED_OUTPUT_REASON]
+    assert batch.metrics.counters[("truncated_outputs", ())] == 1
+
+
+def test_complete_output_is_not_a_failure(batch, profiles):
+    problems = []
+    batch._build_csv_row(output_record(json.dumps(VALID), "end_turn"), profiles["CDC"], 1, ("", ""), problems)
+
+    assert problems == []
+    assert ("truncated_outputs", ()) not in batch.metrics.counters
+
+
+def test_on_demand_call_cut_off_is_retried_with_the_model_limit(batch, monkeypatch):
+    limits = []
+
+    def invoke(request_body, label):
+        limits.append(json.loads(request_body)["max_tokens"])
+        if limits[-1] < MODEL_MAX_OUTPUT_TOKENS:
+            return {"content": [{"text": json.dumps(VALID)[:100]}], "stop_reason": "max_tokens"}
+        return {"content": [{"text": json.dumps(VALID)}], "stop_reason": "end_turn"}
+
+    monkeypatch.setattr(batch, "_invoke_with_backoff", invoke)
+
+    output = batch._process_single_text(0, "patient", 1, "static", 1536)
+    assert (output["content"][0]["text"], output["stop_reason"]) == (json.dumps(VALID), "end_turn")
+    assert limits == [1536, MODEL_MAX_OUTPUT_TOKENS]
+    assert batch.metrics.counters[("truncated_outputs", ())] == 1
+
+
+def test_rerun_sends_truncated_records_with_the_model_limit(batch, profiles, monkeypatch, tmp_path):
+    profile = profiles["CDC"]
+    sent = {}
+
+    def classify_on_demand(bucket, manifests, run_id):
+        for manifest in manifests:
+            manifest.spool.seek(0)
+            limits = [json.loads(line)["max_tokens"] for line in manifest.spool]
+            sent[manifest.source_key] = (limits, manifest.max_tokens)
+        return "results.jsonl.out", {}
+
+    monkeypatch.setattr(batch, "classify_on_demand", classify_on_demand)
+    entry = {"report": "Normal hearing.", "results": []}
+    sidecars = {"raw/a.json": {"PAT00000001": entry}, "raw/b.json": {"PAT00000002": entry}}
+    failures = {("raw/a.json", "PAT00000001"): TRUNCATED_OUTPUT_REASON,
+                ("raw/b.json", "PAT00000002"): "Hearing Type > Left Ear > Degree: missing"}
+    job_manifest = {"input_bucket": "bucket", "input_prefix": "raw/", "institution": "CDC", "run_id": "run"}
+
+    batch.rerun_failed_records(job_manifest, failures, sidecars, profile,
+                               manifest_path=str(tmp_path / "batch_jobs_manifest.json"))
+
+    assert sent == {"raw/a.json": ([MODEL_MAX_OUTPUT_TOKENS], MODEL_MAX_OUTPUT_TOKENS),
+                    "raw/b.json": ([profile.max_tokens], profile.max_tokens)}
@@ -0,0 +1,93 @@
+import io
+import json
+
+import pytest
+
+
+def cdc_output(**overrides):
+    ears = {"Left Ear": {"Overall Result": "Sensorineural", "Degree": "Mild (26-40 dB HL)"},
+            "Right Ear": {"Overall Result": "No hearing loss", "Degree": "1"}}
+    for key, value in overrides.items():
+        ear, _, field = key.partition("__")
+        ear = ear.replace("_", " ")
+        if value is None:
+            del ears[ear][field]
+        else:
+            ears[ear][field] = value
+    return {"Hearing Type": ears, "Reasoning": "Thresholds and report."}
+
+
+def redcap_output(tier_one, known="Yes", degree=""):
+    return {"Hearing Type": {"Left Ear": {"Type": "No hearing loss", "Degree": degree},
+                             "Right Ear": {"Type": "No hearing loss", "Degree": "No hearing loss"}},
+            "Known Hearing Loss Risk Indicators": {"Known Hearing Loss Risk": known,
+                                                   "Risk Factors": {"Tier One": tier_one, "Tier Two": []}},
+            "Reasoning": "Normal thresholds."}
+
+
+def test_valid_output_has_no_problems(profiles):
+    assert profiles["CDC"].validate(cdc_output()) == []
+
+
+def test_value_outside_valid_values(profiles):
+    assert profiles["CDC"].validate(cdc_output(Left_Ear__Degree="Mildish")) == [
+        "Hearing Type > Left Ear > Degree: Mildish not in valid values"]
+
+
+@pytest.mark.parametrize("attributes", [
+    cdc_output(Left_Ear__Degree=None),
+    {key: value for key, value in cdc_output().items() if key != "Reasoning"},
+    {"Reasoning": "no hearing type section"},
+])
+def test_missing_column_is_a_problem(profiles, attributes):
+    assert any(problem.endswith(": missing") for problem in profiles["CDC"].validate(attributes))
+
+
+def test_empty_value_only_where_the_rules_allow_it(profiles):
+    assert profiles["CDC"].validate(cdc_output(Left_Ear__Degree="")) == [
+        "Hearing Type > Left Ear > Degree: '' not in valid values"]
+    mee = {"Hearing Type": {ear: {"Type of Loss": "Conductive loss only", "Degree of Loss": "", "Neuro Type": ""}
+                            for ear in ("Left Ear", "Right Ear")}, "Reasoning": ""}
+    assert profiles["MassEyeAndEar"].validate(mee) == []
+    assert profiles["Redcap"].validate(redcap_output([])) == []
+    assert profiles["Redcap"].validate(redcap_output([], known="")) == [
+        "Known Hearing Loss Risk Indicators > Known Hearing Loss Risk: '' not in valid values"]
+
+
+def test_list_values_are_checked_item_by_item(profiles):
+    assert profiles["Redcap"].validate(redcap_output(["cCMV", "Atresia"])) == []
+    assert profiles["Redcap"].validate(redcap_output(["cCMV", "Bad luck", ""])) == [
+        "Known Hearing Loss Risk Indicators > Risk Factors > Tier One: Bad luck, '' not in valid values"]
+
+
+def test_non_string_values_are_invalid(profiles):
+    assert profiles["CDC"].validate(cdc_output(Left_Ear__Degree=2)) == [
+        "Hearing Type > Left Ear > Degree: 2 not in valid values"]
+
+
+class RecordingCache:
+    def __init__(self):
+        self.puts = {}
+
+    def put(self, key, output):
+        self.puts[key] = output
+
+
+@pytest.mark.parametrize("failures", [None, {}])
+def test_invalid_outputs_are_never_cached(tmp_path, batch, profiles, failures):
+    batch.result_cache = RecordingCache()
+    batch.llm_model_id = "model"
+    outputs = {"PAT00000001": cdc_output(), "PAT00000002": cdc_output(Right_Ear__Degree="")}
+    results = tmp_path / "results.jsonl.out"
+    results.write_text("".join(
+        json.dumps({"recordId": record_id,
+                    "modelOutput": {"content": [{"text": json.dumps({"Attributes": attributes})}]}}) + "\n"
+        for record_id, attributes in outputs.items()))
+    entries = {record_id: {"digest": record_id, "report": "", "results": []} for record_id in outputs}
+
+    rows = list(batch._iter_csv_rows(str(results), profiles["CDC"], io.StringIO(), entries.get, failures))
+
+    assert [row[0] for row in rows] == ["PAT00000001", "PAT00000002"]
+    assert list(batch.result_cache.puts) == [batch._cache_key("PAT00000001", profiles["CDC"])]
+    if failures is not None:
+        assert list(failures) == ["PAT00000002"]